@@ -1,9 +1,14 @@
 from fastapi import APIRouter
-from app.api.v1 import auth, passatger, targeta, targeta_virtual, user
+from app.api.v1 import auth, passatger, targeta, targeta_virtual, user, estadistiques, metriques, validacio, canvi_targeta, bloquejades
 
 router = APIRouter()
 router.include_router(auth.router)
 router.include_router(passatger.router)
+router.include_router(canvi_targeta.router)
+router.include_router(bloquejades.router)
 router.include_router(targeta.router)
 router.include_router(targeta_virtual.router)
-router.include_router(user.router)
\ No newline at end of file
+router.include_router(user.router)
+router.include_router(estadistiques.router)
+router.include_router(metriques.router)
+router.include_router(validacio.router)
\ No newline at end of file
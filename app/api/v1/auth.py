@@ -1,13 +1,11 @@
 from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import Optional
 import pymysql
 import random
-import smtplib
 import os
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
 from app.schemas.auth import (
     LoginRequest,
@@ -17,12 +15,20 @@
 )
 from app.core.security import Token, create_access_token, authenticate_user
 from app.db.database import get_db_connection
+from app.db.sharding import shards_document
+from app.core.estadistiques import estadistiques
+from app.core.codis_2fa import magatzem_codis, ResultatConsum
+from app.core.admissio import admissio, Prioritat
+from app.core.cache import cache_lectura
+from app.core.traces import span
 
 router = APIRouter(
     prefix="/api/v1/auth",
     tags=["Autenticació"]
 )
 
+cache_passatgers = cache_lectura("passatger")
+
 CODI_VALIDESA_MINUTS = 5
 
 ## Helpers
@@ -38,7 +44,12 @@ def _get_smtp_config() -> dict:
     }
 
 # Envia codis 2FA a través de e-mail
+# smtplib i email.mime s'importen aquí dins per a no carregar-los a l'arrencada de l'API
 def _enviar_email_2fa(destinatari: str, nom: str, codi: int) -> None:
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
     cfg = _get_smtp_config()
 
     if not cfg["user"] or not cfg["password"] or not cfg["from"]:
@@ -87,14 +98,21 @@ def _enviar_email_2fa(destinatari: str, nom: str, codi: int) -> None:
     msg.attach(MIMEText(body_text, "plain", "utf-8"))
     msg.attach(MIMEText(body_html, "html", "utf-8"))
 
+    # Cada fase de l'SMTP té el seu span, per a veure si el temps se'n va a la connexió, al TLS o a l'enviament
     try:
-        with smtplib.SMTP(cfg["host"], cfg["port"]) as server:
-            server.ehlo()
-            if cfg["starttls"]:
-                server.starttls()
+        with span("smtp.connexio", host=cfg["host"], port=cfg["port"]):
+            server = smtplib.SMTP(cfg["host"], cfg["port"])
+        with server:
+            with span("smtp.ehlo"):
                 server.ehlo()
-            server.login(cfg["user"], cfg["password"])
-            server.sendmail(cfg["from"], destinatari, msg.as_string())
+            if cfg["starttls"]:
+                with span("smtp.starttls"):
+                    server.starttls()
+                    server.ehlo()
+            with span("smtp.login"):
+                server.login(cfg["user"], cfg["password"])
+            with span("smtp.enviament"):
+                server.sendmail(cfg["from"], destinatari, msg.as_string())
     except smtplib.SMTPAuthenticationError:
         raise HTTPException(
             status_code=500,
@@ -107,6 +125,12 @@ def _enviar_email_2fa(destinatari: str, nom: str, codi: int) -> None:
         )
 
 
+# Shard on és el passatger amb aquest document segons el directori
+# Si no hi és, es retorna el shard 0 i la consulta del passatger ja no el trobarà
+def _shard_document(document: str) -> int:
+    shards = shards_document(document)
+    return shards[0] if shards else 0
+
 
 ## Endpoints
 # i. Login
@@ -118,11 +142,13 @@ def _enviar_email_2fa(destinatari: str, nom: str, codi: int) -> None:
     summary="Sol·licita un codi de verificació 2FA",
     description=(
         "Rep el document d'identitat d'un passatger, genera un codi numeric de 6 digits valid durant X minuts i l'envia al correu electronic associat al registre"
-    )
+    ),
+    dependencies=[Depends(admissio(Prioritat.app))]
 )
 # A l'hora de fer login, es segueixen un parell de passes:
 async def login(body: LoginRequest):
-    with get_db_connection() as conn:
+    # Es llegeix de la primària: un passatger acabat de registrar encara pot no haver arribat a la rèplica
+    with get_db_connection(_shard_document(body.document)) as conn:
         cursor = conn.cursor()
         try:
             # 1. Es comprova que el passatger existeix
@@ -139,35 +165,6 @@ async def login(body: LoginRequest):
                 )
 
             passatger_id, nom, email = row[0], row[1], row[2]
-
-            # 2. Si el passatger existeix, s'invaliden els codis 2FA previs que hagi pogut rebre l'usuari
-            # Aquesta lògica s'extén a l'endpoint '/verify'
-            cursor.execute(
-                "DELETE FROM `2fa` WHERE id_passatger = %s",
-                (passatger_id,)
-            )
-
-            # 3. Amb els codis anteriors invalidats, es genera un codi nou que serà vàlid durant X minuts
-            codi = random.randint(100000, 999999)
-            ara = datetime.utcnow()
-            data_expiracio = ara + timedelta(minutes=CODI_VALIDESA_MINUTS)
-
-            # 4. S'emmagatzema el codi generat a la base de dades de forma temporal per a poder comprovar-ho amb el valor que introdueix l'usuari
-            cursor.execute(
-                """
-                INSERT INTO `2fa` (id_passatger, codi, data_creacio, data_expiracio)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (passatger_id, codi, ara, data_expiracio)
-            )
-            conn.commit()
-
-            # 5. Finalment, el codi s'envia al correu de l'usuari
-            _enviar_email_2fa(email, nom, codi)
-
-            return LoginResponse(
-                detail="Codi de verificacio enviat al correu electrònic"
-            )
         except HTTPException:
             raise
         except pymysql.Error as e:
@@ -178,6 +175,20 @@ async def login(body: LoginRequest):
         finally:
             cursor.close()
 
+    # 2. Si el passatger existeix, es genera un codi nou que serà vàlid durant X minuts
+    codi = random.randint(100000, 999999)
+
+    # 3. S'emmagatzema el codi generat de forma temporal per a poder comprovar-ho amb el valor que introdueix l'usuari
+    # Desar-lo invalida els codis 2FA previs que hagi pogut rebre l'usuari (aquesta lògica s'extén a l'endpoint '/verify')
+    magatzem_codis.desar(passatger_id, codi, timedelta(minutes=CODI_VALIDESA_MINUTS))
+
+    # 4. Finalment, el codi s'envia al correu de l'usuari
+    _enviar_email_2fa(email, nom, codi)
+
+    return LoginResponse(
+        detail="Codi de verificacio enviat al correu electrònic"
+    )
+
 
 # ii. Verificació 2FA
 @router.post(
@@ -187,17 +198,18 @@ async def login(body: LoginRequest):
     name="Verificar codi 2FA",
     summary="Valida el codi 2FA i retorna un token d'accés",
     description=(
-        "Rep el document i el codi de 6 digits enviat per correu. Si el codi és correcte i no ha caducat, marca el passatger com a sessio_iniciada i retorna un JWT d'accés"
-    )
+        "Rep el document i el codi de 6 digits enviat per correu. Si el codi és correcte i no ha caducat, marca el passatger com a sessio_iniciada i retorna un JWT d'accés. Després de diversos intents incorrectes el codi s'invalida i cal sol·licitar-ne un de nou"
+    ),
+    dependencies=[Depends(admissio(Prioritat.app))]
 )
 # A l'hora de fer login, es segueixen un parell de passes:
 async def verify(body: VerifyRequest):
-    with get_db_connection() as conn:
+    with get_db_connection(_shard_document(body.document)) as conn:
         cursor = conn.cursor()
         try:
             # 1. S'obté el passatger
             cursor.execute(
-                "SELECT id FROM passatger WHERE document = %s",
+                "SELECT id, sessio_iniciada FROM passatger WHERE document = %s",
                 (body.document,)
             )
             row = cursor.fetchone()
@@ -207,54 +219,43 @@ async def verify(body: VerifyRequest):
                     detail="Document o codi incorrectes"
                 )
 
-            passatger_id = row[0]
+            passatger_id, sessio_iniciada = row[0], row[1]
 
-            # 2. Es cerca un codi que no ha caducat i que estigui associat a aquest passatger
-            cursor.execute(
-                """
-                SELECT id, codi, data_expiracio
-                FROM `2fa`
-                WHERE id_passatger = %s
-                ORDER BY data_creacio DESC
-                LIMIT 1
-                """,
-                (passatger_id,)
-            )
-            fila_2fa = cursor.fetchone()
+            # 2. Es compara i consumeix el codi pendent del passatger (si n'hi ha i no ha caducat)
+            resultat = magatzem_codis.consumir(passatger_id, body.codi)
 
-            if not fila_2fa:
+            if resultat == ResultatConsum.inexistent:
                 raise HTTPException(
                     status_code=401,
                     detail="No hi ha cap codi de verificació pendent. Sol·licita'n un de nou"
                 )
-
-            id_2fa, codi_bd, data_expiracio = fila_2fa[0], fila_2fa[1], fila_2fa[2]
-
-            # 3. Es comprova la caducitat del codi
-            if datetime.utcnow() > data_expiracio:
-                cursor.execute("DELETE FROM `2fa` WHERE id = %s", (id_2fa,))
-                conn.commit()
+            if resultat == ResultatConsum.caducat:
                 raise HTTPException(
                     status_code=401,
                     detail="El codi ha caducat. Sol·licita'n un de nou"
                 )
-
-            # 4. Es comprova que el codi que ha introduit l'usuari coincideix amb el de la base de dades
-            if int(codi_bd) != body.codi:
+            if resultat == ResultatConsum.bloquejat:
+                raise HTTPException(
+                    status_code=429,
+                    detail="Massa intents incorrectes. Sol·licita un codi nou"
+                )
+            if resultat != ResultatConsum.correcte:
                 raise HTTPException(
                     status_code=401,
                     detail="Document o codi incorrectes"
                 )
 
-            # 5. Si el codi és correcte, s'esborra i es marca sessio_iniciada = True
-            cursor.execute("DELETE FROM `2fa` WHERE id = %s", (id_2fa,))
-            cursor.execute(
-                "UPDATE passatger SET sessio_iniciada = TRUE WHERE id = %s",
-                (passatger_id,)
-            )
-            conn.commit()
+            # 3. Si el codi és correcte, es marca sessio_iniciada = True (si no ho estava ja)
+            if not sessio_iniciada:
+                cursor.execute(
+                    "UPDATE passatger SET sessio_iniciada = TRUE WHERE id = %s",
+                    (passatger_id,)
+                )
+                conn.commit()
+                estadistiques.sessio_modificada(sessio_iniciada, True)
+                await run_in_threadpool(cache_passatgers.invalidar, passatger_id)
 
-            # 6. Es genera i es retorna el JWT
+            # 4. Es genera i es retorna el JWT
             access_token = create_access_token(data={"sub": str(passatger_id)})
 
             return VerifyResponse(access_token=access_token)
@@ -278,7 +279,8 @@ async def verify(body: VerifyRequest):
     summary="Login d'usuari de la API amb username i password",
     description=(
         "Endpoint OAuth2 estàndard. Rep username i password en format form-data i retorna un JWT Bearer si les credencials són correctes. Aquest token és necessari per accedir a la resta d'endpoints"
-    )
+    ),
+    dependencies=[Depends(admissio(Prioritat.app))]
 )
 async def token(form_data: OAuth2PasswordRequestForm = Depends()):
     # OAuth2PasswordRequestForm usa 'username' com a camp fix,
@@ -0,0 +1,52 @@
+from fastapi import APIRouter, HTTPException, status, Depends, Header, Response
+from typing import Optional
+
+from app.core.security import User, get_current_user
+from app.core.admissio import admissio, Prioritat
+from app.core.http_cache import etag_coincideix
+from app.core.bloquejades import llista_bloquejades
+
+# S'ha de registrar abans del router de targetes perquè /api/v1/targetes/{targeta_id} no capturi /bloquejades
+router = APIRouter(
+    prefix="/api/v1/targetes/bloquejades",
+    tags=["Targetes"],
+    dependencies=[Depends(admissio(Prioritat.app))]
+)
+
+## Endpoints
+# i. Filtre de Bloom de les targetes bloquejades
+# Si la petició és GET, es retorna la darrera versió del filtre en format binari
+@router.get(
+    "",
+    status_code=status.HTTP_200_OK,
+    response_class=Response,
+    name="Targetes bloquejades",
+    summary="Retorna el filtre de Bloom dels codis de les targetes no actives",
+    description=(
+        "Retorna en format binari (application/octet-stream) un filtre de Bloom amb els codis de totes les targetes "
+        "que no estan en estat 'Activa'. El format i la funció de hash es descriuen a app/core/bloquejades.py. "
+        "La capçalera X-Cursor-Canvis indica el cursor del registre de canvis que inclou el filtre, per a continuar "
+        "amb /api/v1/targetes/canvis. Inclou un ETag i retorna 304 Not Modified si coincideix amb la capçalera If-None-Match"
+    )
+)
+async def get_bloquejades(
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
+):
+    instantania = llista_bloquejades.instantania()
+    if instantania is None:
+        raise HTTPException(
+            status_code=503,
+            detail="La llista de targetes bloquejades encara no està disponible",
+            headers={"Retry-After": "5"}
+        )
+
+    capcaleres = {"ETag": instantania.etag, "X-Cursor-Canvis": instantania.cursor}
+    if etag_coincideix(if_none_match, instantania.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=capcaleres)
+
+    return Response(
+        content=instantania.dades,
+        media_type="application/octet-stream",
+        headers=capcaleres
+    )
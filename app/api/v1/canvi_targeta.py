@@ -0,0 +1,110 @@
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from typing import Optional
+
+from app.schemas.canvi_targeta import CanviTargetaResponse, CanvisTargetaResponse
+from app.db.database import get_db_read_connection
+from app.db.sharding import N_SHARDS, recollir
+from app.core.security import User, get_current_user
+from app.core.admissio import admissio, Prioritat
+from app.core.canvis_targeta import desar_cursor_dispositiu
+
+# S'ha de registrar abans del router de targetes perquè /api/v1/targetes/{targeta_id} no capturi /canvis
+router = APIRouter(
+    prefix="/api/v1/targetes/canvis",
+    tags=["Targetes"],
+    dependencies=[Depends(admissio(Prioritat.app))]
+)
+
+## Helpers
+# El cursor és la darrera versió llegida de cada shard, separades per punts
+def _llegir_cursor(des_de: str) -> list[int]:
+    try:
+        versions = [int(v) for v in des_de.split(".")]
+    except ValueError:
+        versions = []
+    if len(versions) != N_SHARDS or any(v < 0 for v in versions):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cursor no vàlid: ha de tenir {N_SHARDS} versions separades per punts"
+        )
+    return versions
+
+def _cursor(versions: list[int]) -> str:
+    return ".".join(str(v) for v in versions)
+
+## Endpoints
+# i. Canvis d'estat de les targetes des d'una versió
+# Si la petició és GET, es retornen els canvis posteriors al cursor 'des_de' en ordre de versió
+@router.get(
+    "",
+    status_code=status.HTTP_200_OK,
+    response_model=CanvisTargetaResponse,
+    name="Canvis de targetes",
+    summary="Llista els canvis d'estat de les targetes posteriors a una versió",
+    description=(
+        "Retorna els canvis d'estat (creació, bloqueig, baixa...) de les targetes posteriors al cursor 'des_de', "
+        "fins a 'limit' per shard. La primera sincronització es fa amb 'des_de=0' (o un 0 per shard) i les següents "
+        "amb el cursor 'seguent' de la resposta anterior, mentre 'mes' sigui cert. Per a cada targeta només compta "
+        "la darrera entrada. Si s'indica 'dispositiu', quan la sincronització arriba al final ('mes' fals) se'n desa "
+        "el cursor perquè la compactació no esborri entrades que encara no ha llegit. L'identificador del dispositiu "
+        "és propi de l'usuari autenticat"
+    )
+)
+async def get_canvis_targetes(
+    des_de: str = Query("0"),
+    limit: int = Query(500, ge=1, le=5000),
+    dispositiu: Optional[str] = Query(None, min_length=1, max_length=48),
+    current_user: User = Depends(get_current_user)
+):
+    # Amb un sol shard '0' ja és un cursor vàlid; amb diversos, '0' equival a començar de zero a tots
+    versions = [0] * N_SHARDS if des_de == "0" else _llegir_cursor(des_de)
+
+    def llegir(shard: int):
+        with get_db_read_connection(shard) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    """
+                    SELECT versio, id_targeta, codi_targeta, estat, data_canvi
+                    FROM canvi_targeta
+                    WHERE versio > %s
+                    ORDER BY versio
+                    LIMIT %s
+                    """,
+                    (versions[shard], limit)
+                )
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    per_shard = await recollir(llegir)
+
+    canvis = []
+    for shard, rows in enumerate(per_shard):
+        if rows:
+            versions[shard] = rows[-1][0]
+        canvis.extend(
+            CanviTargetaResponse(
+                versio=row[0],
+                id_targeta=row[1],
+                codi_targeta=row[2],
+                estat=row[3],
+                data_canvi=row[4]
+            )
+            for row in rows
+        )
+
+    mes = any(len(rows) == limit for rows in per_shard)
+
+    # El cursor del dispositiu només es desa un cop per sincronització, a la darrera pàgina, i per tant sempre és
+    # la versió més recent: un dispositiu no pot frenar la compactació amb un cursor antic
+    # L'identificador es prefixa amb l'usuari perquè un usuari no pugui moure el cursor dels dispositius d'un altre
+    if dispositiu is not None and not mes:
+        id_dispositiu = f"{current_user.id}:{dispositiu}"
+        await recollir(lambda shard: desar_cursor_dispositiu(shard, id_dispositiu, versions[shard]))
+
+    return CanvisTargetaResponse(
+        canvis=canvis,
+        seguent=_cursor(versions),
+        mes=mes
+    )
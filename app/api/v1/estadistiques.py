@@ -0,0 +1,39 @@
+from fastapi import APIRouter, status, Depends
+from contextlib import ExitStack
+
+from app.schemas.estadistiques import EstadistiquesResponse
+from app.db.database import get_db_read_connection
+from app.db.sharding import N_SHARDS
+from app.core.security import User, get_current_user
+from app.core.admissio import admissio, Prioritat
+from app.core.estadistiques import estadistiques
+
+router = APIRouter(
+    prefix="/api/v1/estadistiques",
+    tags=["Estadístiques"],
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
+)
+
+## Endpoints
+# i. Estadístiques de la flota
+
+# Es retornen els agregats de memòria. Només es consulta la base de dades si la darrera sincronització és massa antiga
+@router.get(
+    "",
+    status_code=status.HTTP_200_OK,
+    response_model=EstadistiquesResponse,
+    name="Estadístiques de la flota",
+    summary="Retorna els agregats de targetes, saldo, targetes virtuals i sessions",
+    description=(
+        "Retorna el nombre de targetes per perfil i per estat, el saldo total i mitjà, les targetes virtuals actives i els passatgers amb sessió iniciada. "
+        "Els valors se serveixen des de memòria i s'actualitzen amb cada escriptura. Com a molt tenen 'max_antiguitat_segons' de retard respecte a la base de dades"
+    )
+)
+async def get_estadistiques(current_user: User = Depends(get_current_user)):
+    if estadistiques.caducades():
+        # Els agregats se sumen de tots els shards
+        with ExitStack() as pila:
+            connexions = [pila.enter_context(get_db_read_connection(shard)) for shard in range(N_SHARDS)]
+            estadistiques.sincronitzar(connexions)
+
+    return EstadistiquesResponse(**estadistiques.instantania())
@@ -0,0 +1,40 @@
+from fastapi import APIRouter, status, Depends
+
+from app.core.security import User, get_current_user
+from app.core.coalescencia import grups
+from app.core.admissio import control_admissio
+from app.core.validacions import buffer_validacions
+from app.core.cache import metriques_cache
+from app.core.bloquejades import llista_bloquejades
+
+router = APIRouter(
+    prefix="/api/v1/metriques",
+    tags=["Mètriques"]
+)
+
+## Endpoints
+# i. Mètriques internes del worker que respon la petició
+
+@router.get(
+    "",
+    status_code=status.HTTP_200_OK,
+    name="Mètriques",
+    summary="Retorna les mètriques internes del worker",
+    description=(
+        "Retorna els comptadors interns del worker que atén la petició. Per a cada grup de coalescència inclou "
+        "les execucions reals, les peticions que han compartit el resultat d'una altra i les que estan en curs. "
+        "Per al control d'admissió inclou les places lliures, les peticions en cua i les admeses i rebutjades per prioritat. "
+        "Per a l'històric de validacions inclou les pendents d'escriure, les escrites, les descartades i els lots fallits. "
+        "Per a la cache de lectura inclou les entrades, les expulsions per LRU i els encerts, errades i taxa d'encerts de cada cache. "
+        "Per a la llista de targetes bloquejades inclou els elements i la mida del filtre, el cursor del registre de canvis, "
+        "les reconstruccions completes i les actualitzacions fallides"
+    )
+)
+async def get_metriques(current_user: User = Depends(get_current_user)):
+    return {
+        "coalescencia": {nom: grup.metriques() for nom, grup in grups.items()},
+        "admissio": control_admissio.metriques(),
+        "validacions": buffer_validacions.metriques(),
+        "cache": metriques_cache(),
+        "bloquejades": llista_bloquejades.metriques(),
+    }
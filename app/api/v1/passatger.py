@@ -1,13 +1,35 @@
-from fastapi import APIRouter, HTTPException, status, Query, Depends
-from typing import List, Optional
+from fastapi import APIRouter, HTTPException, status, Query, Depends, Header, Response
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Literal, Optional
+import heapq
 import pymysql
+import re
+from datetime import datetime
 from app.schemas.passatger import (
     PassatgerCreate,
     PassatgerUpdate,
     PassatgerResponse,
+    PassatgerCercaResponse,
+)
+from app.schemas.cartera import CarteraResponse, TargetaCarteraResponse
+from app.schemas.targeta_virtual import TargetaVirtualResponse
+from app.db.database import get_db_connection, get_db_read_connection
+from app.db.sharding import (
+    N_SHARDS,
+    shard_de_id,
+    shard_nou,
+    recollir,
+    shards_document,
+    shard_codi_targeta,
+    registrar_document,
+    esborrar_document,
 )
-from app.db.database import get_db_connection
 from app.core.security import User, get_current_user
+from app.core.admissio import admissio, Prioritat
+from app.core.http_cache import calcular_etag, etag_coincideix
+from app.core.estadistiques import estadistiques
+from app.core.qr import recuperar_token_qr
+from app.core.cache import cache_lectura
 
 # Definim router
 
@@ -18,6 +40,34 @@
     tags=["Passatgers"]
 )
 
+# Elements que es poden incloure a la cartera d'un passatger amb el paràmetre 'expand'
+EXPAND_CARTERA = {"targetes", "targeta_virtual"}
+
+cache_passatgers = cache_lectura("passatger")
+
+## Helpers
+# Escapa els comodins de LIKE per a poder fer cerques per prefix amb el valor literal
+def _escapar_like(valor: str) -> str:
+    return valor.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# Converteix un text lliure en una consulta FULLTEXT en mode booleà (totes les paraules, per prefix)
+def _consulta_fulltext(text: str) -> str:
+    paraules = re.findall(r"\w+", text)
+    return " ".join(f"+{p}*" for p in paraules)
+
+# Llegeix un passatger per ID (None si no existeix)
+def _carregar_passatger(passatger_id: int):
+    with get_db_read_connection(shard_de_id(passatger_id)) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT * FROM passatger WHERE id = %s",
+                (passatger_id,)
+            )
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
 
 # Si la petició és POST, es crea un passatger
 @router.post(
@@ -26,13 +76,15 @@
     response_model=PassatgerResponse,
     name="Crear passatger",
     summary="Crea un nou passatger",
-    description="Registra un nou passatger a la base de dades amb les dades associades: nom, llinatges, document, e-mail i estat de sessió"
+    description="Registra un nou passatger a la base de dades amb les dades associades: nom, llinatges, document, e-mail i estat de sessió",
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
 )
 async def create_passatger(
     passatger: PassatgerCreate,
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    # Els passatgers nous es reparteixen entre els shards. Les seves targetes aniran al mateix shard
+    with get_db_connection(shard_nou()) as conn:
         cursor = conn.cursor()
         try:
             query = """
@@ -51,6 +103,7 @@ async def create_passatger(
             conn.commit()
 
             passatger_id = cursor.lastrowid
+            registrar_document(passatger.document, passatger_id)
             cursor.execute(
                 "SELECT * FROM passatger WHERE id = %s",
                 (passatger_id,)
@@ -62,6 +115,8 @@ async def create_passatger(
                     status_code=500,
                     detail="Error al recuperar el passatger creat"
                 )
+            estadistiques.sessio_modificada(False, row[6])
+            await run_in_threadpool(cache_passatgers.actualitzar, passatger_id, row)
 
             return PassatgerResponse(
                 id=row[0],
@@ -86,45 +141,171 @@ async def create_passatger(
     response_model=List[PassatgerResponse],
     name="Llistar passatgers",
     summary="Retorna tots els passatgers",
-    description="Retorna un .json amb totes les dades dels passatgers registrats a la base de dades en aquell moment"
+    description="Retorna un .json amb totes les dades dels passatgers registrats a la base de dades en aquell moment",
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
 )
 async def get_passatgers(
     skip: int = Query(0, ge=0),
     limit: int = Query(None, ge=1),
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        try:
-            if limit is None:
-                cursor.execute(
-                    "SELECT * FROM passatger ORDER BY id "
-                    "LIMIT 18446744073709551615 OFFSET %s",
-                    (skip,)
-                )
-            else:
+    # Amb un sol shard, el skip el fa la mateixa consulta amb OFFSET
+    # Amb diversos shards, cada shard retorna els seus primers skip + limit passatgers per ID, s'ajunten en ordre d'ID
+    # i es descarten els skip primers
+    offset = skip if N_SHARDS == 1 else 0
+
+    def llistar(shard: int):
+        with get_db_read_connection(shard) as conn:
+            cursor = conn.cursor()
+            try:
+                if limit is None:
+                    cursor.execute(
+                        "SELECT * FROM passatger ORDER BY id LIMIT 18446744073709551615 OFFSET %s",
+                        (offset,)
+                    )
+                else:
+                    cursor.execute(
+                        "SELECT * FROM passatger ORDER BY id LIMIT %s OFFSET %s",
+                        (skip - offset + limit, offset)
+                    )
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    rows = list(heapq.merge(*await recollir(llistar), key=lambda row: row[0]))
+    saltar = skip - offset
+    rows = rows[saltar:] if limit is None else rows[saltar:saltar + limit]
+
+    passatgers = []
+    for row in rows:
+        passatgers.append(PassatgerResponse(
+            id=row[0],
+            nom=row[1],
+            llinatge_1=row[2],
+            llinatge_2=row[3],
+            document=row[4],
+            email=row[5],
+            sessio_iniciada=bool(row[6])
+        ))
+
+    return passatgers
+
+# Si la petició és GET a /cerca, es cerquen passatgers per document, email, llinatges, nom o codi de targeta
+# S'ha de declarar abans de "/{passatger_id}" per a que FastAPI no intenti interpretar "cerca" com a ID
+@router.get(
+    "/cerca",
+    response_model=PassatgerCercaResponse,
+    name="Cercar passatgers",
+    summary="Cerca passatgers amb filtres i paginació per cursor",
+    description=(
+        "Cerca passatgers per document, email, llinatge_1, llinatge_2 i codi de targeta, de forma exacta o per prefix segons el paràmetre 'mode'. "
+        "El paràmetre 'text' fa una cerca de text complet sobre nom i llinatges. "
+        "Els resultats s'ordenen per ID i es paginen amb 'despres_de' (l'ID 'seguent' de la pàgina anterior)"
+    ),
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
+)
+async def cercar_passatgers(
+    document: Optional[str] = Query(None, min_length=1),
+    email: Optional[str] = Query(None, min_length=1),
+    llinatge_1: Optional[str] = Query(None, min_length=1),
+    llinatge_2: Optional[str] = Query(None, min_length=1),
+    codi_targeta: Optional[str] = Query(None, min_length=1),
+    text: Optional[str] = Query(None, min_length=1),
+    mode: Literal["exacte", "prefix"] = Query("exacte"),
+    despres_de: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=500),
+    current_user: User = Depends(get_current_user)
+):
+    condicions = ["p.id > %s"]
+    values = [despres_de]
+
+    # Cada filtre empra el seu índex: igualtat en mode exacte, LIKE 'valor%' (rang sobre l'índex) en mode prefix
+    for columna, valor in (
+        ("p.document", document),
+        ("p.email", email),
+        ("p.llinatge_1", llinatge_1),
+        ("p.llinatge_2", llinatge_2),
+    ):
+        if valor is None:
+            continue
+        if mode == "prefix":
+            condicions.append(f"{columna} LIKE %s")
+            values.append(_escapar_like(valor) + "%")
+        else:
+            condicions.append(f"{columna} = %s")
+            values.append(valor)
+
+    if codi_targeta is not None:
+        if mode == "prefix":
+            condicions.append(
+                "EXISTS (SELECT 1 FROM targeta t WHERE t.id_passatger = p.id AND t.codi_targeta LIKE %s)"
+            )
+            values.append(_escapar_like(codi_targeta) + "%")
+        else:
+            condicions.append(
+                "EXISTS (SELECT 1 FROM targeta t WHERE t.id_passatger = p.id AND t.codi_targeta = %s)"
+            )
+            values.append(codi_targeta)
+
+    if text is not None:
+        consulta = _consulta_fulltext(text)
+        if not consulta:
+            raise HTTPException(
+                status_code=400,
+                detail="El text de cerca ha de contenir com a mínim una paraula"
+            )
+        condicions.append("MATCH (p.nom, p.llinatge_1, p.llinatge_2) AGAINST (%s IN BOOLEAN MODE)")
+        values.append(consulta)
+
+    if len(condicions) == 1:
+        raise HTTPException(
+            status_code=400,
+            detail="Cal indicar com a mínim un filtre de cerca"
+        )
+
+    values.append(limit)
+
+    # Si es cerca per document o codi de targeta exactes, el directori indica els shards on pot ser el passatger.
+    # Si no, la cerca es fa a tots els shards i s'ajunten els resultats en ordre d'ID
+    shards = None
+    if mode == "exacte" and document is not None:
+        shards = shards_document(document)
+    elif mode == "exacte" and codi_targeta is not None:
+        shard = shard_codi_targeta(codi_targeta)
+        shards = [] if shard is None else [shard]
+
+    def cercar(shard: int):
+        with get_db_read_connection(shard) as conn:
+            cursor = conn.cursor()
+            try:
                 cursor.execute(
-                    "SELECT * FROM passatger ORDER BY id "
-                    "LIMIT %s OFFSET %s",
-                    (limit, skip)
+                    "SELECT p.id, p.nom, p.llinatge_1, p.llinatge_2, p.document, p.email, p.sessio_iniciada "
+                    f"FROM passatger p WHERE {' AND '.join(condicions)} "
+                    "ORDER BY p.id LIMIT %s",
+                    tuple(values)
                 )
-            rows = cursor.fetchall()
+                return cursor.fetchall()
+            finally:
+                cursor.close()
 
-            passatgers = []
-            for row in rows:
-                passatgers.append(PassatgerResponse(
-                    id=row[0],
-                    nom=row[1],
-                    llinatge_1=row[2],
-                    llinatge_2=row[3],
-                    document=row[4],
-                    email=row[5],
-                    sessio_iniciada=bool(row[6])
-                ))
-
-            return passatgers
-        finally:
-            cursor.close()
+    rows = list(heapq.merge(*await recollir(cercar, shards), key=lambda row: row[0]))[:limit]
+
+    resultats = [
+        PassatgerResponse(
+            id=row[0],
+            nom=row[1],
+            llinatge_1=row[2],
+            llinatge_2=row[3],
+            document=row[4],
+            email=row[5],
+            sessio_iniciada=bool(row[6])
+        )
+        for row in rows
+    ]
+
+    # Si la pàgina és plena, l'últim ID serveix de cursor per a la pàgina següent
+    seguent = resultats[-1].id if len(resultats) == limit else None
+    return PassatgerCercaResponse(resultats=resultats, seguent=seguent)
 
 # ii. Passatger específic (filtra per ID)
 # Si la petició és un GET, llista tots els detalls del passatger específic
@@ -133,64 +314,185 @@ async def get_passatgers(
     response_model=PassatgerResponse,
     name="Llistar passatger concret",
     summary="Llistar passatger concret per ID",
-    description="Retorna tota la informació emmagatzemada sobre un passatger especific, filtrant-lo per ID"
+    description="Retorna tota la informació emmagatzemada sobre un passatger especific, filtrant-lo per ID. Inclou un ETag i retorna 304 Not Modified si coincideix amb la capçalera If-None-Match",
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
 )
 async def get_passatger(
     passatger_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    row = await cache_passatgers.obtenir(
+        passatger_id, lambda: run_in_threadpool(_carregar_passatger, passatger_id)
+    )
+
+    if not row:
+        raise HTTPException(
+            status_code=404,
+            detail="Passatger no trobat"
+        )
+
+    # Si el client ja té la mateixa versió del passatger, no cal tornar-la a enviar
+    etag = calcular_etag(*row)
+    if etag_coincideix(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    return PassatgerResponse(
+        id=row[0],
+        nom=row[1],
+        llinatge_1=row[2],
+        llinatge_2=row[3],
+        document=row[4],
+        email=row[5],
+        sessio_iniciada=bool(row[6])
+    )
+
+# iii. Cartera del passatger (passatger, targetes i targetes virtuals vigents en una sola petició)
+# Si la petició és un GET, es retorna tot el que necessita la pantalla inicial de l'aplicació amb una única consulta
+@router.get(
+    "/{passatger_id}/cartera",
+    response_model=CarteraResponse,
+    response_model_exclude_unset=True,
+    name="Cartera del passatger",
+    summary="Retorna el passatger amb les seves targetes i targetes virtuals vigents",
+    description=(
+        "Retorna les dades del passatger, totes les seves targetes i, per a cada targeta, la targeta virtual no caducada (si n'hi ha) amb una sola consulta. "
+        "El paràmetre 'expand' és una llista separada per comes que indica què s'inclou: 'targetes' i/o 'targeta_virtual' (per defecte, tots dos)"
+    ),
+    dependencies=[Depends(admissio(Prioritat.app))]
+)
+async def get_cartera(
+    passatger_id: int,
+    expand: str = Query("targetes,targeta_virtual"),
+    current_user: User = Depends(get_current_user)
+):
+    elements = {e.strip() for e in expand.split(",") if e.strip()}
+    if not elements <= EXPAND_CARTERA:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Valors d'expand no vàlids: {', '.join(sorted(elements - EXPAND_CARTERA))}"
+        )
+    amb_targetes = "targetes" in elements or "targeta_virtual" in elements
+    amb_virtuals = "targeta_virtual" in elements
+
+    # Les targetes virtuals s'acaben de generar just abans de consultar la cartera, per això es llegeix de la primària
+    with get_db_connection(shard_de_id(passatger_id)) as conn:
         cursor = conn.cursor()
         try:
-            cursor.execute(
-                "SELECT * FROM passatger WHERE id = %s",
-                (passatger_id,)
-            )
-            row = cursor.fetchone()
-
-            if not row:
-                raise HTTPException(
-                    status_code=404,
-                    detail="Passatger no trobat"
+            if amb_virtuals:
+                cursor.execute(
+                    """
+                    SELECT p.id, p.nom, p.llinatge_1, p.llinatge_2, p.document, p.email, p.sessio_iniciada,
+                           t.id, t.codi_targeta, t.perfil, t.saldo, t.estat,
+                           tv.id, tv.qr, tv.qr_sal, tv.data_creacio, tv.data_expiracio
+                    FROM passatger p
+                    LEFT JOIN targeta         t  ON t.id_passatger = p.id
+                    LEFT JOIN targeta_virtual tv ON tv.id_targeta_mare = t.id AND tv.data_expiracio > %s
+                    WHERE p.id = %s
+                    ORDER BY t.id, tv.data_expiracio DESC
+                    """,
+                    (datetime.utcnow(), passatger_id)
                 )
-
-            return PassatgerResponse(
-                id=row[0],
-                nom=row[1],
-                llinatge_1=row[2],
-                llinatge_2=row[3],
-                document=row[4],
-                email=row[5],
-                sessio_iniciada=bool(row[6])
-            )
+            elif amb_targetes:
+                cursor.execute(
+                    """
+                    SELECT p.id, p.nom, p.llinatge_1, p.llinatge_2, p.document, p.email, p.sessio_iniciada,
+                           t.id, t.codi_targeta, t.perfil, t.saldo, t.estat
+                    FROM passatger p
+                    LEFT JOIN targeta t ON t.id_passatger = p.id
+                    WHERE p.id = %s
+                    ORDER BY t.id
+                    """,
+                    (passatger_id,)
+                )
+            else:
+                cursor.execute(
+                    "SELECT * FROM passatger WHERE id = %s",
+                    (passatger_id,)
+                )
+            rows = cursor.fetchall()
         finally:
             cursor.close()
 
+    if not rows:
+        raise HTTPException(
+            status_code=404,
+            detail="Passatger no trobat"
+        )
+
+    row = rows[0]
+    cartera = CarteraResponse(
+        passatger=PassatgerResponse(
+            id=row[0],
+            nom=row[1],
+            llinatge_1=row[2],
+            llinatge_2=row[3],
+            document=row[4],
+            email=row[5],
+            sessio_iniciada=bool(row[6])
+        )
+    )
+    if not amb_targetes:
+        return cartera
+
+    # Cada fila és una combinació targeta / targeta virtual. Es queda la primera (la més recent) de cada targeta
+    # Només s'assignen els camps demanats a 'expand': la resposta omet els que no s'han assignat, però manté els nuls
+    targetes: dict[int, TargetaCarteraResponse] = {}
+    for row in rows:
+        if row[7] is None or row[7] in targetes:
+            continue
+        targeta = TargetaCarteraResponse(
+            id=row[7],
+            id_passatger=row[0],
+            codi_targeta=row[8],
+            perfil=row[9],
+            saldo=row[10],
+            estat=row[11]
+        )
+        if amb_virtuals:
+            targeta.targeta_virtual = None
+            if row[12] is not None:
+                targeta.targeta_virtual = TargetaVirtualResponse(
+                    id=row[12],
+                    id_targeta_mare=row[7],
+                    qr=recuperar_token_qr(row[13], row[14], shard_de_id(row[12])),
+                    data_creacio=row[15],
+                    data_expiracio=row[16]
+                )
+        targetes[row[7]] = targeta
+    cartera.targetes = list(targetes.values())
+    return cartera
+
 # Si la petició és un PUT, permet modificar els detalls del passatger
 @router.put(
     "/{passatger_id}",
     response_model=PassatgerResponse,
     name="Modificar dades d'un passatger",
     summary="Modificar dades d'un passatger concret",
-    description="Modifica un o més camps d'un passatger concret ja existent a traves del seu ID"
+    description="Modifica un o més camps d'un passatger concret ja existent a traves del seu ID",
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
 )
 async def update_passatger(
     passatger_id: int,
     passatger: PassatgerUpdate,
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    with get_db_connection(shard_de_id(passatger_id)) as conn:
         cursor = conn.cursor()
         try:
             cursor.execute(
-                "SELECT id FROM passatger WHERE id = %s",
+                "SELECT id, sessio_iniciada, document FROM passatger WHERE id = %s",
                 (passatger_id,)
             )
-            if not cursor.fetchone():
+            row = cursor.fetchone()
+            if not row:
                 raise HTTPException(
                     status_code=404,
                     detail="Passatger no trobat"
                 )
+            sessio_anterior, document_anterior = row[1], row[2]
 
             updates = []
             values = []
@@ -235,6 +537,11 @@ async def update_passatger(
                 (passatger_id,)
             )
             row = cursor.fetchone()
+            estadistiques.sessio_modificada(sessio_anterior, row[6])
+            await run_in_threadpool(cache_passatgers.actualitzar, passatger_id, row)
+            if row[4] != document_anterior:
+                esborrar_document(document_anterior, passatger_id)
+                registrar_document(row[4], passatger_id)
 
             return PassatgerResponse(
                 id=row[0],
@@ -254,30 +561,36 @@ async def update_passatger(
     status_code=status.HTTP_204_NO_CONTENT,
     name="Eliminar passatger",
     summary="Eliminar passatger concret",
-    description="Elimina un passatger de la base de dades. No es pot eliminar si té targetes associades"
+    description="Elimina un passatger de la base de dades. No es pot eliminar si té targetes associades",
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
 )
 async def delete_passatger(
     passatger_id: int,
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    with get_db_connection(shard_de_id(passatger_id)) as conn:
         cursor = conn.cursor()
         try:
             cursor.execute(
-                "SELECT id FROM passatger WHERE id = %s",
+                "SELECT id, sessio_iniciada, document FROM passatger WHERE id = %s",
                 (passatger_id,)
             )
-            if not cursor.fetchone():
+            row = cursor.fetchone()
+            if not row:
                 raise HTTPException(
                     status_code=404,
                     detail="Passatger no trobat"
                 )
+            sessio_anterior, document = row[1], row[2]
 
             cursor.execute(
                 "DELETE FROM passatger WHERE id = %s",
                 (passatger_id,)
             )
             conn.commit()
+            estadistiques.sessio_modificada(sessio_anterior, False)
+            await run_in_threadpool(cache_passatgers.invalidar, passatger_id)
+            esborrar_document(document, passatger_id)
 
             return None
         except pymysql.IntegrityError:
@@ -1,10 +1,19 @@
-from fastapi import APIRouter, HTTPException, status, Query, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, status, Query, Depends, Header, Response
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Optional
+import heapq
 import pymysql
 import random
 from app.schemas.targeta import TargetaCreate, TargetaResponse, TargetaUpdate
-from app.db.database import get_db_connection
+from app.db.database import get_db_connection, get_db_read_connection
+from app.db.sharding import N_SHARDS, shard_de_id, recollir, reservar_codi_targeta, assignar_codi_targeta
 from app.core.security import User, get_current_user
+from app.core.admissio import admissio, Prioritat
+from app.core.http_cache import calcular_etag, etag_coincideix
+from app.core.estadistiques import estadistiques
+from app.core.coalescencia import grup_coalescencia
+from app.core.cache import cache_lectura
+from app.core.canvis_targeta import registrar_canvi
 
 # Definim router
 
@@ -12,7 +21,8 @@
 # i. Targetes (general)
 router = APIRouter(
     prefix="/api/v1/targetes",
-    tags=["Targetes"]
+    tags=["Targetes"],
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
 )
 
 # Definim diccionari amb prefixes de targetes
@@ -26,8 +36,12 @@
 
 MAX_INTENTS_CODI = 10
 
+coalescencia_targeta = grup_coalescencia("targeta")
+cache_targetes = cache_lectura("targeta")
+
 ## Helpers
 # Genera un codi de targeta únic entre 000001 - 999999
+# Amb diversos shards, el codi també es reserva al directori per a que sigui únic entre tots
 def _generar_codi_targeta(perfil: str, cursor) -> str:
     prefix = PERFIL_PREFIX[perfil]
     for _ in range(MAX_INTENTS_CODI):
@@ -37,13 +51,26 @@ def _generar_codi_targeta(perfil: str, cursor) -> str:
             "SELECT id FROM targeta WHERE codi_targeta = %s",
             (codi,)
         )
-        if not cursor.fetchone():
+        if not cursor.fetchone() and reservar_codi_targeta(codi):
             return codi
     raise HTTPException(
         status_code=500,
         detail="No s'ha pogut generar un codi de targeta únic. Torna-ho a intentar"
     )
 
+# Llegeix una targeta per ID (None si no existeix)
+def _carregar_targeta(targeta_id: int):
+    with get_db_read_connection(shard_de_id(targeta_id)) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT * FROM targeta WHERE id = %s",
+                (targeta_id,)
+            )
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
 # Si la petició que feim és un POST, cream una targeta nova
 @router.post(
     "",
@@ -59,7 +86,9 @@ async def create_targeta(
     targeta: TargetaCreate,
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    # La targeta es crea al shard del seu passatger
+    codi_targeta = None
+    with get_db_connection(shard_de_id(targeta.id_passatger)) as conn:
         cursor = conn.cursor()
         try:
             codi_targeta = _generar_codi_targeta(targeta.perfil, cursor)
@@ -76,14 +105,18 @@ async def create_targeta(
                 targeta.saldo,
                 targeta.estat
             ))
+            targeta_id = cursor.lastrowid
+            registrar_canvi(cursor, targeta_id)
             conn.commit()
 
-            targeta_id = cursor.lastrowid
+            assignar_codi_targeta(codi_targeta, targeta_id)
             cursor.execute(
                 "SELECT * FROM targeta WHERE id = %s",
                 (targeta_id,)
             )
             row = cursor.fetchone()
+            estadistiques.targeta_creada(row[3], row[5], row[4])
+            await run_in_threadpool(cache_targetes.actualitzar, targeta_id, row)
 
             return TargetaResponse(
                 id=row[0],
@@ -94,6 +127,9 @@ async def create_targeta(
                 estat=row[5]
             )
         except pymysql.IntegrityError as e:
+            # Si no s'ha pogut crear la targeta, s'allibera el codi reservat al directori
+            if codi_targeta is not None:
+                assignar_codi_targeta(codi_targeta, None)
             raise HTTPException(
                 status_code=400,
                 detail=f"Error d'integritat: {str(e)}"
@@ -114,37 +150,45 @@ async def get_targetes(
     limit: int = Query(None, ge=1),
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        try:
-            if limit is None:
-                cursor.execute(
-                    "SELECT * FROM targeta ORDER BY id "
-                    "LIMIT 18446744073709551615 OFFSET %s",
-                    (skip,)
-                )
-            else:
-                cursor.execute(
-                    "SELECT * FROM targeta ORDER BY id "
-                    "LIMIT %s OFFSET %s",
-                    (limit, skip)
-                )
-            rows = cursor.fetchall()
+    # Amb un sol shard, el skip el fa la mateixa consulta amb OFFSET
+    # Amb diversos shards, cada shard retorna les seves primeres skip + limit targetes per ID, s'ajunten en ordre d'ID
+    # i es descarten els skip primers
+    offset = skip if N_SHARDS == 1 else 0
 
-            targetes = []
-            for row in rows:
-                targetes.append(TargetaResponse(
-                    id=row[0],
-                    id_passatger=row[1],
-                    codi_targeta=row[2],
-                    perfil=row[3],
-                    saldo=row[4],
-                    estat=row[5]
-                ))
+    def llistar(shard: int):
+        with get_db_read_connection(shard) as conn:
+            cursor = conn.cursor()
+            try:
+                if limit is None:
+                    cursor.execute(
+                        "SELECT * FROM targeta ORDER BY id LIMIT 18446744073709551615 OFFSET %s",
+                        (offset,)
+                    )
+                else:
+                    cursor.execute(
+                        "SELECT * FROM targeta ORDER BY id LIMIT %s OFFSET %s",
+                        (skip - offset + limit, offset)
+                    )
+                return cursor.fetchall()
+            finally:
+                cursor.close()
 
-            return targetes
-        finally:
-            cursor.close()
+    rows = list(heapq.merge(*await recollir(llistar), key=lambda row: row[0]))
+    saltar = skip - offset
+    rows = rows[saltar:] if limit is None else rows[saltar:saltar + limit]
+
+    targetes = []
+    for row in rows:
+        targetes.append(TargetaResponse(
+            id=row[0],
+            id_passatger=row[1],
+            codi_targeta=row[2],
+            perfil=row[3],
+            saldo=row[4],
+            estat=row[5]
+        ))
+
+    return targetes
 
 # ii. Targeta específica (filtrada per ID)
 # Si la petició que feim és un GET, obtenim tots els detalls d'una targeta específica
@@ -153,37 +197,42 @@ async def get_targetes(
     response_model=TargetaResponse,
     name="Llistar targeta concreta",
     summary="Llistar targeta concreta per ID",
-    description="Retorna informacio detallada sobre una targeta especifica, filtrant-la per ID"
+    description="Retorna informacio detallada sobre una targeta especifica, filtrant-la per ID. Inclou un ETag i retorna 304 Not Modified si coincideix amb la capçalera If-None-Match"
 )
 async def get_targeta(
     targeta_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute(
-                "SELECT * FROM targeta WHERE id = %s",
-                (targeta_id,)
-            )
-            row = cursor.fetchone()
+    # Primer es mira la cache. Si no hi és, les peticions simultànies per a la mateixa targeta comparteixen una sola consulta
+    row = await cache_targetes.obtenir(
+        targeta_id,
+        lambda: coalescencia_targeta.fer(
+            targeta_id, lambda: run_in_threadpool(_carregar_targeta, targeta_id)
+        )
+    )
 
-            if not row:
-                raise HTTPException(
-                    status_code=404,
-                    detail="Targeta no trobada"
-                )
+    if not row:
+        raise HTTPException(
+            status_code=404,
+            detail="Targeta no trobada"
+        )
 
-            return TargetaResponse(
-                id=row[0],
-                id_passatger=row[1],
-                codi_targeta=row[2],
-                perfil=row[3],
-                saldo=row[4],
-                estat=row[5]
-            )
-        finally:
-            cursor.close()
+    # Si el client ja té la mateixa versió de la targeta, no cal tornar-la a enviar
+    etag = calcular_etag(*row)
+    if etag_coincideix(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    return TargetaResponse(
+        id=row[0],
+        id_passatger=row[1],
+        codi_targeta=row[2],
+        perfil=row[3],
+        saldo=row[4],
+        estat=row[5]
+    )
 
 # En canvi, si la petició que feim és un PUT, podem modificar una targeta ja existent
 @router.put(
@@ -199,11 +248,11 @@ async def update_targeta(
     body: TargetaUpdate,
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    with get_db_connection(shard_de_id(targeta_id)) as conn:
         cursor = conn.cursor()
         try:
             cursor.execute(
-                "SELECT id, estat FROM targeta WHERE id = %s",
+                "SELECT id, estat, saldo FROM targeta WHERE id = %s",
                 (targeta_id,)
             )
             row = cursor.fetchone()
@@ -214,7 +263,7 @@ async def update_targeta(
                     detail="Targeta no trobada"
                 )
 
-            estat_actual = row[1]
+            estat_actual, saldo_actual = row[1], row[2]
             ESTATS_BLOQUEJATS = {"Caducada", "Robada"}
 
             # Si la targeta ja està bloquetjada, impedeix la modificació
@@ -259,6 +308,9 @@ async def update_targeta(
                 f"WHERE id = %s"
             )
             cursor.execute(query, tuple(values))
+            # Els canvis d'estat queden al registre que sincronitzen les validadores
+            if body.estat is not None and body.estat != estat_actual:
+                registrar_canvi(cursor, targeta_id)
             conn.commit()
 
             cursor.execute(
@@ -266,6 +318,8 @@ async def update_targeta(
                 (targeta_id,)
             )
             row = cursor.fetchone()
+            estadistiques.targeta_modificada(estat_actual, row[5], saldo_actual, row[4])
+            await run_in_threadpool(cache_targetes.actualitzar, targeta_id, row)
 
             return TargetaResponse(
                 id=row[0],
@@ -293,7 +347,7 @@ async def get_targetes_passatger(
     limit: int = Query(100, ge=1, le=500),
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    with get_db_read_connection(shard_de_id(passatger_id)) as conn:
         cursor = conn.cursor()
         try:
             cursor.execute(
@@ -1,22 +1,44 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from fastapi.responses import Response
+from fastapi import APIRouter, HTTPException, status, Depends, Header, Query, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from datetime import datetime, timedelta
+from typing import Literal, Optional
+import asyncio
+import base64
+import json
+import logging
+import math
 import pymysql
-import secrets
-import hashlib
-import io
-
-import qrcode
-from qrcode.image.pil import PilImage
-from PIL import Image
 
 from app.schemas.targeta_virtual import (
     TargetaVirtualResponse,
+    TargetaVirtualAmbImatgeResponse,
     VerifyQRRequest,
     VerifyQRResponse,
+    SecretQRResponse,
 )
 from app.db.database import get_db_connection
+from app.db.sharding import shard_de_id
 from app.core.security import User, get_current_user
+from app.core.http_cache import calcular_etag, etag_coincideix, format_data_http
+from app.core.estadistiques import estadistiques
+from app.core.rotacio_qr import RodaRotacio
+from app.core.qr import generar_token_qr, recuperar_token_qr, digest_token_qr, shard_token_qr, renderitzar_qr
+from app.core.qr_dispositiu import (
+    QR_DISPOSITIU_PERIODE_SEGONS,
+    QR_DISPOSITIU_DIGITS,
+    es_token_dispositiu,
+    llegir_token,
+    derivar_secret,
+    secret_base32,
+    generar_sal,
+    pas_del_codi,
+)
+from app.core.coalescencia import grup_coalescencia
+from app.core.admissio import admissio, control_admissio, Prioritat
+from app.core.validacions import Validacio, buffer_validacions
+from app.core.tarifes import motor_tarifes
+from app.core.cache import cache_lectura
 
 router = APIRouter(
     prefix="/api/v1/targetes-virtuals",
@@ -24,48 +46,50 @@
 )
 
 QR_VALIDESA_SEGONS = 60
-QR_HASH_LENGTH     = 255
+QR_ANTELACIO_SEGONS = 5
+SSE_KEEPALIVE_SEGONS = 15
+WS_TIMEOUT_AUTENTICACIO_SEGONS = 10
+WS_MAX_VERIFICACIONS_CONCURRENTS = 32
 
-## Helpers
-# Genera hash que servirà després per a crear el codi QR
-def _generar_hash_qr() -> str:
-    token = secrets.token_hex(128)
-    salt = hashlib.sha256(token.encode()).hexdigest()
-    combinat = token + salt
-    return combinat[:QR_HASH_LENGTH]
+logger = logging.getLogger(__name__)
+
+coalescencia_qr = grup_coalescencia("qr")
+coalescencia_render_qr = grup_coalescencia("render_qr")
+cache_targetes = cache_lectura("targeta")
 
+## Helpers
 # Estructura la resposta que es reb al cridar a una targeta virtual
+# Espera les columnes (id, id_targeta_mare, qr, qr_sal, data_creacio, data_expiracio)
 def _row_to_response(row) -> TargetaVirtualResponse:
     return TargetaVirtualResponse(
         id=row[0],
         id_targeta_mare=row[1],
-        qr=row[2],
-        data_creacio=row[3],
-        data_expiracio=row[4]
+        qr=recuperar_token_qr(row[2], row[3], shard_de_id(row[0])),
+        data_creacio=row[4],
+        data_expiracio=row[5]
     )
 
+# Llegeix el token i l'expiració d'una targeta virtual (None si no existeix)
+# Es llegeix de la primària perquè la targeta virtual s'acaba de generar just abans de demanar el QR
+def _carregar_qr(targeta_virtual_id: int):
+    with get_db_connection(shard_de_id(targeta_virtual_id)) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT qr, qr_sal, data_expiracio FROM targeta_virtual WHERE id = %s",
+                (targeta_virtual_id,)
+            )
+            return cursor.fetchone()
+        finally:
+            cursor.close()
 
-## Endpoints
-# i. Targetes virtuals (general)
-
-# Si la petició és un POST, generam una nova targeta virtual
-@router.post(
-    "",
-    status_code=status.HTTP_201_CREATED,
-    response_model=TargetaVirtualResponse,
-    name="Crear targeta virtual",
-    summary="Genera una targeta virtual amb QR",
-    description=(
-        "Crea una targeta virtual associada a una targeta física. "
-        "Genera un hash únic de X caràcters que s'emmagatzema al camp 'qr' i és vàlid durant Y segons. Només es pot crear una targeta virtual per a targetes en estat 'Activa'"
-    )
-)
+# Genera una nova targeta virtual per a una targeta mare, invalidant les anteriors
+# La fan servir tant l'endpoint de creació com la rotació automàtica de QR
 # A l'hora de generar una targeta virtual es segueixen un parell de passes:
-async def create_targeta_virtual(
-    id_targeta_mare: int,
-    current_user: User = Depends(get_current_user)
-):
-    with get_db_connection() as conn:
+def _generar_targeta_virtual(id_targeta_mare: int) -> TargetaVirtualResponse:
+    # La targeta virtual es crea al shard de la seva targeta mare
+    shard = shard_de_id(id_targeta_mare)
+    with get_db_connection(shard) as conn:
         cursor = conn.cursor()
         try:
             # 1. Es comprova que la targeta de la que depèn existeix i està activa
@@ -91,25 +115,34 @@ async def create_targeta_virtual(
                 (id_targeta_mare,)
             )
 
-            # 3. Es genera el hash del QR i es defineix la validesa del codi
-            qr_hash = _generar_hash_qr()
+            # 3. Es genera el token del QR i es defineix la validesa del codi
+            qr_hash, qr_sal = generar_token_qr(shard)
             ara = datetime.utcnow()
             data_expiracio = ara + timedelta(seconds=QR_VALIDESA_SEGONS)
 
-            # 4. Es crea la targeta virtual a la base de dades
+            # 4. Es crea la targeta virtual a la base de dades. Del token només es desa el digest (i la sal per a derivar-lo)
             cursor.execute(
                 """
                 INSERT INTO targeta_virtual
-                    (id_targeta_mare, qr, data_creacio, data_expiracio)
-                VALUES (%s, %s, %s, %s)
+                    (id_targeta_mare, qr, qr_digest, qr_sal, data_creacio, data_expiracio)
+                VALUES (%s, %s, %s, %s, %s, %s)
                 """,
-                (id_targeta_mare, qr_hash, ara, data_expiracio)
+                (
+                    id_targeta_mare,
+                    qr_hash if qr_sal is None else None,
+                    digest_token_qr(qr_hash),
+                    qr_sal,
+                    ara,
+                    data_expiracio,
+                )
             )
             conn.commit()
+            estadistiques.targeta_virtual_creada(id_targeta_mare, data_expiracio)
 
             targeta_virtual_id = cursor.lastrowid
             cursor.execute(
-                "SELECT * FROM targeta_virtual WHERE id = %s",
+                "SELECT id, id_targeta_mare, qr, qr_sal, data_creacio, data_expiracio "
+                "FROM targeta_virtual WHERE id = %s",
                 (targeta_virtual_id,)
             )
             return _row_to_response(cursor.fetchone())
@@ -124,178 +157,240 @@ async def create_targeta_virtual(
         finally:
             cursor.close()
 
-# ii. Targeta virtual concreta (QR)
 
-# Feim una petició GET per a obtenir el codi QR d'una targeta
-@router.get(
-    "/{targeta_virtual_id}/qr",
-    status_code=status.HTTP_200_OK,
-    response_class=Response,
-    responses={
-        200: {
-            "content": {"image/jpeg": {}},
-            "description": "Imatge QR en format JPEG"
-        }
-    },
-    name="Obtenir QR",
-    summary="Retorna la imatge QR d'una targeta virtual",
-    description=(
-        "Genera i retorna la imatge QR associada al hash d'una targeta virtual en format JPEG. Retorna 410 Gone si el QR ha caducat"
+# Cobra el viatge d'un QR que ja s'ha reclamat dins la transacció oberta a 'conn' i confirma la transacció
+# Si la targeta no està activa o no té saldo, es desfà tota la transacció (també la reclamació) i el QR no es consumeix
+def _cobrar_viatge(conn, cursor, id_targeta_mare: int, id_usuari: Optional[int]) -> VerifyQRResponse:
+    # 1. Es llegeixen la targeta mare i el passatger dins la mateixa transacció
+    # FOR UPDATE bloqueja la targeta fins al commit, així el saldo llegit és el que es cobrarà
+    cursor.execute(
+        """
+        SELECT t.codi_targeta, t.perfil, t.saldo, t.estat,
+               p.id, p.nom, p.llinatge_1, p.llinatge_2, p.document, p.email
+        FROM targeta t
+        INNER JOIN passatger p ON p.id = t.id_passatger
+        WHERE t.id = %s
+        FOR UPDATE
+        """,
+        (id_targeta_mare,)
     )
-)
-async def get_qr(
-    targeta_virtual_id: int,
-    current_user: User = Depends(get_current_user)
-):
-    with get_db_connection() as conn:
+    (codi_targeta, perfil, saldo, estat,
+     passatger_id, nom, llinatge_1, llinatge_2,
+     document, email) = cursor.fetchone()
+
+    # 2. Si la targeta no està marcada com a activa, es desfà la reclamació i el QR no es consumeix
+    # En tot cas, l'aplicació mòbil (tuAPP) des d'un principi no permet generar un QR si la targeta no és vàlida
+    if estat != "Activa":
+        conn.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail=f"La targeta associada a aquest QR no esta activa (estat: '{estat}')"
+        )
+
+    # 3. Es cobra el viatge amb un UPDATE condicional: si no hi ha saldo suficient no es modifica cap fila,
+    # es desfà tota la transacció i el QR no es consumeix (es pot tornar a provar després de recarregar)
+    import_cobrat = motor_tarifes.import_viatge(perfil)
+    if import_cobrat > 0:
+        cursor.execute(
+            """
+            UPDATE targeta SET saldo = saldo - %s
+            WHERE id = %s AND estat = 'Activa' AND saldo >= %s
+            """,
+            (import_cobrat, id_targeta_mare, import_cobrat)
+        )
+        if cursor.rowcount == 0:
+            conn.rollback()
+            raise HTTPException(
+                status_code=402,
+                detail=f"Saldo insuficient (saldo: {saldo}, tarifa: {import_cobrat})"
+            )
+    saldo_nou = saldo - import_cobrat
+
+    # 4. Si el codi passa totes les validacions, es confirmen la reclamació i el cobrament i el QR queda consumit
+    conn.commit()
+    estadistiques.targeta_modificada(estat, estat, saldo, saldo_nou)
+    # Amb el saldo nou es pot refer la fila completa de la targeta (mateix ordre de columnes que SELECT *)
+    if import_cobrat > 0:
+        cache_targetes.actualitzar(
+            id_targeta_mare,
+            (id_targeta_mare, passatger_id, codi_targeta, perfil, saldo_nou, estat)
+        )
+
+    # 5. La validació queda al buffer de l'històric, que l'escriu en lots fora de la petició
+    buffer_validacions.registrar(Validacio(
+        id_targeta=id_targeta_mare,
+        id_passatger=passatger_id,
+        perfil=perfil,
+        import_cobrat=import_cobrat,
+        id_usuari=id_usuari,
+        data_validacio=datetime.utcnow(),
+    ))
+
+    return VerifyQRResponse(
+        valid=True,
+        id_targeta_mare=id_targeta_mare,
+        codi_targeta=codi_targeta,
+        perfil=perfil,
+        saldo=float(saldo_nou),
+        import_cobrat=float(import_cobrat),
+        passatger_id=passatger_id,
+        nom=nom,
+        llinatge_1=llinatge_1,
+        llinatge_2=llinatge_2,
+        document=document,
+        email=email,
+    )
+
+
+# Verifica un hash QR i, si és vàlid, el consumeix. La fan servir l'endpoint HTTP i el canal WebSocket de les validadores
+# Per a dur a terme dita verificació seguim un parell de passes:
+def _verificar_qr(qr: str, id_usuari: Optional[int] = None) -> VerifyQRResponse:
+    # Els QR generats pel dispositiu (TOTP) no tenen cap targeta virtual associada
+    if es_token_dispositiu(qr):
+        return _verificar_qr_dispositiu(qr, id_usuari)
+
+    # El prefix del token indica a quin shard és la targeta virtual
+    with get_db_connection(shard_token_qr(qr)) as conn:
         cursor = conn.cursor()
         try:
+            # 1. Es reclama el QR esborrant-lo directament pel seu digest. El DELETE bloqueja la fila fins al commit,
+            # de manera que si dues validadores escanegen el mateix QR alhora, només una el pot esborrar
             cursor.execute(
-                "SELECT qr, data_expiracio FROM targeta_virtual WHERE id = %s",
-                (targeta_virtual_id,)
+                """
+                DELETE FROM targeta_virtual
+                WHERE qr_digest = %s
+                RETURNING id_targeta_mare, data_expiracio
+                """,
+                (digest_token_qr(qr),)
             )
-            row = cursor.fetchone()
+            reclamat = cursor.fetchone()
 
-            if not row:
+            if not reclamat:
+                conn.rollback()
                 raise HTTPException(
                     status_code=404,
-                    detail="Targeta virtual no trobada"
+                    detail="QR no valid"
                 )
 
-            qr_hash, data_expiracio = row[0], row[1]
+            id_targeta_mare, data_expiracio = reclamat
 
-            # Si el codi QR ja ha caducat, retornem un status "410 Gone"
+            # 2. Si el QR ha caducat, l'esborrat es confirma igualment
             if datetime.utcnow() > data_expiracio:
+                conn.commit()
+                estadistiques.targeta_virtual_consumida(id_targeta_mare)
                 raise HTTPException(
                     status_code=410,
-                    detail="El QR ha caducat. Genera una nova targeta virtual"
+                    detail="El QR ha caducat. Cal generar una nova targeta virtual"
                 )
 
-            # Si no ha caducat, rebem el hash i generam el QR
-            qr = qrcode.QRCode(
-                version=None,
-                error_correction=qrcode.constants.ERROR_CORRECT_M,
-                box_size=2,
-                border=2,
-            )
-            qr.add_data(qr_hash)
-            qr.make(fit=True)
-
-            img: PilImage = qr.make_image(fill_color="black", back_color="white")
-
-            # Assignam perfil de color al QR i l'escalam a 256x256 per a que càpiga a l'aplicació
-            img_rgb = img.convert("RGB").resize((256, 256), Image.NEAREST)
-
-            buffer = io.BytesIO()
-            img_rgb.save(buffer, format="JPEG", quality=90)
-            buffer.seek(0)
-
-            return Response(
-                content=buffer.read(),
-                media_type="image/jpeg",
-                headers={
-                    "Content-Disposition": f'inline; filename="qr_{targeta_virtual_id}.jpg"'
-                }
-            )
+            # 3. Es cobra el viatge i es confirma l'esborrat dins la mateixa transacció
+            resposta = _cobrar_viatge(conn, cursor, id_targeta_mare, id_usuari)
+            estadistiques.targeta_virtual_consumida(id_targeta_mare)
+            return resposta
 
         except HTTPException:
             raise
-        except Exception as e:
+        except pymysql.Error as e:
             raise HTTPException(
                 status_code=500,
-                detail=f"Error generant el QR: {str(e)}"
+                detail=f"Error de base de dades: {str(e)}"
             )
         finally:
             cursor.close()
 
 
-# iii. Verificació del QR
+# Verifica un QR generat pel dispositiu ("T-<id>-<codi>") i, si és vàlid, el consumeix
+def _verificar_qr_dispositiu(qr: str, id_usuari: Optional[int] = None) -> VerifyQRResponse:
+    token = llegir_token(qr)
+    if token is None:
+        raise HTTPException(
+            status_code=404,
+            detail="QR no valid"
+        )
+    id_targeta_mare, codi = token
 
-# Feim una petició POST amb el hash d'un QR
-@router.post(
-    "/verify",
-    status_code=status.HTTP_200_OK,
-    response_model=VerifyQRResponse,
-    name="Verificar QR",
-    summary="Valida un hash QR i retorna les dades del passatger i la targeta",
-    description=(
-        "Rep el hash extret d'un QR i comprova que existeix i no ha caducat. Si és vàlid, retorna les dades de la targeta física i del passatger associat. Un cop verificat, el QR s'invalida per evitar reutilitzacions"
-    )
-)
-
-# Per a dur a terme dita verificació seguim un parell de passes:
-async def verify_qr(
-    body: VerifyQRRequest,
-    current_user: User = Depends(get_current_user)
-):
-    with get_db_connection() as conn:
+    with get_db_connection(shard_de_id(id_targeta_mare)) as conn:
         cursor = conn.cursor()
         try:
-            # 1. Buscam el hash del QR a la base de dades
+            # 1. Es recalcula el codi amb el secret de la targeta per a cada pas de la finestra de tolerància
             cursor.execute(
-                """
-                SELECT tv.id, tv.id_targeta_mare, tv.data_expiracio,
-                       t.codi_targeta, t.perfil, t.saldo, t.estat,
-                       p.id, p.nom, p.llinatge_1, p.llinatge_2, p.document, p.email
-                FROM targeta_virtual tv
-                INNER JOIN targeta   t ON t.id = tv.id_targeta_mare
-                INNER JOIN passatger p ON p.id = t.id_passatger
-                WHERE tv.qr = %s
-                """,
-                (body.qr,)
+                "SELECT sal, darrer_pas FROM qr_dispositiu WHERE id_targeta = %s",
+                (id_targeta_mare,)
             )
             row = cursor.fetchone()
-
-            if not row:
+            pas = pas_del_codi(derivar_secret(id_targeta_mare, row[0]), codi) if row else None
+            if pas is None:
+                conn.rollback()
                 raise HTTPException(
                     status_code=404,
                     detail="QR no valid"
                 )
 
-            (tv_id, id_targeta_mare, data_expiracio,
-             codi_targeta, perfil, saldo, estat,
-             passatger_id, nom, llinatge_1, llinatge_2,
-             document, email) = row
-
-            # 2. Comprovam si el hash està marcat com a caducat
-            if datetime.utcnow() > data_expiracio:
-                cursor.execute(
-                    "DELETE FROM targeta_virtual WHERE id = %s", (tv_id,)
-                )
-                conn.commit()
+            # 2. Es reclama el pas amb un UPDATE condicional: si ja s'ha acceptat aquest pas o un de posterior
+            # (el mateix QR escanejat dues vegades, o dues validadores alhora) no es modifica cap fila
+            cursor.execute(
+                "UPDATE qr_dispositiu SET darrer_pas = %s WHERE id_targeta = %s AND darrer_pas < %s",
+                (pas, id_targeta_mare, pas)
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
                 raise HTTPException(
                     status_code=410,
-                    detail="El QR ha caducat. Cal generar una nova targeta virtual"
+                    detail="Aquest QR ja s'ha emprat. Espera el codi següent"
                 )
 
-            # 3. Si el codi no està caducat, comprovam que la targeta estigui marcada com a activa
-            # En tot cas, l'aplicació mòbil (tuAPP) des d'un principi no permet generar un QR si la targeta no és vàlida
-            if estat != "Activa":
+            # 3. Es cobra el viatge i es confirma la reclamació dins la mateixa transacció
+            return _cobrar_viatge(conn, cursor, id_targeta_mare, id_usuari)
+
+        except HTTPException:
+            raise
+        except pymysql.Error as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error de base de dades: {str(e)}"
+            )
+        finally:
+            cursor.close()
+
+# Crea o renova el secret TOTP d'una targeta activa. El secret anterior deixa de ser vàlid
+def _provisionar_secret(id_targeta_mare: int) -> SecretQRResponse:
+    with get_db_connection(shard_de_id(id_targeta_mare)) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT estat FROM targeta WHERE id = %s",
+                (id_targeta_mare,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                raise HTTPException(
+                    status_code=404,
+                    detail="Targeta no trobada"
+                )
+            if row[0] != "Activa":
                 raise HTTPException(
                     status_code=400,
-                    detail=f"La targeta associada a aquest QR no esta activa (estat: '{estat}')"
+                    detail=f"No es pot generar el secret d'una targeta en estat '{row[0]}'"
                 )
 
-            # 4. Si el codi passa totes les validacions i és vàlid, es marca com a usat i s'elimina de la base de dades
+            sal = generar_sal()
             cursor.execute(
-                "DELETE FROM targeta_virtual WHERE id = %s", (tv_id,)
+                """
+                INSERT INTO qr_dispositiu (id_targeta, sal, darrer_pas, data_provisio)
+                VALUES (%s, %s, 0, %s)
+                ON DUPLICATE KEY UPDATE sal = VALUES(sal), darrer_pas = 0, data_provisio = VALUES(data_provisio)
+                """,
+                (id_targeta_mare, sal, datetime.utcnow())
             )
             conn.commit()
 
-            return VerifyQRResponse(
-                valid=True,
+            return SecretQRResponse(
                 id_targeta_mare=id_targeta_mare,
-                codi_targeta=codi_targeta,
-                perfil=perfil,
-                saldo=float(saldo),
-                passatger_id=passatger_id,
-                nom=nom,
-                llinatge_1=llinatge_1,
-                llinatge_2=llinatge_2,
-                document=document,
-                email=email,
+                secret=secret_base32(derivar_secret(id_targeta_mare, sal)),
+                periode_segons=QR_DISPOSITIU_PERIODE_SEGONS,
+                digits=QR_DISPOSITIU_DIGITS,
+                format=f"T-{id_targeta_mare}-{{codi}}",
             )
-
         except HTTPException:
             raise
         except pymysql.Error as e:
@@ -304,4 +399,366 @@ async def verify_qr(
                 detail=f"Error de base de dades: {str(e)}"
             )
         finally:
-            cursor.close()
\ No newline at end of file
+            cursor.close()
+
+# Converteix un esdeveniment de la roda de rotació en un missatge SSE
+def _format_sse(esdeveniment, amb_imatge: bool) -> str:
+    if esdeveniment.error is not None:
+        return f"event: error\ndata: {json.dumps({'detail': esdeveniment.error}, ensure_ascii=False)}\n\n"
+    dades = esdeveniment.targeta_virtual.model_dump(mode="json")
+    if amb_imatge and esdeveniment.imatge is not None:
+        dades["imatge"] = base64.b64encode(esdeveniment.imatge).decode("ascii")
+    return f"event: qr\nid: {dades['id']}\ndata: {json.dumps(dades)}\n\n"
+
+
+# Les rotacions automàtiques passen pel control d'admissió amb la mateixa prioritat que la generació des de l'app
+async def _generar_rotacio(id_targeta_mare: int) -> TargetaVirtualResponse:
+    async with control_admissio.ocupar(Prioritat.app):
+        return await run_in_threadpool(_generar_targeta_virtual, id_targeta_mare)
+
+
+# Roda de rotació compartida per totes les connexions SSE del worker
+roda_rotacio = RodaRotacio(
+    generar=_generar_rotacio,
+    renderitzar=lambda qr_hash: run_in_threadpool(renderitzar_qr, qr_hash),
+    antelacio_segons=QR_ANTELACIO_SEGONS,
+)
+
+## Endpoints
+# i. Targetes virtuals (general)
+
+# Si la petició és un POST, generam una nova targeta virtual
+@router.post(
+    "",
+    status_code=status.HTTP_201_CREATED,
+    response_model=TargetaVirtualResponse,
+    name="Crear targeta virtual",
+    summary="Genera una targeta virtual amb QR",
+    description=(
+        "Crea una targeta virtual associada a una targeta física. "
+        "Genera un hash únic de X caràcters que s'emmagatzema al camp 'qr' i és vàlid durant Y segons. Només es pot crear una targeta virtual per a targetes en estat 'Activa'"
+    ),
+    dependencies=[Depends(admissio(Prioritat.app))]
+)
+async def create_targeta_virtual(
+    id_targeta_mare: int,
+    current_user: User = Depends(get_current_user)
+):
+    return _generar_targeta_virtual(id_targeta_mare)
+
+# Si la petició és un POST a /qr, es genera la targeta virtual i es retorna directament amb la imatge del QR
+@router.post(
+    "/qr",
+    status_code=status.HTTP_201_CREATED,
+    response_model=TargetaVirtualAmbImatgeResponse,
+    responses={
+        201: {
+            "content": {"image/jpeg": {}},
+            "description": "Amb format=imatge, la imatge QR en JPEG i les dades de la targeta virtual a les capçaleres X-Targeta-Virtual-*"
+        }
+    },
+    name="Crear targeta virtual i obtenir QR",
+    summary="Genera una targeta virtual i retorna la imatge QR en una sola petició",
+    description=(
+        "Equival a fer POST /targetes-virtuals seguit de GET /targetes-virtuals/{id}/qr. "
+        "Amb format=json (per defecte) retorna les dades de la targeta virtual amb la imatge JPEG en base64 al camp 'imatge'. "
+        "Amb format=imatge retorna la imatge JPEG i les dades a les capçaleres X-Targeta-Virtual-Id, X-Targeta-Virtual-QR, X-Targeta-Virtual-Creacio i X-Targeta-Virtual-Expiracio"
+    ),
+    dependencies=[Depends(admissio(Prioritat.app))]
+)
+async def create_targeta_virtual_qr(
+    id_targeta_mare: int,
+    format: Literal["json", "imatge"] = Query("json"),
+    current_user: User = Depends(get_current_user)
+):
+    targeta_virtual = _generar_targeta_virtual(id_targeta_mare)
+    imatge = renderitzar_qr(targeta_virtual.qr)
+
+    if format == "json":
+        return TargetaVirtualAmbImatgeResponse(
+            **targeta_virtual.model_dump(),
+            imatge=base64.b64encode(imatge).decode("ascii")
+        )
+
+    segons_restants = max(0, math.floor((targeta_virtual.data_expiracio - datetime.utcnow()).total_seconds()))
+    return Response(
+        content=imatge,
+        status_code=status.HTTP_201_CREATED,
+        media_type="image/jpeg",
+        headers={
+            "ETag": calcular_etag(targeta_virtual.id, targeta_virtual.qr),
+            "Cache-Control": f"private, max-age={segons_restants}",
+            "Expires": format_data_http(targeta_virtual.data_expiracio),
+            "Content-Disposition": f'inline; filename="qr_{targeta_virtual.id}.jpg"',
+            "X-Targeta-Virtual-Id": str(targeta_virtual.id),
+            "X-Targeta-Virtual-QR": targeta_virtual.qr,
+            "X-Targeta-Virtual-Creacio": targeta_virtual.data_creacio.isoformat(),
+            "X-Targeta-Virtual-Expiracio": targeta_virtual.data_expiracio.isoformat(),
+        }
+    )
+
+# Si la petició és un POST a /secret, es genera el secret amb què l'app calcula els QR sense demanar-los al servidor
+@router.post(
+    "/secret",
+    status_code=status.HTTP_201_CREATED,
+    response_model=SecretQRResponse,
+    name="Crear secret de QR",
+    summary="Genera el secret TOTP d'una targeta per a generar els QR al dispositiu",
+    description=(
+        "Crea (o renova, invalidant l'anterior) el secret d'una targeta física activa. Amb el secret, l'app calcula cada "
+        "'periode_segons' un codi TOTP (RFC 6238, HMAC-SHA1) de 'digits' xifres i mostra el QR 'T-<id>-<codi>', sense cap "
+        "petició al servidor. La verificació accepta els codis d'un pas abans o després de l'actual i cada codi només una vegada"
+    ),
+    dependencies=[Depends(admissio(Prioritat.app))]
+)
+async def create_secret_qr(
+    id_targeta_mare: int,
+    current_user: User = Depends(get_current_user)
+):
+    return _provisionar_secret(id_targeta_mare)
+
+# Si la petició és un GET a /stream, s'obre un canal SSE que envia un QR nou abans que caduqui l'anterior
+@router.get(
+    "/stream",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {"text/event-stream": {}},
+            "description": "Flux d'esdeveniments 'qr' amb la targeta virtual vigent (i opcionalment la imatge en base64)"
+        }
+    },
+    name="Flux de QR rotatius",
+    summary="Envia per Server-Sent Events un QR nou abans que caduqui l'anterior",
+    description=(
+        "Obre una connexió SSE per a una targeta física activa. Envia immediatament la targeta virtual vigent i, uns segons abans que caduqui, en genera i envia una de nova. "
+        "Amb 'imatge=true' cada esdeveniment inclou també la imatge JPEG en base64. Tots els clients d'una mateixa targeta comparteixen el mateix QR. "
+        "Si la targeta deixa d'estar activa s'envia un esdeveniment 'error' i es tanca el flux"
+    )
+)
+async def stream_targeta_virtual(
+    id_targeta_mare: int,
+    imatge: bool = Query(False),
+    current_user: User = Depends(get_current_user)
+):
+    # L'autenticació i la primera generació es fan abans de començar el flux, per a poder retornar errors HTTP normals
+    subscripcio = await roda_rotacio.subscriure(id_targeta_mare, imatge)
+
+    async def esdeveniments():
+        try:
+            while True:
+                try:
+                    esdeveniment = await asyncio.wait_for(
+                        subscripcio.cua.get(), timeout=SSE_KEEPALIVE_SEGONS
+                    )
+                except asyncio.TimeoutError:
+                    # Comentari SSE per a que els proxies no tanquin la connexió inactiva
+                    yield ": keepalive\n\n"
+                    continue
+                yield _format_sse(esdeveniment, imatge)
+                if esdeveniment.error is not None:
+                    return
+        finally:
+            roda_rotacio.dessubscriure(id_targeta_mare, subscripcio)
+
+    return StreamingResponse(
+        esdeveniments(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ii. Targeta virtual concreta (QR)
+
+# Feim una petició GET per a obtenir el codi QR d'una targeta
+@router.get(
+    "/{targeta_virtual_id}/qr",
+    status_code=status.HTTP_200_OK,
+    response_class=Response,
+    responses={
+        200: {
+            "content": {"image/jpeg": {}},
+            "description": "Imatge QR en format JPEG"
+        }
+    },
+    name="Obtenir QR",
+    summary="Retorna la imatge QR d'una targeta virtual",
+    description=(
+        "Genera i retorna la imatge QR associada al hash d'una targeta virtual en format JPEG. Retorna 410 Gone si el QR ha caducat. "
+        "La resposta es pot cachejar fins a la data d'expiració del QR i retorna 304 Not Modified si l'ETag coincideix amb If-None-Match"
+    ),
+    dependencies=[Depends(admissio(Prioritat.app))]
+)
+async def get_qr(
+    targeta_virtual_id: int,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
+):
+    # Les peticions simultànies per al mateix QR (per exemple, l'app i una validadora) comparteixen consulta i renderitzat
+    row = await coalescencia_qr.fer(
+        targeta_virtual_id, lambda: run_in_threadpool(_carregar_qr, targeta_virtual_id)
+    )
+
+    if not row:
+        raise HTTPException(
+            status_code=404,
+            detail="Targeta virtual no trobada"
+        )
+
+    qr_hash, data_expiracio = recuperar_token_qr(row[0], row[1], shard_de_id(targeta_virtual_id)), row[2]
+
+    # Si el codi QR ja ha caducat, retornem un status "410 Gone"
+    ara = datetime.utcnow()
+    if ara > data_expiracio:
+        raise HTTPException(
+            status_code=410,
+            detail="El QR ha caducat. Genera una nova targeta virtual"
+        )
+
+    # La imatge només depèn del hash, i es pot cachejar fins que el QR caduqui
+    segons_restants = max(0, math.floor((data_expiracio - ara).total_seconds()))
+    headers = {
+        "ETag": calcular_etag(targeta_virtual_id, qr_hash),
+        "Cache-Control": f"private, max-age={segons_restants}",
+        "Expires": format_data_http(data_expiracio),
+    }
+
+    # Si el client ja té aquesta imatge, no cal tornar-la a renderitzar
+    if etag_coincideix(if_none_match, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Si no ha caducat, rebem el hash i generam el QR
+    try:
+        imatge = await coalescencia_render_qr.fer(
+            qr_hash, lambda: run_in_threadpool(renderitzar_qr, qr_hash)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error generant el QR: {str(e)}"
+        )
+
+    return Response(
+        content=imatge,
+        media_type="image/jpeg",
+        headers={
+            **headers,
+            "Content-Disposition": f'inline; filename="qr_{targeta_virtual_id}.jpg"'
+        }
+    )
+
+
+# iii. Verificació del QR
+
+# Feim una petició POST amb el hash d'un QR
+@router.post(
+    "/verify",
+    status_code=status.HTTP_200_OK,
+    response_model=VerifyQRResponse,
+    name="Verificar QR",
+    summary="Valida un hash QR i retorna les dades del passatger i la targeta",
+    description=(
+        "Rep el hash extret d'un QR i comprova que existeix i no ha caducat. Si és vàlid, retorna les dades de la targeta física i del passatger associat. Un cop verificat, el QR s'invalida per evitar reutilitzacions"
+    ),
+    dependencies=[Depends(admissio(Prioritat.validadora))]
+)
+
+async def verify_qr(
+    body: VerifyQRRequest,
+    current_user: User = Depends(get_current_user)
+):
+    # La verificació actualitza la cache de targetes, que amb el backend compartit és un fitxer: es fa al threadpool
+    return await run_in_threadpool(_verificar_qr, body.qr, current_user.id)
+
+
+# iv. Canal WebSocket per a validadores
+
+# La validadora s'autentica un sol cop i després envia escanejos {"id": ..., "qr": ...} pel mateix canal
+# Cada escaneig es verifica en paral·lel i la resposta porta el mateix "id", per això poden arribar desordenades
+@router.websocket("/ws/validadora")
+async def validadora_ws(websocket: WebSocket):
+    await websocket.accept()
+
+    # 1. Autenticació: amb la capçalera Authorization o amb un primer missatge {"token": "..."}
+    token = None
+    autoritzacio = websocket.headers.get("authorization", "")
+    if autoritzacio.lower().startswith("bearer "):
+        token = autoritzacio[7:]
+    try:
+        if token is None:
+            missatge = json.loads(await asyncio.wait_for(
+                websocket.receive_text(), timeout=WS_TIMEOUT_AUTENTICACIO_SEGONS
+            ))
+            token = missatge.get("token") if isinstance(missatge, dict) else None
+        usuari = await get_current_user(token or "")
+    except (HTTPException, asyncio.TimeoutError, ValueError, WebSocketDisconnect):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    # El canal es tanca quan caduca el JWT amb el que s'ha autenticat
+    # Un token sense 'exp' no caduca mai: no s'accepta per a un canal de llarga durada
+    from jose import jwt
+    exp = jwt.get_unverified_claims(token).get("exp")
+    if exp is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    expiracio = datetime.utcfromtimestamp(exp)
+
+    await websocket.send_json({"tipus": "autenticat"})
+
+    # 2. Escanejos: cada un es processa en una tasca pròpia. Els enviaments es serialitzen amb un lock
+    enviament = asyncio.Lock()
+    limit = asyncio.Semaphore(WS_MAX_VERIFICACIONS_CONCURRENTS)
+    tasques: set[asyncio.Task] = set()
+
+    async def enviar(resposta: dict) -> None:
+        async with enviament:
+            await websocket.send_json(resposta)
+
+    async def processar(id_peticio, qr: str) -> None:
+        try:
+            async with control_admissio.ocupar(Prioritat.validadora):
+                resultat = await run_in_threadpool(_verificar_qr, qr, usuari.id)
+            resposta = {"id": id_peticio, "status": 200, **resultat.model_dump(mode="json")}
+        except HTTPException as e:
+            resposta = {"id": id_peticio, "status": e.status_code, "valid": False, "detail": e.detail}
+        except Exception:
+            # Cada escaneig ha de rebre una resposta, encara que la verificació falli de manera inesperada
+            logger.exception("Error verificant un QR pel canal WebSocket")
+            resposta = {"id": id_peticio, "status": 500, "valid": False, "detail": "Error intern verificant el QR"}
+        finally:
+            limit.release()
+        try:
+            await enviar(resposta)
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+
+    try:
+        while True:
+            text = await websocket.receive_text()
+            if datetime.utcnow() > expiracio:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Token caducat")
+                return
+
+            try:
+                missatge = json.loads(text)
+            except ValueError:
+                missatge = None
+            if not isinstance(missatge, dict) or not isinstance(missatge.get("qr"), str):
+                await enviar({
+                    "id": missatge.get("id") if isinstance(missatge, dict) else None,
+                    "status": 422,
+                    "valid": False,
+                    "detail": "El missatge ha de ser un objecte JSON amb els camps 'id' i 'qr'"
+                })
+                continue
+
+            # Si la validadora té massa escanejos pendents, s'espera a que n'acabi algun
+            await limit.acquire()
+            tasca = asyncio.create_task(processar(missatge.get("id"), missatge["qr"]))
+            tasques.add(tasca)
+            tasca.add_done_callback(tasques.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for tasca in tasques:
+            tasca.cancel()
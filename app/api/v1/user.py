@@ -3,12 +3,14 @@
 import pymysql
 
 from app.schemas.user import UserCreate, UserUpdate, UserResponse
-from app.db.database import get_db_connection
+from app.db.database import get_db_connection, get_db_read_connection
 from app.core.security import User, get_current_user, get_password_hash
+from app.core.admissio import admissio, Prioritat
 
 router = APIRouter(
     prefix="/api/v1/users",
-    tags=["Usuaris"]
+    tags=["Usuaris"],
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
 )
 
 ## Helpers
@@ -31,7 +33,7 @@ def _row_to_response(row) -> UserResponse:
     response_model=UserResponse,
     name="Crear usuari",
     summary="Registra un nou usuari autoritzat",
-    description="Crea un nou usuari amb acces a la API. La contrasenya s'emmagatzema hashejada amb bcrypt"
+    description="Crea un nou usuari amb acces a la API. La contrasenya s'emmagatzema hashejada amb l'algorisme de la política de contrasenyes (bcrypt o scrypt)"
 )
 async def create_user(
     user: UserCreate,
@@ -98,7 +100,7 @@ async def get_users(
     limit: int = Query(None, ge=1),
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    with get_db_read_connection() as conn:
         cursor = conn.cursor()
         try:
             if limit is None:
@@ -131,7 +133,7 @@ async def get_users(
     description="Retorna la informacio de l'usuari que ha fet la peticio, identificat pel JWT"
 )
 async def get_me(current_user: User = Depends(get_current_user)):
-    with get_db_connection() as conn:
+    with get_db_read_connection() as conn:
         cursor = conn.cursor()
         try:
             cursor.execute(
@@ -160,7 +162,7 @@ async def get_user(
     user_id: int,
     current_user: User = Depends(get_current_user)
 ):
-    with get_db_connection() as conn:
+    with get_db_read_connection() as conn:
         cursor = conn.cursor()
         try:
             cursor.execute(
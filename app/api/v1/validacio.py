@@ -0,0 +1,151 @@
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+
+from app.schemas.validacio import HistoricTargetaResponse, ValidacioResponse, ValidacionsDiaResponse
+from app.db.database import get_db_read_connection
+from app.core.security import User, get_current_user
+from app.core.admissio import admissio, Prioritat
+
+router = APIRouter(
+    prefix="/api/v1/validacions",
+    tags=["Validacions"],
+    dependencies=[Depends(admissio(Prioritat.backoffice))]
+)
+
+HISTORIC_DIES_PER_DEFECTE = 30
+MAX_DIES_RESUM = 366
+
+## Endpoints
+# Les consultes sempre filtren per rang de dates sobre `data_validacio`, de manera que MariaDB només llegeix
+# les particions (mesos) afectades
+
+# i. Històric d'una targeta
+# Si la petició és GET a /targeta/{id}, es retornen les validacions de la targeta dins el rang de dates
+@router.get(
+    "/targeta/{targeta_id}",
+    status_code=status.HTTP_200_OK,
+    response_model=HistoricTargetaResponse,
+    name="Històric de validacions d'una targeta",
+    summary="Llista les validacions d'una targeta en un rang de dates",
+    description=(
+        "Retorna les validacions de la targeta entre 'des_de' i 'fins_a' (per defecte, els darrers 30 dies). "
+        "Els resultats s'ordenen per ID i es paginen amb 'despres_de' (l'ID 'seguent' de la pàgina anterior). "
+        "Les validacions s'escriuen en lots, per això les dels darrers segons encara poden no aparèixer"
+    )
+)
+async def get_historic_targeta(
+    targeta_id: int,
+    des_de: Optional[datetime] = Query(None),
+    fins_a: Optional[datetime] = Query(None),
+    despres_de: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(get_current_user)
+):
+    fins_a = fins_a or datetime.utcnow()
+    des_de = des_de or fins_a - timedelta(days=HISTORIC_DIES_PER_DEFECTE)
+    if des_de > fins_a:
+        raise HTTPException(
+            status_code=400,
+            detail="'des_de' ha de ser anterior a 'fins_a'"
+        )
+
+    with get_db_read_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """
+                SELECT id, id_targeta, id_passatger, perfil, import_cobrat, id_usuari, data_validacio
+                FROM validacio
+                WHERE id_targeta = %s AND data_validacio >= %s AND data_validacio <= %s AND id > %s
+                ORDER BY id
+                LIMIT %s
+                """,
+                (targeta_id, des_de, fins_a, despres_de, limit)
+            )
+            rows = cursor.fetchall()
+
+            resultats = [
+                ValidacioResponse(
+                    id=row[0],
+                    id_targeta=row[1],
+                    id_passatger=row[2],
+                    perfil=row[3],
+                    import_cobrat=row[4],
+                    id_usuari=row[5],
+                    data_validacio=row[6]
+                )
+                for row in rows
+            ]
+
+            # Si la pàgina és plena, l'últim ID serveix de cursor per a la pàgina següent
+            seguent = resultats[-1].id if len(resultats) == limit else None
+            return HistoricTargetaResponse(resultats=resultats, seguent=seguent)
+        finally:
+            cursor.close()
+
+# ii. Resum diari
+# Si la petició és GET a /dies, es retorna el nombre de validacions de cada dia, en total i per perfil
+@router.get(
+    "/dies",
+    status_code=status.HTTP_200_OK,
+    response_model=List[ValidacionsDiaResponse],
+    name="Validacions per dia",
+    summary="Retorna el nombre de validacions de cada dia d'un rang",
+    description=(
+        "Retorna, per a cada dia entre 'des_de' i 'fins_a' (inclosos) amb alguna validació, el nombre de validacions, "
+        "de targetes diferents i de validacions per perfil. Si s'indica 'targeta_id', només es compten les d'aquesta targeta. "
+        "El rang no pot superar els 366 dies"
+    )
+)
+async def get_validacions_per_dia(
+    des_de: date = Query(...),
+    fins_a: date = Query(...),
+    targeta_id: Optional[int] = Query(None),
+    current_user: User = Depends(get_current_user)
+):
+    if des_de > fins_a:
+        raise HTTPException(
+            status_code=400,
+            detail="'des_de' ha de ser anterior a 'fins_a'"
+        )
+    if (fins_a - des_de).days >= MAX_DIES_RESUM:
+        raise HTTPException(
+            status_code=400,
+            detail=f"El rang no pot superar els {MAX_DIES_RESUM} dies"
+        )
+
+    # El rang es passa com a DATETIME (sense DATE() a la columna) per a que s'apliqui la poda de particions
+    condicions = ["data_validacio >= %s", "data_validacio < %s"]
+    values = [
+        datetime.combine(des_de, datetime.min.time()),
+        datetime.combine(fins_a + timedelta(days=1), datetime.min.time()),
+    ]
+    if targeta_id is not None:
+        condicions.append("id_targeta = %s")
+        values.append(targeta_id)
+
+    with get_db_read_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT DATE(data_validacio) AS dia, perfil, COUNT(*), COUNT(DISTINCT id_targeta) "
+                f"FROM validacio WHERE {' AND '.join(condicions)} "
+                "GROUP BY dia, perfil ORDER BY dia",
+                tuple(values)
+            )
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+
+    # Una targeta només té un perfil, per això les targetes diferents de cada perfil es poden sumar
+    dies: dict[date, ValidacionsDiaResponse] = {}
+    for dia, perfil, validacions, targetes in rows:
+        resum = dies.get(dia)
+        if resum is None:
+            resum = dies[dia] = ValidacionsDiaResponse(dia=dia, validacions=0, targetes=0, per_perfil={})
+        resum.validacions += validacions
+        resum.targetes += targetes
+        resum.per_perfil[perfil] = validacions
+
+    return list(dies.values())
@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import itertools
+import os
+from contextlib import asynccontextmanager
+from enum import IntEnum
+
+from fastapi import HTTPException
+
+'''
+Control d'admissió davant l'accés a la base de dades.
+
+Com a molt hi pot haver ADMISSIO_MAX_CONCURRENCIA peticions treballant amb la base de dades alhora. La resta esperen
+en una cua de prioritat: quan s'allibera una plaça, passa la petició de més prioritat (i, a igual prioritat, la més antiga).
+Cada classe té un temps màxim d'espera. Si se supera, o si la cua ja és plena, es respon immediatament amb
+503 i Retry-After en lloc d'acumular peticions fins que tot faci timeout.
+
+Prioritats: validadora (verificació de QR a la porta del bus) > app (generació de QR, login, cartera) > backoffice.
+'''
+
+ADMISSIO_MAX_CONCURRENCIA = int(os.getenv("ADMISSIO_MAX_CONCURRENCIA", 20))
+ADMISSIO_MAX_CUA = int(os.getenv("ADMISSIO_MAX_CUA", 200))
+ADMISSIO_RETRY_AFTER_SEGONS = int(os.getenv("ADMISSIO_RETRY_AFTER_SEGONS", 1))
+
+
+class Prioritat(IntEnum):
+    validadora = 0
+    app        = 1
+    backoffice = 2
+
+
+# Temps màxim d'espera a la cua per a cada prioritat
+ADMISSIO_TIMEOUTS = {
+    Prioritat.validadora: float(os.getenv("ADMISSIO_TIMEOUT_VALIDADORA", 2.0)),
+    Prioritat.app:        float(os.getenv("ADMISSIO_TIMEOUT_APP", 1.0)),
+    Prioritat.backoffice: float(os.getenv("ADMISSIO_TIMEOUT_BACKOFFICE", 0.5)),
+}
+
+
+class ControlAdmissio:
+    def __init__(self, places: int, max_cua: int, timeouts: dict):
+        self._lliures = places
+        self._max_cua = max_cua
+        self._timeouts = timeouts
+        # Cua de prioritat: (prioritat, ordre d'arribada, futur que es resol quan s'assigna la plaça)
+        self._cua: list = []
+        self._ordre = itertools.count()
+        self._en_espera = 0
+        self.admeses = {p.name: 0 for p in Prioritat}
+        self.rebutjades = {p.name: 0 for p in Prioritat}
+
+    def _rebutjar(self, prioritat: Prioritat) -> HTTPException:
+        self.rebutjades[prioritat.name] += 1
+        return HTTPException(
+            status_code=503,
+            detail="El servei està saturat. Torna-ho a intentar en uns instants",
+            headers={"Retry-After": str(ADMISSIO_RETRY_AFTER_SEGONS)},
+        )
+
+    async def entrar(self, prioritat: Prioritat) -> None:
+        # Si hi ha places lliures és que no hi ha ningú esperant (sortir() sempre dona la plaça a la cua primer)
+        if self._lliures > 0:
+            self._lliures -= 1
+            self.admeses[prioritat.name] += 1
+            return
+
+        if self._en_espera >= self._max_cua:
+            raise self._rebutjar(prioritat)
+
+        futur = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._cua, (prioritat, next(self._ordre), futur))
+        self._en_espera += 1
+        try:
+            await asyncio.wait_for(futur, timeout=self._timeouts[prioritat])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Normalment el futur queda cancel·lat i sortir() se'l saltarà. Però si sortir() ja ens havia cedit
+            # la plaça just abans del timeout o de la desconnexió del client, s'ha de tornar perquè no es perdi
+            if futur.done() and not futur.cancelled():
+                self.sortir()
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._rebutjar(prioritat)
+            raise
+        finally:
+            self._en_espera -= 1
+        self.admeses[prioritat.name] += 1
+
+    def sortir(self) -> None:
+        while self._cua:
+            _, _, futur = heapq.heappop(self._cua)
+            if not futur.done():
+                futur.set_result(None)
+                return
+        self._lliures += 1
+
+    @asynccontextmanager
+    async def ocupar(self, prioritat: Prioritat):
+        await self.entrar(prioritat)
+        try:
+            yield
+        finally:
+            self.sortir()
+
+    def metriques(self) -> dict:
+        return {
+            "places_lliures": self._lliures,
+            "en_cua": self._en_espera,
+            "admeses": dict(self.admeses),
+            "rebutjades": dict(self.rebutjades),
+        }
+
+
+control_admissio = ControlAdmissio(ADMISSIO_MAX_CONCURRENCIA, ADMISSIO_MAX_CUA, ADMISSIO_TIMEOUTS)
+
+
+# Dependència de FastAPI que ocupa una plaça amb la prioritat indicada durant tota la petició
+def admissio(prioritat: Prioritat):
+    async def dependencia():
+        async with control_admissio.ocupar(prioritat):
+            yield
+    return dependencia
@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.db.database import get_db_read_connection
+from app.db.sharding import N_SHARDS
+from app.core.http_cache import calcular_etag
+
+'''
+Llista de targetes bloquejades (tots els estats excepte 'Activa') en forma de filtre de Bloom, perquè les
+validadores sense connexió puguin rebutjar les targetes robades o perdudes sense cridar la verificació.
+
+Una tasca de fons de cada worker manté el filtre a memòria. Cada BLOQUEJADES_INTERVAL_SEGONS llegeix les entrades
+noves del registre de canvis (`canvi_targeta`, vegeu app/core/canvis_targeta.py) i hi afegeix els codis bloquejats.
+Un filtre de Bloom no permet treure elements, per això es reconstrueix sencer quan una targeta bloquejada torna a
+'Activa'. Per a saber-ho es guarden els ID de les targetes bloquejades: les entrades 'Activa' de targetes que no hi
+són (altes noves) no obliguen a reconstruir. També es reconstrueix quan el nombre d'elements demana una altra
+capacitat, que només depèn d'aquest nombre perquè dos workers amb el mateix estat generin els mateixos bytes.
+La reconstrucció llegeix els codis i la versió del registre de cada shard dins la mateixa instantània de la base de dades.
+
+Format binari (enters little-endian):
+    'TUBF' | format (u8) | k (u8) | longitud del cursor (u16) | m en bits (u32) | elements (u32) | cursor (UTF-8) | bits
+El cursor és el del registre de canvis en el moment del filtre: la validadora pot continuar amb
+/api/v1/targetes/canvis?des_de=<cursor>. Per a cada codi, d = SHA-256(codi en UTF-8), h1 i h2 són els enters dels
+bytes 0-7 i 8-15 de d (h2 amb el bit baix a 1), i els bits són (h1 + i * h2) mod m per a i = 0..k-1.
+El bit j és el bit (j mod 8) del byte j div 8.
+'''
+
+BLOQUEJADES_FALSOS_POSITIUS = float(os.getenv("BLOQUEJADES_FALSOS_POSITIUS", 0.01))
+BLOQUEJADES_INTERVAL_SEGONS = float(os.getenv("BLOQUEJADES_INTERVAL_SEGONS", 10))
+BLOQUEJADES_CAPACITAT_MINIMA = int(os.getenv("BLOQUEJADES_CAPACITAT_MINIMA", 1024))
+
+MAGIC = b"TUBF"
+FORMAT = 1
+_CAPCALERA = struct.Struct("<4sBBHII")
+
+MIDA_PAGINA_CANVIS = 5000
+
+logger = logging.getLogger(__name__)
+
+
+class FiltreBloom:
+    def __init__(self, capacitat: int, falsos_positius: float):
+        # Mida òptima per a 'capacitat' elements amb la taxa de falsos positius indicada
+        self.m = max(8, math.ceil(-capacitat * math.log(falsos_positius) / math.log(2) ** 2))
+        self.k = max(1, round(self.m / capacitat * math.log(2)))
+        self.capacitat = capacitat
+        self.elements = 0
+        self.bits = bytearray((self.m + 7) // 8)
+
+    def _posicions(self, codi: str) -> Iterable[int]:
+        d = hashlib.sha256(codi.encode("utf-8")).digest()
+        h1 = int.from_bytes(d[0:8], "little")
+        h2 = int.from_bytes(d[8:16], "little") | 1
+        return ((h1 + i * h2) % self.m for i in range(self.k))
+
+    def afegir(self, codi: str) -> None:
+        for p in self._posicions(codi):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.elements += 1
+
+    def conte(self, codi: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._posicions(codi))
+
+    def serialitzar(self, cursor: str) -> bytes:
+        cursor_bytes = cursor.encode("utf-8")
+        return (
+            _CAPCALERA.pack(MAGIC, FORMAT, self.k, len(cursor_bytes), self.m, self.elements)
+            + cursor_bytes
+            + bytes(self.bits)
+        )
+
+
+# Darrera versió publicada del filtre
+@dataclass(frozen=True)
+class Instantania:
+    dades: bytes
+    etag: str
+    cursor: str
+    elements: int
+
+
+class LlistaBloquejades:
+    def __init__(self, interval_segons: float, falsos_positius: float, capacitat_minima: int):
+        self.interval_segons = interval_segons
+        self.falsos_positius = falsos_positius
+        self.capacitat_minima = capacitat_minima
+        self.reconstruccions = 0
+        self.errors = 0
+        self._filtre: Optional[FiltreBloom] = None
+        # ID de les targetes bloquejades que hi ha al filtre
+        self._bloquejades: set[int] = set()
+        self._versions = [0] * N_SHARDS
+        self._instantania: Optional[Instantania] = None
+        self._lock = threading.Lock()
+        self._tasca: Optional[asyncio.Task] = None
+
+    # La capacitat només depèn del nombre de codis (potència de dos, amb un 25% de marge com a mínim), de manera que
+    # tots els workers amb el mateix estat serveixen exactament el mateix filtre i el mateix ETag
+    def _capacitat(self, elements: int) -> int:
+        capacitat = max(self.capacitat_minima, elements + elements // 4)
+        return 1 << (capacitat - 1).bit_length()
+
+    def _cursor(self) -> str:
+        return ".".join(str(v) for v in self._versions)
+
+    def _publicar(self) -> None:
+        dades = self._filtre.serialitzar(self._cursor())
+        self._instantania = Instantania(
+            dades=dades,
+            etag=calcular_etag(hashlib.sha256(dades).hexdigest()),
+            cursor=self._cursor(),
+            elements=self._filtre.elements,
+        )
+
+    # Torna a crear el filtre amb tots els codis bloquejats de tots els shards
+    def _reconstruir(self) -> None:
+        bloquejades = {}
+        versions = []
+        for shard in range(N_SHARDS):
+            with get_db_read_connection(shard) as conn:
+                cursor = conn.cursor()
+                try:
+                    # La versió i els codis han de sortir de la mateixa instantània perquè cap canvi quedi fora
+                    cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                    cursor.execute("SELECT versio FROM comptador_canvis WHERE id = 1")
+                    versions.append(cursor.fetchone()[0])
+                    cursor.execute("SELECT id, codi_targeta FROM targeta WHERE estat <> 'Activa'")
+                    bloquejades.update(cursor.fetchall())
+                    conn.commit()
+                finally:
+                    cursor.close()
+
+        filtre = FiltreBloom(self._capacitat(len(bloquejades)), self.falsos_positius)
+        for codi in bloquejades.values():
+            filtre.afegir(codi)
+        self._filtre = filtre
+        self._bloquejades = set(bloquejades)
+        self._versions = versions
+        self.reconstruccions += 1
+
+    # Aplica les entrades noves del registre de canvis. Retorna False si cal reconstruir el filtre
+    def _aplicar_canvis(self) -> bool:
+        for shard in range(N_SHARDS):
+            with get_db_read_connection(shard) as conn:
+                cursor = conn.cursor()
+                try:
+                    while True:
+                        cursor.execute(
+                            "SELECT versio, id_targeta, codi_targeta, estat FROM canvi_targeta "
+                            "WHERE versio > %s ORDER BY versio LIMIT %s",
+                            (self._versions[shard], MIDA_PAGINA_CANVIS)
+                        )
+                        rows = cursor.fetchall()
+                        for versio, id_targeta, codi_targeta, estat in rows:
+                            if estat != "Activa":
+                                if id_targeta not in self._bloquejades:
+                                    self._filtre.afegir(codi_targeta)
+                                    self._bloquejades.add(id_targeta)
+                            elif id_targeta in self._bloquejades:
+                                # Una targeta bloquejada s'ha tornat a activar: el seu codi s'ha de treure del filtre
+                                return False
+                            self._versions[shard] = versio
+                        if len(rows) < MIDA_PAGINA_CANVIS:
+                            break
+                finally:
+                    cursor.close()
+        return self._capacitat(self._filtre.elements) == self._filtre.capacitat
+
+    def actualitzar(self) -> None:
+        with self._lock:
+            try:
+                cursor_anterior = self._cursor()
+                if self._filtre is None or not self._aplicar_canvis():
+                    self._reconstruir()
+                elif self._instantania is not None and self._cursor() == cursor_anterior:
+                    return
+                self._publicar()
+            except Exception:
+                # get_db_read_connection converteix els errors de pymysql en HTTPException, per això es captura tot
+                # El filtre pot haver quedat a mitges: el següent cicle el reconstrueix
+                logger.exception("No s'ha pogut actualitzar la llista de targetes bloquejades")
+                self.errors += 1
+                self._filtre = None
+
+    def instantania(self) -> Optional[Instantania]:
+        return self._instantania
+
+    ## Tasca de fons (s'inicia i s'atura amb el cicle de vida de l'aplicació)
+
+    async def _executar(self) -> None:
+        while True:
+            try:
+                await run_in_threadpool(self.actualitzar)
+            except Exception:
+                logger.exception("Error en la tasca de la llista de targetes bloquejades")
+            await asyncio.sleep(self.interval_segons)
+
+    def iniciar(self) -> None:
+        if self._tasca is None:
+            self._tasca = asyncio.create_task(self._executar())
+
+    async def aturar(self) -> None:
+        if self._tasca is not None:
+            self._tasca.cancel()
+            try:
+                await self._tasca
+            except asyncio.CancelledError:
+                pass
+            self._tasca = None
+
+    def metriques(self) -> dict:
+        instantania = self._instantania
+        return {
+            "elements": instantania.elements if instantania else None,
+            "bytes": len(instantania.dades) if instantania else None,
+            "cursor": instantania.cursor if instantania else None,
+            "reconstruccions": self.reconstruccions,
+            "errors": self.errors,
+        }
+
+
+llista_bloquejades = LlistaBloquejades(
+    BLOQUEJADES_INTERVAL_SEGONS, BLOQUEJADES_FALSOS_POSITIUS, BLOQUEJADES_CAPACITAT_MINIMA
+)
@@ -0,0 +1,317 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.config import DIRECTORI_APLICACIO
+
+'''
+Cache de lectura (read-through) per a les consultes de detall per ID (targetes i passatgers).
+
+Cada entrada caduca després de CACHE_TTL_SEGONS i, quan se supera CACHE_MAX_ENTRADES, s'expulsen les
+menys emprades recentment (LRU). Les rutes d'escriptura hi desen la fila nova llegida de la primària
+(o n'invaliden l'entrada si s'ha esborrat), de manera que una lectura posterior no depèn del retard de
+les rèpliques. Una escriptura feta des d'un altre worker amb el backend `memoria` només es veu quan
+caduca l'entrada, per això el TTL és el retard màxim en aquest cas.
+
+Es pot triar el backend amb la variable d'entorn CACHE_BACKEND:
+- memoria: OrderedDict del procés. Cada worker té la seva cache
+- compartit: fitxer SQLite local (CACHE_FITXER) compartit per tots els workers de la mateixa màquina.
+  Les consultes al fitxer es fan al threadpool perquè no aturin el bucle d'esdeveniments
+- desactivada: totes les lectures van a la base de dades
+'''
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memoria")
+CACHE_FITXER = os.getenv("CACHE_FITXER", os.path.join(DIRECTORI_APLICACIO, "cache.sqlite3"))
+CACHE_TTL_SEGONS = float(os.getenv("CACHE_TTL_SEGONS", 30))
+CACHE_MAX_ENTRADES = int(os.getenv("CACHE_MAX_ENTRADES", 10000))
+
+# Valor que retornen els backends quan la clau no hi és o ha caducat (None és un valor vàlid)
+ABSENT = object()
+
+
+class BackendCache(ABC):
+    # Indica si les operacions fan E/S i, per tant, s'han d'executar fora del bucle d'esdeveniments
+    bloquejant = False
+
+    def __init__(self):
+        self.expulsions = 0
+
+    # Retorna el valor desat o ABSENT si no hi és o ha caducat
+    @abstractmethod
+    def obtenir(self, clau: str) -> Any:
+        ...
+
+    @abstractmethod
+    def desar(self, clau: str, valor: Any, ttl_segons: float) -> None:
+        ...
+
+    @abstractmethod
+    def invalidar(self, clau: str) -> None:
+        ...
+
+    @abstractmethod
+    def entrades(self) -> int:
+        ...
+
+
+## Backend en memòria
+
+class CacheMemoria(BackendCache):
+    def __init__(self, max_entrades: int):
+        super().__init__()
+        self.max_entrades = max_entrades
+        self._lock = threading.Lock()
+        # clau -> (valor, instant d'expiració (monotonic)). L'ordre és el d'ús: la primera és la menys recent
+        self._entrades: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+
+    def obtenir(self, clau: str) -> Any:
+        with self._lock:
+            entrada = self._entrades.get(clau)
+            if entrada is None:
+                return ABSENT
+            if time.monotonic() > entrada[1]:
+                del self._entrades[clau]
+                return ABSENT
+            self._entrades.move_to_end(clau)
+            return entrada[0]
+
+    def desar(self, clau: str, valor: Any, ttl_segons: float) -> None:
+        with self._lock:
+            self._entrades[clau] = (valor, time.monotonic() + ttl_segons)
+            self._entrades.move_to_end(clau)
+            while len(self._entrades) > self.max_entrades:
+                self._entrades.popitem(last=False)
+                self.expulsions += 1
+
+    def invalidar(self, clau: str) -> None:
+        with self._lock:
+            self._entrades.pop(clau, None)
+
+    def entrades(self) -> int:
+        with self._lock:
+            return len(self._entrades)
+
+
+## Backend compartit entre workers (SQLite local)
+
+# Els valors són files de la base de dades (tuples d'escalars). Es desen en JSON, marcant els tipus que JSON
+# no té (Decimal i datetime), i les llistes es tornen a convertir en tuples en llegir-les
+def _json_per_defecte(valor: Any) -> Any:
+    if isinstance(valor, Decimal):
+        return {"__decimal__": str(valor)}
+    if isinstance(valor, datetime):
+        return {"__datetime__": valor.isoformat()}
+    if isinstance(valor, date):
+        return {"__date__": valor.isoformat()}
+    raise TypeError(f"No es pot desar a la cache un valor de tipus {type(valor).__name__}")
+
+
+def _json_objecte(objecte: dict) -> Any:
+    if "__decimal__" in objecte:
+        return Decimal(objecte["__decimal__"])
+    if "__datetime__" in objecte:
+        return datetime.fromisoformat(objecte["__datetime__"])
+    if "__date__" in objecte:
+        return date.fromisoformat(objecte["__date__"])
+    return objecte
+
+
+def _serialitzar(valor: Any) -> str:
+    return json.dumps(valor, default=_json_per_defecte, separators=(",", ":"))
+
+
+def _deserialitzar(text: str) -> Any:
+    valor = json.loads(text, object_hook=_json_objecte)
+    return tuple(valor) if isinstance(valor, list) else valor
+
+
+class CacheCompartida(BackendCache):
+    bloquejant = True
+
+    def __init__(self, fitxer: str, max_entrades: int):
+        super().__init__()
+        self.max_entrades = max_entrades
+        self._fitxer = fitxer
+        conn = self._connectar()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "clau TEXT PRIMARY KEY, valor TEXT NOT NULL, expiracio REAL NOT NULL, us REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_us ON cache (us)")
+        finally:
+            conn.close()
+
+    def _connectar(self) -> sqlite3.Connection:
+        # isolation_level=None per a controlar les transaccions amb BEGIN IMMEDIATE
+        conn = sqlite3.connect(self._fitxer, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def obtenir(self, clau: str) -> Any:
+        ara = time.time()
+        conn = self._connectar()
+        try:
+            fila = conn.execute(
+                "SELECT valor, expiracio FROM cache WHERE clau = ?", (clau,)
+            ).fetchone()
+            if fila is None:
+                return ABSENT
+            if ara > fila[1]:
+                conn.execute("DELETE FROM cache WHERE clau = ? AND expiracio = ?", (clau, fila[1]))
+                return ABSENT
+            # Es marca l'ús per a l'ordre LRU
+            conn.execute("UPDATE cache SET us = ? WHERE clau = ?", (ara, clau))
+            try:
+                return _deserialitzar(fila[0])
+            except ValueError:
+                # Entrada en un format que no és el d'aquesta versió: es tracta com si no hi fos
+                conn.execute("DELETE FROM cache WHERE clau = ?", (clau,))
+                return ABSENT
+        finally:
+            conn.close()
+
+    def desar(self, clau: str, valor: Any, ttl_segons: float) -> None:
+        ara = time.time()
+        conn = self._connectar()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (clau, valor, expiracio, us) VALUES (?, ?, ?, ?)",
+                (clau, _serialitzar(valor), ara + ttl_segons, ara)
+            )
+            sobrants = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entrades
+            if sobrants > 0:
+                conn.execute(
+                    "DELETE FROM cache WHERE clau IN (SELECT clau FROM cache ORDER BY us LIMIT ?)",
+                    (sobrants,)
+                )
+                self.expulsions += sobrants
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def invalidar(self, clau: str) -> None:
+        conn = self._connectar()
+        try:
+            conn.execute("DELETE FROM cache WHERE clau = ?", (clau,))
+        finally:
+            conn.close()
+
+    def entrades(self) -> int:
+        conn = self._connectar()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        finally:
+            conn.close()
+
+
+## Cache de lectura d'un tipus de fila (un espai de claus per nom)
+
+class CacheLectura:
+    def __init__(self, nom: str, backend: Optional[BackendCache], ttl_segons: float):
+        self.nom = nom
+        self.backend = backend
+        self.ttl_segons = ttl_segons
+        self.encerts = 0
+        self.errades = 0
+        # S'incrementa amb cada escriptura. Una càrrega que ha començat abans d'una escriptura no desa el seu
+        # resultat, perquè podria ser la fila anterior a l'escriptura (llegida d'una rèplica o abans del commit)
+        self._versio = 0
+        # Les escriptures al backend poden venir de diversos fils: la comprovació de la versió i el desat van junts
+        self._lock = threading.Lock()
+
+    def _clau(self, clau: Hashable) -> str:
+        return f"{self.nom}:{clau}"
+
+    # Retorna el valor de la cache o l'obté amb 'carregar' i el desa. Els valors None (no trobats) no es desen
+    async def obtenir(self, clau: Hashable, carregar: Callable[[], Awaitable[Any]]) -> Any:
+        if self.backend is None:
+            self.errades += 1
+            return await carregar()
+
+        # La versió es llegeix abans de consultar la cache: una escriptura posterior descarta el que es carregui
+        versio = self._versio
+        if self.backend.bloquejant:
+            valor = await run_in_threadpool(self.backend.obtenir, self._clau(clau))
+        else:
+            valor = self.backend.obtenir(self._clau(clau))
+        if valor is not ABSENT:
+            self.encerts += 1
+            return valor
+
+        self.errades += 1
+        valor = await carregar()
+        if valor is not None and versio == self._versio:
+            if self.backend.bloquejant:
+                await run_in_threadpool(self._desar_si_vigent, clau, valor, versio)
+            else:
+                self._desar_si_vigent(clau, valor, versio)
+        return valor
+
+    def _desar_si_vigent(self, clau: Hashable, valor: Any, versio: int) -> None:
+        with self._lock:
+            if versio == self._versio:
+                self.backend.desar(self._clau(clau), valor, self.ttl_segons)
+
+    # Les rutes d'escriptura hi desen la fila nova després del commit
+    # Amb el backend compartit accedeixen al fitxer: des d'una ruta async s'han de cridar amb run_in_threadpool
+    def actualitzar(self, clau: Hashable, valor: Any) -> None:
+        with self._lock:
+            self._versio += 1
+            if self.backend is not None:
+                self.backend.desar(self._clau(clau), valor, self.ttl_segons)
+
+    def invalidar(self, clau: Hashable) -> None:
+        with self._lock:
+            self._versio += 1
+            if self.backend is not None:
+                self.backend.invalidar(self._clau(clau))
+
+    def metriques(self) -> dict:
+        consultes = self.encerts + self.errades
+        return {
+            "encerts": self.encerts,
+            "errades": self.errades,
+            "taxa_encerts": round(self.encerts / consultes, 4) if consultes else None,
+        }
+
+
+def _crear_backend(backend: str) -> Optional[BackendCache]:
+    if backend == "memoria":
+        return CacheMemoria(CACHE_MAX_ENTRADES)
+    if backend == "compartit":
+        return CacheCompartida(CACHE_FITXER, CACHE_MAX_ENTRADES)
+    if backend == "desactivada":
+        return None
+    raise ValueError(f"CACHE_BACKEND no vàlid: '{backend}' (memoria, compartit o desactivada)")
+
+
+backend_cache = _crear_backend(CACHE_BACKEND)
+
+# Registre de totes les caches de lectura, per a exportar-ne les mètriques
+caches: dict[str, CacheLectura] = {}
+
+
+def cache_lectura(nom: str) -> CacheLectura:
+    if nom not in caches:
+        caches[nom] = CacheLectura(nom, backend_cache, CACHE_TTL_SEGONS)
+    return caches[nom]
+
+
+def metriques_cache() -> dict:
+    return {
+        "backend": CACHE_BACKEND,
+        "entrades": backend_cache.entrades() if backend_cache is not None else 0,
+        "expulsions": backend_cache.expulsions if backend_cache is not None else 0,
+        "caches": {nom: cache.metriques() for nom, cache in caches.items()},
+    }
@@ -0,0 +1,93 @@
+import os
+from datetime import datetime, timedelta
+
+from app.db.database import get_db_connection
+
+'''
+Registre de canvis d'estat de les targetes, perquè les validadores es puguin sincronitzar per deltes.
+
+Cada vegada que es crea una targeta o se'n canvia l'estat, s'afegeix una fila a `canvi_targeta` dins la mateixa
+transacció. La versió surt del comptador `comptador_canvis`: l'UPDATE bloqueja la fila fins al commit, per això
+les versions es confirmen en ordre i un dispositiu que ja ha llegit la versió N no en pot veure aparèixer cap de menor.
+Cada shard té el seu propi registre i comptador. El cursor d'un dispositiu és la darrera versió de cada shard,
+separades per punts (amb un sol shard, un enter).
+
+Els dispositius que s'identifiquen desen el seu cursor a `dispositiu_canvis` en acabar cada sincronització, amb
+l'identificador prefixat per l'ID de l'usuari (`<id usuari>:<dispositiu>`). La compactació
+(scripts/compactar_canvis_targeta.py) esborra les entrades que ja han passat tots els dispositius actius i que
+tenen una entrada posterior de la mateixa targeta. Sempre es conserva la darrera de cada targeta, per això un
+dispositiu nou o que fa més de CANVIS_DISPOSITIU_INACTIU_DIES que no es sincronitza (i no es té en compte)
+pot començar des de 0 i acaba amb l'estat actual de totes les targetes.
+'''
+
+CANVIS_DISPOSITIU_INACTIU_DIES = int(os.getenv("CANVIS_DISPOSITIU_INACTIU_DIES", 30))
+
+
+# Afegeix l'estat actual de la targeta al registre. S'ha de cridar abans del commit de la transacció que l'ha modificat
+def registrar_canvi(cursor, id_targeta: int) -> None:
+    cursor.execute("UPDATE comptador_canvis SET versio = LAST_INSERT_ID(versio + 1) WHERE id = 1")
+    cursor.execute(
+        """
+        INSERT INTO canvi_targeta (versio, id_targeta, codi_targeta, estat, data_canvi)
+        SELECT LAST_INSERT_ID(), id, codi_targeta, estat, %s FROM targeta WHERE id = %s
+        """,
+        (datetime.utcnow(), id_targeta)
+    )
+
+# Desa fins on s'ha sincronitzat un dispositiu en un shard (mai no fa enrere el cursor)
+def desar_cursor_dispositiu(shard: int, id_dispositiu: str, versio: int) -> None:
+    with get_db_connection(shard) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """
+                INSERT INTO dispositiu_canvis (id_dispositiu, versio, data_sincronitzacio)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    versio = GREATEST(versio, VALUES(versio)),
+                    data_sincronitzacio = VALUES(data_sincronitzacio)
+                """,
+                (id_dispositiu, versio, datetime.utcnow())
+            )
+            conn.commit()
+        finally:
+            cursor.close()
+
+# Esborra les entrades que tots els dispositius actius ja han passat i que una entrada posterior substitueix.
+# Retorna el nombre d'entrades esborrades
+def compactar(shard: int) -> int:
+    limit_actius = datetime.utcnow() - timedelta(days=CANVIS_DISPOSITIU_INACTIU_DIES)
+    with get_db_connection(shard) as conn:
+        cursor = conn.cursor()
+        try:
+            # Sense dispositius actius, es pot compactar fins a la darrera versió
+            cursor.execute(
+                """
+                SELECT COALESCE(
+                    (SELECT MIN(versio) FROM dispositiu_canvis WHERE data_sincronitzacio >= %s),
+                    (SELECT versio FROM comptador_canvis WHERE id = 1)
+                )
+                """,
+                (limit_actius,)
+            )
+            fins_a = cursor.fetchone()[0]
+
+            cursor.execute(
+                """
+                DELETE c FROM canvi_targeta c
+                JOIN canvi_targeta posterior
+                    ON posterior.id_targeta = c.id_targeta AND posterior.versio > c.versio
+                WHERE c.versio <= %s
+                """,
+                (fins_a,)
+            )
+            esborrades = cursor.rowcount
+
+            cursor.execute(
+                "DELETE FROM dispositiu_canvis WHERE data_sincronitzacio < %s",
+                (limit_actius,)
+            )
+            conn.commit()
+            return esborrades
+        finally:
+            cursor.close()
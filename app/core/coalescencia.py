@@ -0,0 +1,62 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+'''
+Coalescència de lectures concurrents idèntiques (single-flight).
+
+Quan arriben diverses peticions iguals alhora (mateix grup i mateixa clau), només la primera executa la consulta
+o el renderitzat. La resta esperen el mateix resultat (o la mateixa excepció). Un cop acabada, la següent petició
+torna a executar-se, de manera que no s'afegeix cap cache ni cap retard.
+
+Cada ruta empra el seu grup i es pot desactivar amb COALESCENCIA_DESACTIVADA (noms separats per comes).
+'''
+
+COALESCENCIA_DESACTIVADA = {
+    nom.strip() for nom in os.getenv("COALESCENCIA_DESACTIVADA", "").split(",") if nom.strip()
+}
+
+T = TypeVar("T")
+
+
+class GrupCoalescencia:
+    def __init__(self, nom: str, activat: bool = True):
+        self.nom = nom
+        self.activat = activat
+        self.execucions = 0
+        self.coalescides = 0
+        self._en_curs: dict[Hashable, asyncio.Future] = {}
+
+    async def fer(self, clau: Hashable, funcio: Callable[[], Awaitable[T]]) -> T:
+        if not self.activat:
+            self.execucions += 1
+            return await funcio()
+
+        tasca = self._en_curs.get(clau)
+        if tasca is None:
+            # La feina s'executa en una tasca pròpia: si el client que l'ha iniciada es desconnecta, la resta continuen esperant
+            tasca = asyncio.ensure_future(funcio())
+            self._en_curs[clau] = tasca
+            tasca.add_done_callback(lambda _: self._en_curs.pop(clau, None))
+            self.execucions += 1
+        else:
+            self.coalescides += 1
+        return await asyncio.shield(tasca)
+
+    def metriques(self) -> dict:
+        return {
+            "activat": self.activat,
+            "execucions": self.execucions,
+            "coalescides": self.coalescides,
+            "en_curs": len(self._en_curs),
+        }
+
+
+grups: dict[str, GrupCoalescencia] = {}
+
+
+# Crea (o retorna) el grup amb aquest nom, activat segons COALESCENCIA_DESACTIVADA
+def grup_coalescencia(nom: str) -> GrupCoalescencia:
+    if nom not in grups:
+        grups[nom] = GrupCoalescencia(nom, activat=nom not in COALESCENCIA_DESACTIVADA)
+    return grups[nom]
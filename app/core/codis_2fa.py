@@ -0,0 +1,244 @@
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+import time
+from datetime import datetime, timedelta
+from enum import Enum
+
+import pymysql
+
+from app.core.config import DIRECTORI_APLICACIO
+from app.db.database import get_db_connection
+from app.db.sharding import shard_de_id
+
+'''
+Emmagatzematge dels codis 2FA pendents de verificar.
+
+Cada passatger té com a molt un codi pendent. Consumir un codi és una operació atòmica: si coincideix s'esborra,
+i si no coincideix se suma un intent. Quan s'arriba a MAX_INTENTS_2FA el codi queda invalidat.
+
+Es pot triar el backend amb la variable d'entorn CODIS_2FA_BACKEND:
+- memoria: diccionari del procés amb TTL. No fa cap escriptura a la base de dades, però només serveix amb un worker
+- compartit: fitxer SQLite local compartit per tots els workers de la mateixa màquina
+- sql: la taula `2fa` de MariaDB (comportament anterior), al shard del passatger
+'''
+
+MAX_INTENTS_2FA = int(os.getenv("MAX_INTENTS_2FA", 5))
+CODIS_2FA_BACKEND = os.getenv("CODIS_2FA_BACKEND", "memoria")
+CODIS_2FA_FITXER = os.getenv("CODIS_2FA_FITXER", os.path.join(DIRECTORI_APLICACIO, "codis_2fa.sqlite3"))
+
+
+class ResultatConsum(str, Enum):
+    correcte   = "correcte"
+    incorrecte = "incorrecte"
+    caducat    = "caducat"
+    inexistent = "inexistent"
+    bloquejat  = "bloquejat"
+
+
+class MagatzemCodis(ABC):
+    # Desa el codi d'un passatger, substituint el que tingués pendent
+    @abstractmethod
+    def desar(self, id_passatger: int, codi: int, validesa: timedelta) -> None:
+        ...
+
+    # Compara i consumeix el codi d'un passatger de forma atòmica
+    @abstractmethod
+    def consumir(self, id_passatger: int, codi: int) -> ResultatConsum:
+        ...
+
+
+## Backend en memòria
+
+class MagatzemMemoria(MagatzemCodis):
+    # Cada quantes escriptures es fa neteja dels codis caducats
+    NETEJA_CADA = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # id_passatger -> [codi, instant d'expiració (monotonic), intents]
+        self._codis: dict[int, list] = {}
+        self._escriptures = 0
+
+    def desar(self, id_passatger: int, codi: int, validesa: timedelta) -> None:
+        ara = time.monotonic()
+        with self._lock:
+            self._codis[id_passatger] = [codi, ara + validesa.total_seconds(), 0]
+            self._escriptures += 1
+            if self._escriptures % self.NETEJA_CADA == 0:
+                self._codis = {k: v for k, v in self._codis.items() if v[1] > ara}
+
+    def consumir(self, id_passatger: int, codi: int) -> ResultatConsum:
+        with self._lock:
+            pendent = self._codis.get(id_passatger)
+            if pendent is None:
+                return ResultatConsum.inexistent
+            if time.monotonic() > pendent[1]:
+                del self._codis[id_passatger]
+                return ResultatConsum.caducat
+            if pendent[0] == codi:
+                del self._codis[id_passatger]
+                return ResultatConsum.correcte
+            pendent[2] += 1
+            if pendent[2] >= MAX_INTENTS_2FA:
+                del self._codis[id_passatger]
+                return ResultatConsum.bloquejat
+            return ResultatConsum.incorrecte
+
+
+## Backend compartit entre workers (SQLite local)
+
+class MagatzemCompartit(MagatzemCodis):
+    def __init__(self, fitxer: str):
+        self._fitxer = fitxer
+        conn = self._connectar()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS codi_2fa ("
+                "id_passatger INTEGER PRIMARY KEY, codi INTEGER NOT NULL, "
+                "expiracio REAL NOT NULL, intents INTEGER NOT NULL DEFAULT 0)"
+            )
+        finally:
+            conn.close()
+        # Els codis es desen en clar: només els ha de poder llegir l'usuari de l'aplicació
+        # SQLite crea els fitxers -wal i -shm amb els mateixos permisos que la base de dades
+        os.chmod(fitxer, 0o600)
+
+    def _connectar(self) -> sqlite3.Connection:
+        # isolation_level=None per a controlar les transaccions amb BEGIN IMMEDIATE
+        conn = sqlite3.connect(self._fitxer, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def desar(self, id_passatger: int, codi: int, validesa: timedelta) -> None:
+        ara = time.time()
+        conn = self._connectar()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM codi_2fa WHERE expiracio < ?", (ara,))
+            conn.execute(
+                "INSERT OR REPLACE INTO codi_2fa (id_passatger, codi, expiracio, intents) VALUES (?, ?, ?, 0)",
+                (id_passatger, codi, ara + validesa.total_seconds())
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def consumir(self, id_passatger: int, codi: int) -> ResultatConsum:
+        conn = self._connectar()
+        try:
+            # BEGIN IMMEDIATE bloqueja les escriptures d'altres workers fins al COMMIT
+            conn.execute("BEGIN IMMEDIATE")
+            pendent = conn.execute(
+                "SELECT codi, expiracio, intents FROM codi_2fa WHERE id_passatger = ?",
+                (id_passatger,)
+            ).fetchone()
+
+            if pendent is None:
+                resultat = ResultatConsum.inexistent
+            elif time.time() > pendent[1]:
+                resultat = ResultatConsum.caducat
+            elif pendent[0] == codi:
+                resultat = ResultatConsum.correcte
+            elif pendent[2] + 1 >= MAX_INTENTS_2FA:
+                resultat = ResultatConsum.bloquejat
+            else:
+                resultat = ResultatConsum.incorrecte
+
+            if resultat == ResultatConsum.incorrecte:
+                conn.execute(
+                    "UPDATE codi_2fa SET intents = intents + 1 WHERE id_passatger = ?",
+                    (id_passatger,)
+                )
+            elif resultat != ResultatConsum.inexistent:
+                conn.execute("DELETE FROM codi_2fa WHERE id_passatger = ?", (id_passatger,))
+            conn.execute("COMMIT")
+            return resultat
+        finally:
+            conn.close()
+
+
+## Backend SQL (taula `2fa`)
+
+class MagatzemSql(MagatzemCodis):
+    def desar(self, id_passatger: int, codi: int, validesa: timedelta) -> None:
+        ara = datetime.utcnow()
+        with get_db_connection(shard_de_id(id_passatger)) as conn:
+            cursor = conn.cursor()
+            try:
+                # S'invaliden els codis previs del passatger i es desa el nou
+                cursor.execute(
+                    "DELETE FROM `2fa` WHERE id_passatger = %s",
+                    (id_passatger,)
+                )
+                cursor.execute(
+                    """
+                    INSERT INTO `2fa` (id_passatger, codi, data_creacio, data_expiracio, intents)
+                    VALUES (%s, %s, %s, %s, 0)
+                    """,
+                    (id_passatger, codi, ara, ara + validesa)
+                )
+                conn.commit()
+            finally:
+                cursor.close()
+
+    def consumir(self, id_passatger: int, codi: int) -> ResultatConsum:
+        with get_db_connection(shard_de_id(id_passatger)) as conn:
+            cursor = conn.cursor()
+            try:
+                # FOR UPDATE bloqueja la fila fins al commit, de manera que dues verificacions simultànies no poden consumir el mateix codi
+                cursor.execute(
+                    """
+                    SELECT id, codi, data_expiracio, intents
+                    FROM `2fa`
+                    WHERE id_passatger = %s
+                    ORDER BY data_creacio DESC
+                    LIMIT 1
+                    FOR UPDATE
+                    """,
+                    (id_passatger,)
+                )
+                pendent = cursor.fetchone()
+
+                if pendent is None:
+                    conn.rollback()
+                    return ResultatConsum.inexistent
+
+                id_2fa, codi_bd, data_expiracio, intents = pendent
+                if datetime.utcnow() > data_expiracio:
+                    resultat = ResultatConsum.caducat
+                elif int(codi_bd) == codi:
+                    resultat = ResultatConsum.correcte
+                elif intents + 1 >= MAX_INTENTS_2FA:
+                    resultat = ResultatConsum.bloquejat
+                else:
+                    resultat = ResultatConsum.incorrecte
+
+                if resultat == ResultatConsum.incorrecte:
+                    cursor.execute(
+                        "UPDATE `2fa` SET intents = intents + 1 WHERE id = %s",
+                        (id_2fa,)
+                    )
+                else:
+                    cursor.execute("DELETE FROM `2fa` WHERE id = %s", (id_2fa,))
+                conn.commit()
+                return resultat
+            except pymysql.Error:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+
+def _crear_magatzem(backend: str) -> MagatzemCodis:
+    if backend == "memoria":
+        return MagatzemMemoria()
+    if backend == "compartit":
+        return MagatzemCompartit(CODIS_2FA_FITXER)
+    if backend == "sql":
+        return MagatzemSql()
+    raise ValueError(f"CODIS_2FA_BACKEND no vàlid: '{backend}' (memoria, compartit o sql)")
+
+
+magatzem_codis = _crear_magatzem(CODIS_2FA_BACKEND)
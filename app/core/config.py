@@ -2,8 +2,14 @@
 from dotenv import load_dotenv
 import pymysql
 
+from app.core.traces import CursorTracat
+
 load_dotenv()
 
+# Directori arrel de l'aplicació. Els fitxers locals (cache i codis 2FA compartits) s'hi desen per defecte, i no a
+# /tmp, on qualsevol altre usuari de la màquina els podria crear abans, llegir o modificar
+DIRECTORI_APLICACIO = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 # Configuració de la base de dades (es reb des de les variables d'entorn)
 DB_CONFIG = {
     "host": os.getenv("MARIADB_HOST"),
@@ -12,9 +18,38 @@
     "password": os.getenv("MARIADB_PASSWORD"),
     "database": os.getenv("MARIADB_DATABASE"),
     "charset": "utf8mb4",
-    "cursorclass": pymysql.cursors.Cursor
+    # Cursor de pymysql que obre un span per consulta a les peticions mostrejades (vegeu app/core/traces.py)
+    "cursorclass": CursorTracat
 }
 
+# Converteix una llista "host:port" separada per comes en configuracions de connexió.
+# Tots els nodes comparteixen usuari, contrasenya i base de dades amb la primària
+def _nodes(llista: str) -> list[dict]:
+    return [
+        {
+            **DB_CONFIG,
+            "host": node.strip().rsplit(":", 1)[0],
+            "port": int(node.strip().rsplit(":", 1)[1]) if ":" in node else DB_CONFIG["port"],
+        }
+        for node in llista.split(",")
+        if node.strip()
+    ]
+
+# Rèpliques de lectura (opcionals) de la primària
+DB_REPLICAS = _nodes(os.getenv("MARIADB_REPLICAS", ""))
+
+# Shards (opcionals). El shard 0 és sempre la primària, que també conté les taules globals (user, validacio
+# i els directoris). MARIADB_SHARDS afegeix els nodes dels shards 1, 2, ... Sense shards addicionals tot va a la primària
+DB_SHARDS = [DB_CONFIG] + _nodes(os.getenv("MARIADB_SHARDS", ""))
+
+# Les files amb ID fins a aquest valor són anteriors als shards i continuen a la primària
+DB_SHARDS_ID_INICIAL = int(os.getenv("MARIADB_SHARDS_ID_INICIAL", 0))
+
+# Retard màxim de replicació acceptat abans d'enviar les lectures a la primària,
+# i cada quant es torna a comprovar el retard d'una rèplica
+DB_REPLICA_MAX_RETARD_SEGONS = int(os.getenv("MARIADB_REPLICA_MAX_RETARD_SEGONS", 5))
+DB_REPLICA_COMPROVACIO_SEGONS = int(os.getenv("MARIADB_REPLICA_COMPROVACIO_SEGONS", 2))
+
 # Clau secreta per a encriptar sessions i validesa de les mateixes
 SECRET_KEY = os.getenv("SECRET_KEY",)
 ALGORITHM = "HS256"
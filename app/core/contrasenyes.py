@@ -0,0 +1,92 @@
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+
+import bcrypt
+
+'''
+Política de hash de les contrasenyes dels usuaris de la plataforma.
+
+L'algorisme i el cost es configuren amb variables d'entorn:
+- CONTRASENYES_ALGORISME: bcrypt (per defecte) o scrypt (memory-hard, de hashlib)
+- CONTRASENYES_BCRYPT_RONDES: log2 del nombre d'iteracions de bcrypt
+- CONTRASENYES_SCRYPT_LN, CONTRASENYES_SCRYPT_R i CONTRASENYES_SCRYPT_P: paràmetres de scrypt (N = 2^LN).
+  La memòria emprada és 128 * R * 2^LN bytes (32 MiB amb els valors per defecte)
+Els valors adequats per al maquinari on s'executa l'API es poden mesurar amb scripts/calibrar_hash.py.
+
+La verificació accepta tots els formats suportats, independentment de la política actual:
+- bcrypt: $2b$<rondes>$... (també $2a$ i $2y$)
+- scrypt: $scrypt$ln=<ln>,r=<r>,p=<p>$<sal en base64>$<hash en base64>
+Quan un usuari inicia sessió amb una contrasenya desada amb un altre algorisme o cost, el hash es torna a
+calcular amb la política actual (vegeu `authenticate_user`). Així es pot canviar de política sense migracions.
+'''
+
+CONTRASENYES_ALGORISME = os.getenv("CONTRASENYES_ALGORISME", "bcrypt")
+CONTRASENYES_BCRYPT_RONDES = int(os.getenv("CONTRASENYES_BCRYPT_RONDES", 12))
+CONTRASENYES_SCRYPT_LN = int(os.getenv("CONTRASENYES_SCRYPT_LN", 15))
+CONTRASENYES_SCRYPT_R = int(os.getenv("CONTRASENYES_SCRYPT_R", 8))
+CONTRASENYES_SCRYPT_P = int(os.getenv("CONTRASENYES_SCRYPT_P", 1))
+
+SCRYPT_SAL_BYTES = 16
+SCRYPT_HASH_BYTES = 32
+
+_BCRYPT = re.compile(r"\$2[aby]\$(\d{2})\$.{53}")
+_SCRYPT = re.compile(r"\$scrypt\$ln=(\d+),r=(\d+),p=(\d+)\$([A-Za-z0-9+/]+)\$([A-Za-z0-9+/]+)")
+
+## Helpers
+
+def _b64(dades: bytes) -> str:
+    return base64.b64encode(dades).decode("ascii").rstrip("=")
+
+def _des_b64(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+def _scrypt(contrasenya: str, sal: bytes, ln: int, r: int, p: int) -> bytes:
+    # hashlib limita la memòria a 32 MiB si no s'indica maxmem, just el que necessiten els valors per defecte
+    return hashlib.scrypt(
+        contrasenya.encode("utf-8"), salt=sal, n=2 ** ln, r=r, p=p,
+        maxmem=128 * r * (2 ** ln + p + 2) + 1024 * 1024, dklen=SCRYPT_HASH_BYTES
+    )
+
+def hash_bcrypt(contrasenya: str, rondes: int) -> str:
+    return bcrypt.hashpw(contrasenya.encode("utf-8"), bcrypt.gensalt(rounds=rondes)).decode("utf-8")
+
+def hash_scrypt(contrasenya: str, ln: int, r: int, p: int) -> str:
+    sal = secrets.token_bytes(SCRYPT_SAL_BYTES)
+    return f"$scrypt$ln={ln},r={r},p={p}${_b64(sal)}${_b64(_scrypt(contrasenya, sal, ln, r, p))}"
+
+
+# Calcula el hash d'una contrasenya amb la política actual
+def calcular_hash(contrasenya: str) -> str:
+    if CONTRASENYES_ALGORISME == "bcrypt":
+        return hash_bcrypt(contrasenya, CONTRASENYES_BCRYPT_RONDES)
+    if CONTRASENYES_ALGORISME == "scrypt":
+        return hash_scrypt(contrasenya, CONTRASENYES_SCRYPT_LN, CONTRASENYES_SCRYPT_R, CONTRASENYES_SCRYPT_P)
+    raise ValueError(f"CONTRASENYES_ALGORISME no vàlid: '{CONTRASENYES_ALGORISME}' (bcrypt o scrypt)")
+
+# Comprova una contrasenya contra un hash de qualsevol format suportat. Un format desconegut no és vàlid
+def verificar(contrasenya: str, hash_desat: str) -> bool:
+    if _BCRYPT.fullmatch(hash_desat):
+        return bcrypt.checkpw(contrasenya.encode("utf-8"), hash_desat.encode("utf-8"))
+
+    coincidencia = _SCRYPT.fullmatch(hash_desat)
+    if coincidencia:
+        ln, r, p = (int(v) for v in coincidencia.group(1, 2, 3))
+        calculat = _scrypt(contrasenya, _des_b64(coincidencia.group(4)), ln, r, p)
+        return hmac.compare_digest(calculat, _des_b64(coincidencia.group(5)))
+
+    return False
+
+# Indica si un hash (ja verificat) s'ha de tornar a calcular perquè no segueix la política actual
+def necessita_rehash(hash_desat: str) -> bool:
+    if CONTRASENYES_ALGORISME == "bcrypt":
+        coincidencia = _BCRYPT.fullmatch(hash_desat)
+        return coincidencia is None or int(coincidencia.group(1)) != CONTRASENYES_BCRYPT_RONDES
+
+    coincidencia = _SCRYPT.fullmatch(hash_desat)
+    return coincidencia is None or tuple(int(v) for v in coincidencia.group(1, 2, 3)) != (
+        CONTRASENYES_SCRYPT_LN, CONTRASENYES_SCRYPT_R, CONTRASENYES_SCRYPT_P
+    )
@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional
+
+'''
+Agregats de la flota de targetes (comptadors per perfil i estat, saldo, targetes virtuals actives
+i passatgers amb sessió iniciada) mantinguts a memòria.
+
+Els comptadors es carreguen amb una sincronització completa (GROUP BY) i després els routers hi apliquen
+els canvis que fan a la base de dades. Com que cada worker només veu les seves escriptures, la sincronització
+completa es repeteix com a molt cada ESTADISTIQUES_MAX_ANTIGUITAT_SEGONS, que és el retard màxim garantit.
+'''
+
+ESTADISTIQUES_MAX_ANTIGUITAT_SEGONS = int(os.getenv("ESTADISTIQUES_MAX_ANTIGUITAT_SEGONS", 60))
+
+
+class Estadistiques:
+    def __init__(self, max_antiguitat_segons: int):
+        self.max_antiguitat_segons = max_antiguitat_segons
+        self._lock = threading.Lock()
+        self._sincronitzacio_lock = threading.Lock()
+        self._per_perfil: Counter = Counter()
+        self._per_estat: Counter = Counter()
+        self._saldo_total = Decimal("0.00")
+        self._targetes = 0
+        self._sessions = 0
+        # Expiració de la targeta virtual vigent de cada targeta mare (n'hi ha com a molt una per targeta)
+        self._virtuals: dict[int, datetime] = {}
+        self._sincronitzat: Optional[float] = None
+        self.data_sincronitzacio: Optional[datetime] = None
+
+    ## Sincronització completa
+
+    def caducades(self) -> bool:
+        with self._lock:
+            return (
+                self._sincronitzat is None
+                or time.monotonic() - self._sincronitzat > self.max_antiguitat_segons
+            )
+
+    # Recalcula tots els agregats des de la base de dades (una connexió per shard). Si un altre fil ja ho està fent, espera el seu resultat
+    def sincronitzar(self, connexions: list) -> None:
+        with self._sincronitzacio_lock:
+            if not self.caducades():
+                return
+
+            files_targeta = []
+            sessions = 0
+            virtuals: dict[int, datetime] = {}
+            for conn in connexions:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        "SELECT perfil, estat, COUNT(*), COALESCE(SUM(saldo), 0) "
+                        "FROM targeta GROUP BY perfil, estat"
+                    )
+                    files_targeta.extend(cursor.fetchall())
+                    cursor.execute(
+                        "SELECT COUNT(*) FROM passatger WHERE sessio_iniciada = TRUE"
+                    )
+                    sessions += cursor.fetchone()[0]
+                    cursor.execute(
+                        "SELECT id_targeta_mare, MAX(data_expiracio) FROM targeta_virtual "
+                        "WHERE data_expiracio > %s GROUP BY id_targeta_mare",
+                        (datetime.utcnow(),)
+                    )
+                    virtuals.update(cursor.fetchall())
+                finally:
+                    cursor.close()
+
+            per_perfil: Counter = Counter()
+            per_estat: Counter = Counter()
+            saldo_total = Decimal("0.00")
+            for perfil, estat, quantitat, saldo in files_targeta:
+                per_perfil[perfil] += quantitat
+                per_estat[estat] += quantitat
+                saldo_total += Decimal(saldo)
+
+            with self._lock:
+                self._per_perfil = per_perfil
+                self._per_estat = per_estat
+                self._saldo_total = saldo_total
+                self._targetes = sum(per_perfil.values())
+                self._sessions = sessions
+                self._virtuals = virtuals
+                self._sincronitzat = time.monotonic()
+                self.data_sincronitzacio = datetime.utcnow()
+
+    ## Canvis incrementals (els criden els routers després de fer commit)
+    # Mentre no hi ha hagut cap sincronització no es fa res, ja que la primera sincronització ho inclourà
+
+    def targeta_creada(self, perfil: str, estat: str, saldo: Decimal) -> None:
+        with self._lock:
+            if self._sincronitzat is None:
+                return
+            self._per_perfil[perfil] += 1
+            self._per_estat[estat] += 1
+            self._saldo_total += Decimal(saldo)
+            self._targetes += 1
+
+    def targeta_modificada(
+        self, estat_anterior: str, estat_nou: str, saldo_anterior: Decimal, saldo_nou: Decimal
+    ) -> None:
+        with self._lock:
+            if self._sincronitzat is None:
+                return
+            if estat_anterior != estat_nou:
+                self._per_estat[estat_anterior] -= 1
+                self._per_estat[estat_nou] += 1
+            self._saldo_total += Decimal(saldo_nou) - Decimal(saldo_anterior)
+
+    def targeta_virtual_creada(self, id_targeta_mare: int, data_expiracio: datetime) -> None:
+        with self._lock:
+            if self._sincronitzat is None:
+                return
+            self._virtuals[id_targeta_mare] = data_expiracio
+
+    def targeta_virtual_consumida(self, id_targeta_mare: int) -> None:
+        with self._lock:
+            self._virtuals.pop(id_targeta_mare, None)
+
+    def sessio_modificada(self, anterior: bool, nova: bool) -> None:
+        with self._lock:
+            if self._sincronitzat is None or bool(anterior) == bool(nova):
+                return
+            self._sessions += 1 if nova else -1
+
+    ## Lectura
+
+    def instantania(self) -> dict:
+        ara = datetime.utcnow()
+        with self._lock:
+            # Les targetes virtuals caducades es descarten en llegir
+            self._virtuals = {k: v for k, v in self._virtuals.items() if v > ara}
+            return {
+                "targetes_total": self._targetes,
+                "targetes_per_perfil": {k: v for k, v in self._per_perfil.items() if v},
+                "targetes_per_estat": {k: v for k, v in self._per_estat.items() if v},
+                "saldo_total": self._saldo_total,
+                "saldo_mitja": (
+                    (self._saldo_total / self._targetes).quantize(Decimal("0.01"))
+                    if self._targetes else Decimal("0.00")
+                ),
+                "targetes_virtuals_actives": len(self._virtuals),
+                "passatgers_amb_sessio": self._sessions,
+                "data_sincronitzacio": self.data_sincronitzacio,
+                "max_antiguitat_segons": self.max_antiguitat_segons,
+            }
+
+
+estadistiques = Estadistiques(ESTADISTIQUES_MAX_ANTIGUITAT_SEGONS)
@@ -0,0 +1,31 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Optional
+
+'''
+Helpers per a peticions HTTP condicionals (ETag / If-None-Match) i capçaleres de cache.
+Els ETag són forts i es calculen a partir de l'estat de la fila retornada, de manera que
+qualsevol canvi a la base de dades en genera un de nou.
+'''
+
+## Helpers
+
+# Calcula un ETag fort a partir dels valors d'una fila de la base de dades
+def calcular_etag(*valors) -> str:
+    contingut = "\x1f".join("" if v is None else str(v) for v in valors)
+    return '"' + hashlib.sha256(contingut.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+# Comprova si l'ETag actual coincideix amb algun dels de la capçalera If-None-Match
+def etag_coincideix(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidats = [c.strip() for c in if_none_match.split(",")]
+    # Comparació feble (RFC 9110): un ETag W/"x" del client també val per a "x"
+    return "*" in candidats or etag in candidats or f"W/{etag}" in candidats
+
+
+# Formata una data UTC (sense zona horària, com les desa MariaDB) en format de capçalera HTTP
+def format_data_http(data: datetime) -> str:
+    return format_datetime(data.replace(tzinfo=timezone.utc), usegmt=True)
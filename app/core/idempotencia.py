@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+'''
+Suport de la capçalera Idempotency-Key per a les peticions POST.
+
+Si un client repeteix una petició POST amb la mateixa Idempotency-Key (per exemple, perquè la primera ha fet timeout),
+no es torna a executar: es retorna la resposta desada de la primera. Les claus s'associen a qui fa la petició
+(capçalera Authorization) i a la petició en si (mètode, ruta, query i cos). Si es reutilitza una clau amb una petició
+diferent es retorna 422, i si la primera petició encara s'està executant, 409.
+
+El magatzem és a memòria de cada worker, té un nombre màxim de claus i descarta les caducades en cada inserció.
+Si és ple, es descarten les claus completades més antigues; les que encara s'estan executant no es descarten mai
+(el reintent tornaria a fer l'escriptura), i si totes ho estan la petició nova es rebutja amb 503.
+'''
+
+IDEMPOTENCIA_TTL_SEGONS = int(os.getenv("IDEMPOTENCIA_TTL_SEGONS", 86400))
+IDEMPOTENCIA_MAX_CLAUS = int(os.getenv("IDEMPOTENCIA_MAX_CLAUS", 10000))
+
+
+@dataclass
+class RespostaDesada:
+    status: int
+    headers: list
+    cos: bytes
+
+
+@dataclass
+class Entrada:
+    expiracio: float
+    empremta: str
+    resposta: Optional[RespostaDesada] = None
+
+
+# El magatzem és ple de peticions en curs i no es pot reservar cap clau nova
+class MagatzemPle(Exception):
+    pass
+
+
+class MagatzemIdempotencia:
+    def __init__(self, ttl_segons: int, max_claus: int):
+        self.ttl_segons = ttl_segons
+        self.max_claus = max_claus
+        # clau -> entrada. L'ordre és el d'inserció: la primera és la més antiga
+        self._entrades: OrderedDict[tuple, Entrada] = OrderedDict()
+
+    def _netejar(self, ara: float) -> None:
+        # Totes les entrades tenen el mateix TTL, per tant les més antigues són les primeres a caducar
+        while self._entrades:
+            clau, entrada = next(iter(self._entrades.items()))
+            if entrada.expiracio > ara:
+                break
+            del self._entrades[clau]
+
+        # Si encara és ple, es descarten les completades més antigues
+        sobrants = len(self._entrades) - self.max_claus + 1
+        if sobrants > 0:
+            completades = [clau for clau, entrada in self._entrades.items() if entrada.resposta is not None]
+            for clau in completades[:sobrants]:
+                del self._entrades[clau]
+
+    # Retorna l'entrada existent d'una clau, o en reserva una de nova (sense resposta) i retorna None
+    # Llança MagatzemPle si no hi ha lloc perquè totes les claus desades són de peticions en curs
+    def reservar(self, clau: tuple, empremta: str) -> Optional[Entrada]:
+        ara = time.monotonic()
+        entrada = self._entrades.get(clau)
+        if entrada is not None and entrada.expiracio > ara:
+            return entrada
+        self._entrades.pop(clau, None)
+        self._netejar(ara)
+        if len(self._entrades) >= self.max_claus:
+            raise MagatzemPle()
+        self._entrades[clau] = Entrada(expiracio=ara + self.ttl_segons, empremta=empremta)
+        return None
+
+    def completar(self, clau: tuple, resposta: RespostaDesada) -> None:
+        entrada = self._entrades.get(clau)
+        if entrada is not None:
+            entrada.resposta = resposta
+
+    # Si la petició ha fallat per un error del servidor, s'allibera la clau per a que el client la pugui reintentar
+    def alliberar(self, clau: tuple) -> None:
+        self._entrades.pop(clau, None)
+
+    def __len__(self) -> int:
+        return len(self._entrades)
+
+
+magatzem_idempotencia = MagatzemIdempotencia(IDEMPOTENCIA_TTL_SEGONS, IDEMPOTENCIA_MAX_CLAUS)
+
+
+## Middleware ASGI
+
+class IdempotenciaMiddleware:
+    def __init__(self, app, magatzem: MagatzemIdempotencia = magatzem_idempotencia):
+        self.app = app
+        self.magatzem = magatzem
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        clau_client = headers.get(b"idempotency-key")
+        if not clau_client:
+            return await self.app(scope, receive, send)
+
+        # Es llegeix el cos sencer per a calcular l'empremta de la petició
+        cos = b""
+        while True:
+            missatge = await receive()
+            cos += missatge.get("body", b"")
+            if not missatge.get("more_body"):
+                break
+
+        ambit = hashlib.sha256(headers.get(b"authorization", b"")).hexdigest()
+        clau = (ambit, clau_client.decode("latin-1"))
+        empremta = hashlib.sha256(
+            b"\x1f".join([scope["path"].encode(), scope.get("query_string", b""), cos])
+        ).hexdigest()
+
+        try:
+            entrada = self.magatzem.reservar(clau, empremta)
+        except MagatzemPle:
+            return await _enviar_error(send, 503, "Massa peticions en curs amb Idempotency-Key", [(b"retry-after", b"1")])
+        if entrada is not None:
+            if entrada.empremta != empremta:
+                return await _enviar_error(send, 422, "Aquesta Idempotency-Key ja s'ha emprat amb una petició diferent")
+            if entrada.resposta is None:
+                return await _enviar_error(send, 409, "Ja hi ha una petició en curs amb aquesta Idempotency-Key", [(b"retry-after", b"1")])
+            resposta = entrada.resposta
+            await send({
+                "type": "http.response.start",
+                "status": resposta.status,
+                "headers": resposta.headers + [(b"idempotent-replayed", b"true")],
+            })
+            await send({"type": "http.response.body", "body": resposta.cos})
+            return
+
+        # Petició nova: s'executa, es reenvia la resposta al client i es desa
+        cos_enviat = False
+
+        async def receive_amb_cos():
+            nonlocal cos_enviat
+            if not cos_enviat:
+                cos_enviat = True
+                return {"type": "http.request", "body": cos, "more_body": False}
+            return await receive()
+
+        capturada = {"status": 500, "headers": [], "cos": b""}
+
+        async def send_capturant(missatge):
+            if missatge["type"] == "http.response.start":
+                capturada["status"] = missatge["status"]
+                capturada["headers"] = list(missatge.get("headers", []))
+            elif missatge["type"] == "http.response.body":
+                capturada["cos"] += missatge.get("body", b"")
+            await send(missatge)
+
+        # La clau s'allibera si la petició no acaba amb una resposta desable: errors del servidor, excepcions i
+        # també cancel·lacions (CancelledError no és una Exception), que si no la deixarien reservada fins que caduqués
+        completada = False
+        try:
+            await self.app(scope, receive_amb_cos, send_capturant)
+            if capturada["status"] < 500:
+                self.magatzem.completar(clau, RespostaDesada(**capturada))
+                completada = True
+        finally:
+            if not completada:
+                self.magatzem.alliberar(clau)
+
+
+async def _enviar_error(send, status: int, detail: str, headers: Optional[list] = None) -> None:
+    cos = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(cos)).encode()),
+        ] + (headers or []),
+    })
+    await send({"type": "http.response.body", "body": cos})
@@ -0,0 +1,110 @@
+import base64
+import hashlib
+import hmac
+import io
+import os
+import secrets
+from typing import Optional
+
+from app.core.config import SECRET_KEY, DB_SHARDS
+from app.core.traces import span
+
+'''
+Generació i renderitzat dels tokens que porten els codis QR de les targetes virtuals.
+
+Formats de token:
+- compacte: QR_TOKEN_BITS bits aleatoris en base32 (A-Z, 2-7) sense padding. Tots els caràcters són del
+  mode alfanumèric de QR, de manera que 160 bits (32 caràcters) caben en un QR de versió 2 (25x25 mòduls)
+- llegat: 255 caràcters hexadecimals (format original). Necessita un QR de versió 10 o superior
+
+Els dos formats es verifiquen igual, de manera que els QR en format llegat continuen essent vàlids durant la migració.
+
+A la base de dades no es desa el token, sinó el seu SHA-256 (`qr_digest`, BINARY(32)), que és el que es cerca en verificar.
+Els tokens compactes es deriven amb HMAC(SECRET_KEY, sal) i només es desa la sal (`qr_sal`), de manera que el QR
+es pot tornar a renderitzar però un bolcat de la base de dades no permet reconstruir cap token sense la clau secreta.
+Els tokens en format llegat (aleatoris) s'han de desar sencers a la columna `qr` per a poder-los renderitzar.
+
+Amb diversos shards, el token porta davant el número del shard on és la targeta virtual ("2-ABCD..."), per a
+que la verificació vagi directament al node correcte. El guió i els dígits també són del mode alfanumèric.
+Amb un sol shard no hi ha prefix i els tokens són els mateixos que abans.
+'''
+
+QR_FORMAT = os.getenv("QR_FORMAT", "compacte")
+QR_TOKEN_BITS = int(os.getenv("QR_TOKEN_BITS", 160))
+QR_HASH_LENGTH = 255
+QR_SAL_BYTES = 16
+
+## Helpers
+
+def _derivar_token(sal: bytes) -> str:
+    mac = hmac.new(SECRET_KEY.encode("utf-8"), b"qr:" + sal, hashlib.sha256).digest()
+    return base64.b32encode(mac[:QR_TOKEN_BITS // 8]).decode("ascii").rstrip("=")
+
+def _generar_token_compacte() -> tuple[str, bytes]:
+    sal = secrets.token_bytes(QR_SAL_BYTES)
+    return _derivar_token(sal), sal
+
+def _generar_token_llegat() -> tuple[str, None]:
+    token = secrets.token_hex(128)
+    salt = hashlib.sha256(token.encode()).hexdigest()
+    combinat = token + salt
+    return combinat[:QR_HASH_LENGTH], None
+
+def _prefix_shard(shard: int) -> str:
+    return f"{shard}-" if len(DB_SHARDS) > 1 else ""
+
+# Genera el token que servirà després per a crear el codi QR, en el format configurat a QR_FORMAT
+# Retorna el token i la sal amb la que s'ha derivat (None en format llegat, on s'ha de desar el token)
+def generar_token_qr(shard: int = 0) -> tuple[str, Optional[bytes]]:
+    if QR_FORMAT == "llegat":
+        token, sal = _generar_token_llegat()
+    else:
+        token, sal = _generar_token_compacte()
+    return _prefix_shard(shard) + token, sal
+
+# Recupera el token d'una targeta virtual a partir de les columnes `qr` i `qr_sal` (en format llegat, `qr` ja porta el prefix)
+def recuperar_token_qr(qr: Optional[str], qr_sal: Optional[bytes], shard: int = 0) -> str:
+    if qr is not None:
+        return qr
+    return _prefix_shard(shard) + _derivar_token(bytes(qr_sal))
+
+# Shard d'un token segons el seu prefix. Els tokens sense prefix són del shard 0
+def shard_token_qr(token: str) -> int:
+    prefix, separador, _ = token.partition("-")
+    if separador and prefix.isdigit() and int(prefix) < len(DB_SHARDS):
+        return int(prefix)
+    return 0
+
+# Digest de longitud fixa amb el que es desa i es cerca el token a la base de dades
+def digest_token_qr(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+# Renderitza el token com a imatge QR JPEG de 256x256
+# qrcode i PIL s'importen aquí dins per a no carregar-los a l'arrencada de l'API, només quan es demana el primer QR
+def renderitzar_qr(qr_hash: str) -> bytes:
+    import qrcode
+    from PIL import Image
+
+    # Codificació: es tria la versió de QR i es calculen els mòduls
+    with span("qr.codificacio", longitud=len(qr_hash)) as s:
+        qr = qrcode.QRCode(
+            version=None,
+            error_correction=qrcode.constants.ERROR_CORRECT_M,
+            box_size=2,
+            border=2,
+        )
+        qr.add_data(qr_hash)
+        qr.make(fit=True)
+        if s is not None:
+            s.atributs["versio"] = qr.version
+
+    with span("qr.renderitzat"):
+        img = qr.make_image(fill_color="black", back_color="white")
+
+        # Assignam perfil de color al QR i l'escalam a 256x256 per a que càpiga a l'aplicació
+        img_rgb = img.convert("RGB").resize((256, 256), Image.NEAREST)
+
+    with span("qr.jpeg"):
+        buffer = io.BytesIO()
+        img_rgb.save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue()
@@ -0,0 +1,75 @@
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import time
+from typing import Optional
+
+from app.core.config import SECRET_KEY
+
+'''
+QR generats al dispositiu (TOTP), com a alternativa a demanar una targeta virtual nova cada minut.
+
+L'app demana un sol cop el secret de la targeta (POST /api/v1/targetes-virtuals/secret) i a partir d'aquí calcula
+els codis localment, sense connexió ni cap escriptura al servidor. El contingut del QR és "T-<id targeta>-<codi>",
+on el codi és un TOTP (RFC 6238, HMAC-SHA1) de QR_DISPOSITIU_DIGITS xifres amb passos de QR_DISPOSITIU_PERIODE_SEGONS.
+Tots els caràcters són del mode alfanumèric de QR.
+
+A la base de dades (`qr_dispositiu`) només es desa una sal: el secret es deriva amb HMAC(SECRET_KEY, id + sal),
+igual que els tokens compactes de app/core/qr.py. Tornar a demanar el secret en genera un de nou i invalida l'anterior.
+
+En verificar s'accepten els passos fins a QR_DISPOSITIU_DESVIACIO_PASSOS abans o després de l'actual (rellotges
+desajustats) i es desa el darrer pas acceptat. Un codi d'aquest pas o d'un d'anterior ja no s'accepta, de manera
+que cada codi només es pot validar una vegada i com a molt hi ha una validació per pas.
+'''
+
+QR_DISPOSITIU_PERIODE_SEGONS = int(os.getenv("QR_DISPOSITIU_PERIODE_SEGONS", 30))
+QR_DISPOSITIU_DIGITS = int(os.getenv("QR_DISPOSITIU_DIGITS", 8))
+QR_DISPOSITIU_DESVIACIO_PASSOS = int(os.getenv("QR_DISPOSITIU_DESVIACIO_PASSOS", 1))
+QR_DISPOSITIU_SAL_BYTES = 16
+
+_TOKEN = re.compile(r"T-(\d{1,10})-(\d+)")
+
+## Helpers
+
+def generar_sal() -> bytes:
+    return secrets.token_bytes(QR_DISPOSITIU_SAL_BYTES)
+
+# Secret TOTP d'una targeta (20 bytes, la mida de bloc recomanada per a HMAC-SHA1)
+def derivar_secret(id_targeta: int, sal: bytes) -> bytes:
+    missatge = b"qr-dispositiu:" + str(id_targeta).encode("ascii") + b":" + bytes(sal)
+    return hmac.new(SECRET_KEY.encode("utf-8"), missatge, hashlib.sha256).digest()[:20]
+
+# El secret en base32 sense padding, com l'esperen les biblioteques TOTP
+def secret_base32(secret: bytes) -> str:
+    return base64.b32encode(secret).decode("ascii").rstrip("=")
+
+def pas_actual(ara: Optional[float] = None) -> int:
+    return int((time.time() if ara is None else ara) // QR_DISPOSITIU_PERIODE_SEGONS)
+
+# Codi TOTP d'un pas (RFC 4226, truncament dinàmic)
+def codi_totp(secret: bytes, pas: int) -> str:
+    mac = hmac.new(secret, pas.to_bytes(8, "big"), hashlib.sha1).digest()
+    desplacament = mac[-1] & 0x0F
+    valor = int.from_bytes(mac[desplacament:desplacament + 4], "big") & 0x7FFFFFFF
+    return str(valor % 10 ** QR_DISPOSITIU_DIGITS).zfill(QR_DISPOSITIU_DIGITS)
+
+# Retorna (id_targeta, codi) si el token té el format dels QR de dispositiu, o None si és un token de targeta virtual
+def llegir_token(token: str) -> Optional[tuple[int, str]]:
+    coincidencia = _TOKEN.fullmatch(token)
+    if coincidencia is None or len(coincidencia.group(2)) != QR_DISPOSITIU_DIGITS:
+        return None
+    return int(coincidencia.group(1)), coincidencia.group(2)
+
+def es_token_dispositiu(token: str) -> bool:
+    return token.startswith("T-")
+
+# Pas de la finestra de tolerància amb què coincideix el codi (None si no coincideix amb cap)
+def pas_del_codi(secret: bytes, codi: str, ara: Optional[float] = None) -> Optional[int]:
+    actual = pas_actual(ara)
+    for pas in range(actual - QR_DISPOSITIU_DESVIACIO_PASSOS, actual + QR_DISPOSITIU_DESVIACIO_PASSOS + 1):
+        if hmac.compare_digest(codi_totp(secret, pas), codi):
+            return pas
+    return None
@@ -0,0 +1,172 @@
+import asyncio
+import math
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+'''
+Rotació de codis QR per a clients connectats per SSE.
+
+Una única roda de temporitzadors (timer wheel) amb ranures d'un segon decideix quan cal generar el següent QR
+de cada targeta. Totes les connexions d'una mateixa targeta comparteixen la mateixa targeta virtual: només se'n
+genera una per rotació i s'envia a tots els subscriptors, de manera que els clients en espera no fan peticions
+ni consumeixen CPU fins que toca rotar.
+'''
+
+
+@dataclass(eq=False)
+class Subscripcio:
+    amb_imatge: bool
+    cua: asyncio.Queue = field(default_factory=asyncio.Queue)
+
+
+@dataclass
+class EsdevenimentQR:
+    targeta_virtual: object
+    imatge: Optional[bytes] = None
+    error: Optional[str] = None
+
+
+class RodaRotacio:
+    def __init__(
+        self,
+        generar: Callable[[int], Awaitable[object]],
+        renderitzar: Callable[[str], Awaitable[bytes]],
+        antelacio_segons: int,
+        ranures: int = 128,
+    ):
+        # generar(id_targeta_mare) -> TargetaVirtualResponse, renderitzar(qr) -> bytes JPEG
+        self._generar = generar
+        self._renderitzar = renderitzar
+        self._antelacio_segons = antelacio_segons
+        self._ranures: list[set[int]] = [set() for _ in range(ranures)]
+        # Ranura on és programada cada targeta: com a molt una rotació pendent per targeta
+        self._programades: dict[int, int] = {}
+        self._tic = 0
+        self._subscriptors: dict[int, set[Subscripcio]] = {}
+        self._darrer: dict[int, EsdevenimentQR] = {}
+        # Evita que dos clients que es connecten alhora a la mateixa targeta generin dos QR i s'invalidin entre ells
+        # Cada bloqueig porta el nombre de corutines que el tenen o l'esperen, i s'esborra quan arriba a zero
+        self._bloquejos: dict[int, list] = {}
+        self._tasca: Optional[asyncio.Task] = None
+
+    ## Subscripcions
+
+    # Registra un client per a una targeta i li envia immediatament el QR vigent (o en genera un de nou)
+    # Si la targeta no permet generar QR, l'excepció es propaga abans de registrar el client
+    async def subscriure(self, id_targeta_mare: int, amb_imatge: bool) -> Subscripcio:
+        async with self._bloqueig(id_targeta_mare):
+            esdeveniment = self._darrer.get(id_targeta_mare)
+            if esdeveniment is None or esdeveniment.targeta_virtual.data_expiracio <= datetime.utcnow():
+                esdeveniment = await self._emetre(id_targeta_mare, amb_imatge, nou_subscriptor=True)
+            elif amb_imatge and esdeveniment.imatge is None:
+                esdeveniment.imatge = await self._renderitzar(esdeveniment.targeta_virtual.qr)
+
+            subscripcio = Subscripcio(amb_imatge=amb_imatge)
+            subscripcio.cua.put_nowait(esdeveniment)
+            self._subscriptors.setdefault(id_targeta_mare, set()).add(subscripcio)
+
+        if self._tasca is None:
+            self._tasca = asyncio.create_task(self._girar())
+        return subscripcio
+
+    def dessubscriure(self, id_targeta_mare: int, subscripcio: Subscripcio) -> None:
+        subscripcions = self._subscriptors.get(id_targeta_mare)
+        if subscripcions is None:
+            return
+        subscripcions.discard(subscripcio)
+        if not subscripcions:
+            del self._subscriptors[id_targeta_mare]
+            self._oblidar(id_targeta_mare)
+
+    def connexions(self) -> int:
+        return sum(len(s) for s in self._subscriptors.values())
+
+    ## Roda de temporitzadors
+
+    # Substitueix la rotació pendent de la targeta, si n'hi ha, perquè no s'acumulin cadenes de rotacions
+    def _programar(self, id_targeta_mare: int, data_expiracio: datetime) -> None:
+        self._desprogramar(id_targeta_mare)
+        segons = (data_expiracio - datetime.utcnow()).total_seconds() - self._antelacio_segons
+        tics = min(max(1, math.ceil(segons)), len(self._ranures) - 1)
+        ranura = (self._tic + tics) % len(self._ranures)
+        self._ranures[ranura].add(id_targeta_mare)
+        self._programades[id_targeta_mare] = ranura
+
+    def _desprogramar(self, id_targeta_mare: int) -> None:
+        ranura = self._programades.pop(id_targeta_mare, None)
+        if ranura is not None:
+            self._ranures[ranura].discard(id_targeta_mare)
+
+    # Deixa la targeta sense rotació pendent ni estat, quan ja no té subscriptors
+    # El bloqueig no s'esborra aquí: pot estar agafat per una rotació en curs (vegeu _bloqueig)
+    def _oblidar(self, id_targeta_mare: int) -> None:
+        self._desprogramar(id_targeta_mare)
+        self._darrer.pop(id_targeta_mare, None)
+
+    @asynccontextmanager
+    async def _bloqueig(self, id_targeta_mare: int):
+        entrada = self._bloquejos.setdefault(id_targeta_mare, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                del self._bloquejos[id_targeta_mare]
+
+    # Genera una nova targeta virtual, la renderitza un sol cop si algun client vol la imatge i l'envia a tothom
+    # Si mentrestant s'han desconnectat tots els clients (i no n'hi ha cap de nou esperant), no es desa ni es programa
+    async def _emetre(
+        self, id_targeta_mare: int, amb_imatge: bool = False, nou_subscriptor: bool = False
+    ) -> EsdevenimentQR:
+        targeta_virtual = await self._generar(id_targeta_mare)
+
+        imatge = None
+        subscripcions = self._subscriptors.get(id_targeta_mare, set())
+        if amb_imatge or any(s.amb_imatge for s in subscripcions):
+            imatge = await self._renderitzar(targeta_virtual.qr)
+
+        esdeveniment = EsdevenimentQR(targeta_virtual=targeta_virtual, imatge=imatge)
+        subscripcions = self._subscriptors.get(id_targeta_mare, set())
+        if not subscripcions and not nou_subscriptor:
+            return esdeveniment
+        self._darrer[id_targeta_mare] = esdeveniment
+        for subscripcio in subscripcions:
+            subscripcio.cua.put_nowait(esdeveniment)
+        self._programar(id_targeta_mare, targeta_virtual.data_expiracio)
+        return esdeveniment
+
+    # Si una rotació falla (per exemple, la targeta ha passat a 'Robada'), s'avisa als clients i es tanquen
+    # Es fa amb el mateix bloqueig que subscriure perquè una connexió nova no generi un altre QR alhora
+    async def _rotar(self, id_targeta_mare: int) -> None:
+        async with self._bloqueig(id_targeta_mare):
+            if id_targeta_mare not in self._subscriptors or id_targeta_mare in self._programades:
+                # Tots els clients s'han desconnectat, o una subscripció ja ha generat i programat un QR nou
+                return
+            try:
+                await self._emetre(id_targeta_mare)
+            except Exception as e:
+                error = EsdevenimentQR(targeta_virtual=None, error=getattr(e, "detail", str(e)))
+                for subscripcio in self._subscriptors.pop(id_targeta_mare, set()):
+                    subscripcio.cua.put_nowait(error)
+                self._oblidar(id_targeta_mare)
+
+    async def _girar(self) -> None:
+        try:
+            while self._subscriptors:
+                await asyncio.sleep(1)
+                self._tic = (self._tic + 1) % len(self._ranures)
+                venciments = self._ranures[self._tic]
+                self._ranures[self._tic] = set()
+                for id_targeta_mare in venciments:
+                    self._programades.pop(id_targeta_mare, None)
+                await asyncio.gather(*(
+                    self._rotar(id_targeta_mare)
+                    for id_targeta_mare in venciments
+                    if id_targeta_mare in self._subscriptors
+                ))
+        finally:
+            self._tasca = None
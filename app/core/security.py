@@ -1,10 +1,9 @@
+import logging
 from datetime import datetime, timedelta
 from typing import Optional
 
-import bcrypt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
 from pydantic import BaseModel
 
 from app.core.config import (
@@ -12,7 +11,9 @@
     ALGORITHM,
     ACCESS_TOKEN_EXPIRE_MINUTES,
 )
-from app.db.database import get_db_connection
+from app.db.database import get_db_connection, get_db_read_connection
+from app.core.contrasenyes import calcular_hash, verificar, necessita_rehash
+from app.core.traces import span
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/v1/auth/token")
 
@@ -22,6 +23,8 @@
 d'usuaris, a l'app o a la validadora (sempre amb el seu pertinent usuari).
 '''
 
+logger = logging.getLogger(__name__)
+
 ## Models interns
 
 class Token(BaseModel):
@@ -44,21 +47,23 @@ class UserInDB(User):
 
 ## Helpers
 
+# L'algorisme i el cost dels hashos es defineixen a app/core/contrasenyes.py
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(
-        plain_password.encode("utf-8"),
-        hashed_password.encode("utf-8")
-    )
+    with span("contrasenya.verificacio"):
+        return verificar(plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
-    salt = bcrypt.gensalt(rounds=12)
-    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+    with span("contrasenya.hash"):
+        return calcular_hash(password)
 
 
 def create_access_token(
     data: dict, expires_delta: Optional[timedelta] = None
 ) -> str:
+    # python-jose (i les seves dependències criptogràfiques) es carrega al primer ús
+    from jose import jwt
+
     to_encode = data.copy()
     expire = (
         datetime.utcnow() + expires_delta
@@ -66,7 +71,8 @@ def create_access_token(
         else datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     )
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with span("jwt.codificacio"):
+        return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
 ## Autenticació (dependències)
@@ -74,13 +80,16 @@ def create_access_token(
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
 ) -> User:
+    from jose import JWTError, jwt
+
     credential_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="No s'han pogut validar les credencials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with span("jwt.descodificacio"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             raise credential_exception
@@ -88,7 +97,7 @@ async def get_current_user(
     except JWTError:
         raise credential_exception
 
-    with get_db_connection() as conn:
+    with get_db_read_connection() as conn:
         cursor = conn.cursor()
         try:
             cursor.execute(
@@ -124,4 +133,23 @@ async def authenticate_user(email: str, password: str) -> Optional[User]:
     if not verify_password(password, row[1]):
         return None
 
+    # Si el hash no segueix la política actual (un altre algorisme o cost), es recalcula ara que es té la contrasenya
+    # La condició sobre el hash anterior evita sobreescriure un canvi de contrasenya fet mentrestant
+    if necessita_rehash(row[1]):
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        "UPDATE user SET contrasenya = %s WHERE id = %s AND contrasenya = %s",
+                        (get_password_hash(password), row[0], row[1])
+                    )
+                    conn.commit()
+                finally:
+                    cursor.close()
+        except HTTPException:
+            # get_db_connection converteix els errors de pymysql en HTTPException
+            # El login no falla per això: es tornarà a provar al següent
+            logger.exception("No s'ha pogut actualitzar el hash de la contrasenya de l'usuari %s", row[0])
+
     return User(id=row[0], email=email)
\ No newline at end of file
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, time as hora
+from decimal import Decimal
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+'''
+Motor de tarifes: import que es cobra a cada validació segons el perfil de la targeta.
+
+La taula de tarifes es carrega a memòria des del fitxer JSON TARIFES_FITXER. Si no existeix, s'empren les
+tarifes per defecte (TARIFES_PER_DEFECTE). Com a molt cada TARIFES_COMPROVACIO_SEGONS es mira la data de
+modificació del fitxer i, si ha canviat, es torna a carregar sense reiniciar l'API. Si el fitxer nou no és
+vàlid, es registra l'error i es continua amb la taula anterior.
+
+Format del fitxer:
+{
+    "tarifes": {"General": "1.50", "Jove": "0.75", ...},
+    "franges": [
+        {"des_de": "07:00", "fins_a": "09:30", "dies": [0, 1, 2, 3, 4], "tarifes": {"General": "1.80"}}
+    ]
+}
+
+Les franges són opcionals. La primera franja que inclou l'hora local (TARIFES_ZONA_HORARIA) i el dia de la
+setmana (0 = dilluns; si no s'indica, tots) substitueix la tarifa dels perfils que defineix.
+'''
+
+TARIFES_FITXER = os.getenv("TARIFES_FITXER", "tarifes.json")
+TARIFES_ZONA_HORARIA = ZoneInfo(os.getenv("TARIFES_ZONA_HORARIA", "Europe/Madrid"))
+TARIFES_COMPROVACIO_SEGONS = float(os.getenv("TARIFES_COMPROVACIO_SEGONS", 5))
+
+PERFILS = ("Infantil", "Jove", "General", "Pensionista", "Altres")
+
+TARIFES_PER_DEFECTE = {
+    "tarifes": {
+        "Infantil": "0.00",
+        "Jove": "0.75",
+        "General": "1.50",
+        "Pensionista": "0.50",
+        "Altres": "1.50",
+    },
+    "franges": [],
+}
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Franja:
+    des_de: hora
+    fins_a: hora
+    dies: frozenset[int]
+    tarifes: dict[str, Decimal]
+
+    def inclou(self, moment: datetime) -> bool:
+        if moment.weekday() not in self.dies:
+            return False
+        ara = moment.time()
+        # Una franja que passa de mitjanit (per exemple, 22:00-06:00) té des_de > fins_a
+        if self.des_de <= self.fins_a:
+            return self.des_de <= ara < self.fins_a
+        return ara >= self.des_de or ara < self.fins_a
+
+
+@dataclass(frozen=True)
+class TaulaTarifes:
+    tarifes: dict[str, Decimal]
+    franges: tuple[Franja, ...]
+
+
+## Helpers
+def _import(valor) -> Decimal:
+    # Els imports es llegeixen com a text o número i s'arrodoneixen a cèntims, igual que la columna `saldo`
+    valor = Decimal(str(valor)).quantize(Decimal("0.01"))
+    if valor < 0:
+        raise ValueError(f"Import negatiu: {valor}")
+    return valor
+
+def _tarifes_perfil(dades: dict) -> dict[str, Decimal]:
+    desconeguts = set(dades) - set(PERFILS)
+    if desconeguts:
+        raise ValueError(f"Perfils desconeguts: {', '.join(sorted(desconeguts))}")
+    return {perfil: _import(valor) for perfil, valor in dades.items()}
+
+def _llegir_taula(dades: dict) -> TaulaTarifes:
+    tarifes = _tarifes_perfil(dades["tarifes"])
+    falten = set(PERFILS) - set(tarifes)
+    if falten:
+        raise ValueError(f"Falta la tarifa dels perfils: {', '.join(sorted(falten))}")
+
+    franges = tuple(
+        Franja(
+            des_de=hora.fromisoformat(franja["des_de"]),
+            fins_a=hora.fromisoformat(franja["fins_a"]),
+            dies=frozenset(franja.get("dies", range(7))),
+            tarifes=_tarifes_perfil(franja["tarifes"]),
+        )
+        for franja in dades.get("franges", [])
+    )
+    return TaulaTarifes(tarifes=tarifes, franges=franges)
+
+
+class MotorTarifes:
+    def __init__(self, fitxer: str, comprovacio_segons: float):
+        self.fitxer = fitxer
+        self.comprovacio_segons = comprovacio_segons
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._comprovat = 0.0
+        self._taula = _llegir_taula(TARIFES_PER_DEFECTE)
+        self._recarregar()
+
+    # Torna a llegir el fitxer si la seva data de modificació ha canviat
+    def _recarregar(self) -> None:
+        try:
+            mtime = os.stat(self.fitxer).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+
+        try:
+            if mtime is None:
+                taula = _llegir_taula(TARIFES_PER_DEFECTE)
+            else:
+                with open(self.fitxer, encoding="utf-8") as f:
+                    taula = _llegir_taula(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError, ArithmeticError):
+            logger.exception("Fitxer de tarifes no vàlid (%s), es manté la taula anterior", self.fitxer)
+        else:
+            self._taula = taula
+        # Tant si s'ha carregat com si no, no es torna a provar fins que el fitxer canviï de nou
+        self._mtime = mtime
+
+    def taula(self) -> TaulaTarifes:
+        with self._lock:
+            ara = time.monotonic()
+            if ara - self._comprovat >= self.comprovacio_segons:
+                self._comprovat = ara
+                self._recarregar()
+            return self._taula
+
+    # Import d'un viatge per a un perfil en un moment donat (per defecte, ara)
+    def import_viatge(self, perfil: str, moment: Optional[datetime] = None) -> Decimal:
+        taula = self.taula()
+        moment = (moment or datetime.now(TARIFES_ZONA_HORARIA)).astimezone(TARIFES_ZONA_HORARIA)
+        for franja in taula.franges:
+            if franja.inclou(moment) and perfil in franja.tarifes:
+                return franja.tarifes[perfil]
+        return taula.tarifes[perfil]
+
+
+motor_tarifes = MotorTarifes(TARIFES_FITXER, TARIFES_COMPROVACIO_SEGONS)
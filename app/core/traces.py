@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+import pymysql
+
+'''
+Traces distribuïdes de les peticions: quant temps passa cada petició a cada consulta SQL, a obtenir la connexió,
+a l'SMTP, al JWT o al renderitzat dels QR.
+
+El middleware obre un span arrel per petició i la resta de spans en pengen a través d'un ContextVar, que també
+arriba als fils del threadpool. El context es propaga amb la capçalera W3C `traceparent`
+(00-<trace id>-<span id pare>-<flags>): si la petició en porta una, la traça continua la del client. Es mostreja
+una fracció TRACES_MOSTREIG de les peticions (0 = cap, 1 = totes); el flag de mostreig de la capçalera només es
+respecta amb TRACES_CONFIAR_MOSTREIG=true (per exemple, darrere d'un gateway propi), perquè si no qualsevol client
+podria fer traçar totes les seves peticions. La decisió es pren a l'inici (head-based): a les peticions no
+mostrejades, `span()` no crea cap objecte.
+
+Els spans de les peticions mostrejades s'escriuen, un per línia en JSON, al fitxer TRACES_FITXER, que fa de
+col·lector local. Quan el fitxer passa de TRACES_MAX_BYTES es renomena a TRACES_FITXER.1 (substituint l'anterior)
+i se'n comença un de nou. La resposta porta la capçalera `traceparent` amb el span arrel, per a poder trobar-ne la traça.
+'''
+
+TRACES_MOSTREIG = float(os.getenv("TRACES_MOSTREIG", 0.0))
+TRACES_CONFIAR_MOSTREIG = os.getenv("TRACES_CONFIAR_MOSTREIG", "false").lower() == "true"
+TRACES_FITXER = os.getenv("TRACES_FITXER", "traces.jsonl")
+TRACES_MAX_BYTES = int(os.getenv("TRACES_MAX_BYTES", 100 * 1024 * 1024))
+
+MAX_SQL = 500
+
+_TRACEPARENT = re.compile(r"([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    pare: Optional[str]
+    nom: str
+    atributs: dict = field(default_factory=dict)
+    inici: float = field(default_factory=time.time)
+    error: Optional[str] = None
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+
+# Span actiu del context. Només n'hi ha a les peticions mostrejades
+_span_actual: ContextVar[Optional[Span]] = ContextVar("span_actual", default=None)
+
+
+class ExportadorJsonl:
+    def __init__(self, fitxer: str, max_bytes: int):
+        self.fitxer = fitxer
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sortida = None
+        self._mida = 0
+
+    # Renomena el fitxer ple a <fitxer>.1 i el torna a obrir buit. Es crida amb el lock agafat
+    def _rotar(self) -> None:
+        self._sortida.close()
+        self._sortida = None
+        os.replace(self.fitxer, self.fitxer + ".1")
+
+    def exportar(self, span: Span, durada_segons: float) -> None:
+        linia = json.dumps({
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "pare": span.pare,
+            "nom": span.nom,
+            "inici": datetime.fromtimestamp(span.inici, timezone.utc).isoformat(),
+            "durada_ms": round(durada_segons * 1000, 3),
+            "atributs": span.atributs,
+            "error": span.error,
+        }, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            try:
+                if self._sortida is not None and self._mida >= self.max_bytes:
+                    self._rotar()
+                if self._sortida is None:
+                    self._sortida = open(self.fitxer, "a", encoding="utf-8", buffering=1)
+                    self._mida = self._sortida.tell()
+                self._sortida.write(linia)
+                self._mida += len(linia.encode("utf-8"))
+            except OSError:
+                # Les traces no han de fer fallar la petició
+                logger.exception("No s'ha pogut escriure la traça a %s", self.fitxer)
+
+
+exportador = ExportadorJsonl(TRACES_FITXER, TRACES_MAX_BYTES)
+
+
+## Helpers
+
+def _id(bytes_: int) -> str:
+    return secrets.token_hex(bytes_)
+
+# Llegeix una capçalera traceparent. Retorna (trace id, span id pare, mostrejat) o None si no és vàlida
+def _llegir_traceparent(valor: Optional[str]) -> Optional[tuple[str, str, bool]]:
+    coincidencia = _TRACEPARENT.fullmatch((valor or "").strip().lower())
+    if coincidencia is None:
+        return None
+    versio, trace_id, span_id, flags = coincidencia.groups()
+    if versio == "ff" or trace_id == "0" * 32 or span_id == "0" * 16:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+def _tancar(span: Span, inici_monotonic: float) -> None:
+    exportador.exportar(span, time.monotonic() - inici_monotonic)
+
+
+# Obre un span fill del span actiu. Fora d'una petició mostrejada no fa res i retorna None
+@contextmanager
+def span(nom: str, **atributs) -> Iterator[Optional[Span]]:
+    pare = _span_actual.get()
+    if pare is None:
+        yield None
+        return
+
+    fill = Span(trace_id=pare.trace_id, span_id=_id(8), pare=pare.span_id, nom=nom, atributs=atributs)
+    testimoni = _span_actual.set(fill)
+    inici = time.monotonic()
+    try:
+        yield fill
+    except BaseException as e:
+        fill.error = type(e).__name__
+        raise
+    finally:
+        _span_actual.reset(testimoni)
+        _tancar(fill, inici)
+
+# Afegeix atributs al span actiu (si n'hi ha)
+def anotar(**atributs) -> None:
+    actual = _span_actual.get()
+    if actual is not None:
+        actual.atributs.update(atributs)
+
+
+## Cursor de pymysql amb un span per consulta
+
+class CursorTracat(pymysql.cursors.Cursor):
+    def execute(self, query, args=None):
+        if _span_actual.get() is None:
+            return super().execute(query, args)
+        with span("db.consulta", sql=" ".join(str(query).split())[:MAX_SQL]) as s:
+            files = super().execute(query, args)
+            s.atributs["files"] = self.rowcount
+            return files
+
+    def executemany(self, query, args):
+        if _span_actual.get() is None:
+            return super().executemany(query, args)
+        with span("db.consulta_multiple", sql=" ".join(str(query).split())[:MAX_SQL], lots=len(args)):
+            return super().executemany(query, args)
+
+
+## Middleware ASGI
+
+class TracesMiddleware:
+    def __init__(self, app, mostreig: float = TRACES_MOSTREIG, confiar_mostreig: bool = TRACES_CONFIAR_MOSTREIG):
+        self.app = app
+        self.mostreig = mostreig
+        self.confiar_mostreig = confiar_mostreig
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        pare = _llegir_traceparent(headers.get(b"traceparent", b"").decode("latin-1"))
+        if pare is not None:
+            trace_id, id_pare, mostrejat = pare
+            if not self.confiar_mostreig:
+                mostrejat = random.random() < self.mostreig
+        else:
+            trace_id, id_pare, mostrejat = _id(16), None, random.random() < self.mostreig
+        if not mostrejat:
+            return await self.app(scope, receive, send)
+
+        arrel = Span(
+            trace_id=trace_id,
+            span_id=_id(8),
+            pare=id_pare,
+            nom=f"{scope['method']} {scope['path']}",
+            atributs={"http.metode": scope["method"], "http.ruta": scope["path"]},
+        )
+        capcalera = (b"traceparent", arrel.traceparent().encode("ascii"))
+
+        async def send_amb_traca(missatge):
+            if missatge["type"] == "http.response.start":
+                arrel.atributs["http.status"] = missatge["status"]
+                missatge = {**missatge, "headers": list(missatge.get("headers", [])) + [capcalera]}
+            await send(missatge)
+
+        testimoni = _span_actual.set(arrel)
+        inici = time.monotonic()
+        try:
+            await self.app(scope, receive, send_amb_traca)
+        except BaseException as e:
+            arrel.error = type(e).__name__
+            raise
+        finally:
+            _span_actual.reset(testimoni)
+            # Després de l'enrutament, FastAPI deixa la ruta a l'scope: el nom agrupa per plantilla i no per ID
+            ruta = getattr(scope.get("route"), "path", None)
+            if ruta is not None:
+                arrel.nom = f"{scope['method']} {ruta}"
+            _tancar(arrel, inici)
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.db.database import get_db_connection
+
+'''
+Històric de validacions (taula `validacio`, particionada per mesos).
+
+La verificació d'un QR no escriu l'esdeveniment a la base de dades: el deixa a un buffer de memòria i una tasca
+de fons l'insereix en lots cada VALIDACIONS_INTERVAL_SEGONS (o abans, si hi ha VALIDACIONS_MIDA_LOT pendents).
+Així l'escaneig no afegeix cap escriptura síncrona a la seva latència.
+
+Si la base de dades no respon, els esdeveniments es queden al buffer i es tornen a intentar al següent cicle.
+El buffer té un màxim de VALIDACIONS_MAX_PENDENTS: si s'omple, es descarten els més antics i es compten a `perdudes`.
+En aturar el procés es fa un darrer buidatge, però una aturada brusca perd el que encara no s'havia escrit.
+'''
+
+VALIDACIONS_INTERVAL_SEGONS = float(os.getenv("VALIDACIONS_INTERVAL_SEGONS", 1.0))
+VALIDACIONS_MIDA_LOT = int(os.getenv("VALIDACIONS_MIDA_LOT", 500))
+VALIDACIONS_MAX_PENDENTS = int(os.getenv("VALIDACIONS_MAX_PENDENTS", 100000))
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Validacio:
+    id_targeta: int
+    id_passatger: int
+    perfil: str
+    import_cobrat: Decimal
+    id_usuari: Optional[int]
+    data_validacio: datetime
+
+
+class BufferValidacions:
+    def __init__(self, interval_segons: float, mida_lot: int, max_pendents: int):
+        self.interval_segons = interval_segons
+        self.mida_lot = mida_lot
+        self.max_pendents = max_pendents
+        self.escrites = 0
+        self.perdudes = 0
+        self.errors = 0
+        # registrar() es crida des dels fils del threadpool i el buidatge des d'un altre fil, per això el lock
+        self._lock = threading.Lock()
+        self._buidatge_lock = threading.Lock()
+        self._pendents: deque[Validacio] = deque()
+        self._avis: Optional[asyncio.Event] = None
+        self._bucle: Optional[asyncio.AbstractEventLoop] = None
+        self._tasca: Optional[asyncio.Task] = None
+
+    # Afegeix una validació al buffer. No toca la base de dades
+    def registrar(self, validacio: Validacio) -> None:
+        with self._lock:
+            if len(self._pendents) >= self.max_pendents:
+                self._pendents.popleft()
+                self.perdudes += 1
+            self._pendents.append(validacio)
+            ple = len(self._pendents) >= self.mida_lot
+
+        # Si ja hi ha un lot complet, es desperta la tasca de fons sense esperar l'interval
+        if ple and self._avis is not None and self._bucle is not None:
+            self._bucle.call_soon_threadsafe(self._avis.set)
+
+    # Escriu tots els pendents en lots de mida_lot. Retorna el nombre de files inserides
+    def buidar(self) -> int:
+        inserides = 0
+        with self._buidatge_lock:
+            while True:
+                with self._lock:
+                    lot = [self._pendents.popleft() for _ in range(min(self.mida_lot, len(self._pendents)))]
+                if not lot:
+                    return inserides
+
+                try:
+                    with get_db_connection() as conn:
+                        cursor = conn.cursor()
+                        try:
+                            # pymysql converteix l'executemany d'un INSERT ... VALUES en un sol INSERT multi-fila
+                            cursor.executemany(
+                                "INSERT INTO validacio (id_targeta, id_passatger, perfil, import_cobrat, id_usuari, data_validacio) "
+                                "VALUES (%s, %s, %s, %s, %s, %s)",
+                                [
+                                    (v.id_targeta, v.id_passatger, v.perfil, v.import_cobrat, v.id_usuari, v.data_validacio)
+                                    for v in lot
+                                ]
+                            )
+                            conn.commit()
+                        finally:
+                            cursor.close()
+                except Exception:
+                    # get_db_connection converteix els errors de pymysql en HTTPException, per això es captura tot
+                    # El lot torna al principi del buffer. Si es passa del màxim, es descarten els més antics
+                    logger.exception("No s'han pogut escriure %d validacions", len(lot))
+                    with self._lock:
+                        self.errors += 1
+                        self._pendents.extendleft(reversed(lot))
+                        while len(self._pendents) > self.max_pendents:
+                            self._pendents.popleft()
+                            self.perdudes += 1
+                    return inserides
+
+                inserides += len(lot)
+                with self._lock:
+                    self.escrites += len(lot)
+
+    ## Tasca de fons (s'inicia i s'atura amb el cicle de vida de l'aplicació)
+
+    async def _executar(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._avis.wait(), timeout=self.interval_segons)
+            except asyncio.TimeoutError:
+                pass
+            self._avis.clear()
+            try:
+                await run_in_threadpool(self.buidar)
+            except Exception:
+                # Un error inesperat no ha d'aturar la tasca: els pendents es tornen a intentar al següent cicle
+                logger.exception("Error en el buidatge del buffer de validacions")
+
+    def iniciar(self) -> None:
+        if self._tasca is not None:
+            return
+        self._bucle = asyncio.get_running_loop()
+        self._avis = asyncio.Event()
+        self._tasca = asyncio.create_task(self._executar())
+
+    async def aturar(self) -> None:
+        if self._tasca is not None:
+            self._tasca.cancel()
+            try:
+                await self._tasca
+            except asyncio.CancelledError:
+                pass
+            self._tasca = None
+        await run_in_threadpool(self.buidar)
+
+    def metriques(self) -> dict:
+        with self._lock:
+            return {
+                "pendents": len(self._pendents),
+                "escrites": self.escrites,
+                "perdudes": self.perdudes,
+                "errors": self.errors,
+            }
+
+
+buffer_validacions = BufferValidacions(
+    VALIDACIONS_INTERVAL_SEGONS, VALIDACIONS_MIDA_LOT, VALIDACIONS_MAX_PENDENTS
+)
@@ -1,15 +1,62 @@
 from contextlib import contextmanager
+from typing import Optional
+import itertools
+import threading
+import time
 import pymysql
 from fastapi import HTTPException
-from app.core.config import DB_CONFIG
+from app.core.traces import span
+from app.core.config import (
+    DB_SHARDS,
+    DB_REPLICAS,
+    DB_REPLICA_MAX_RETARD_SEGONS,
+    DB_REPLICA_COMPROVACIO_SEGONS,
+)
 
 pymysql.install_as_MySQLdb()
 
+# Estat de cada rèplica: índex -> (és apta, instant de l'última comprovació)
+_estat_replicas: dict[int, tuple[bool, float]] = {}
+_estat_lock = threading.Lock()
+_seguent_replica = itertools.count()
+
+# Amb diversos shards, cada un genera IDs amb pas N i desplaçament shard + 1 (1, N + 1, 2N + 1, ... al shard 0),
+# de manera que el shard d'una fila es pot calcular a partir del seu ID (vegeu app/db/sharding.py)
+_CONFIG_SHARDS = [
+    {
+        **config,
+        "init_command": f"SET SESSION auto_increment_increment = {len(DB_SHARDS)}, auto_increment_offset = {shard + 1}",
+    } if len(DB_SHARDS) > 1 else config
+    for shard, config in enumerate(DB_SHARDS)
+]
+
+# Connexió a la primària d'un shard (per defecte, el shard 0, on hi ha les taules globals)
+@contextmanager
+def get_db_connection(shard: int = 0):
+    conn = None
+    try:
+        with span("db.connexio", shard=shard, lectura=False):
+            conn = pymysql.connect(**_CONFIG_SHARDS[shard])
+        yield conn
+    except pymysql.Error as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error de base de datos: {str(e)}"
+        )
+    finally:
+        if conn:
+            conn.close()
+
+# Connexió per a consultes de només lectura. S'envia a una rèplica al dia si n'hi ha cap,
+# i si no (o no n'hi ha de configurades) a la primària. Les rèpliques només ho són del shard 0
+# Les escriptures i les lectures que han de veure una escriptura recent han d'emprar get_db_connection()
 @contextmanager
-def get_db_connection():
+def get_db_read_connection(shard: int = 0):
     conn = None
     try:
-        conn = pymysql.connect(**DB_CONFIG)
+        with span("db.connexio", shard=shard, lectura=True) as s:
+            conn = (_connectar_replica() if shard == 0 else None) or pymysql.connect(**_CONFIG_SHARDS[shard])
+            if s is not None:
+                s.atributs["host"] = conn.host
         yield conn
     except pymysql.Error as e:
         raise HTTPException(
@@ -17,4 +64,59 @@ def get_db_connection():
         )
     finally:
         if conn:
-            conn.close()
\ No newline at end of file
+            conn.close()
+
+
+## Helpers
+# Retorna el retard de replicació en segons, o None si la replicació està aturada
+def _retard_replica(conn) -> Optional[int]:
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone()
+        if not row:
+            return None
+        columnes = [c[0] for c in cursor.description]
+        return row[columnes.index("Seconds_Behind_Master")]
+    finally:
+        cursor.close()
+
+# Connecta a la següent rèplica apta (round-robin). Les rèpliques caigudes o massa endarrerides
+# es descarten fins a la següent comprovació
+def _connectar_replica():
+    if not DB_REPLICAS:
+        return None
+
+    inici = next(_seguent_replica)
+    for i in range(len(DB_REPLICAS)):
+        index = (inici + i) % len(DB_REPLICAS)
+        ara = time.monotonic()
+        with _estat_lock:
+            apta, comprovada = _estat_replicas.get(index, (True, 0.0))
+        cal_comprovar = ara - comprovada >= DB_REPLICA_COMPROVACIO_SEGONS
+
+        if not apta and not cal_comprovar:
+            continue
+
+        try:
+            conn = pymysql.connect(**DB_REPLICAS[index])
+        except pymysql.Error:
+            with _estat_lock:
+                _estat_replicas[index] = (False, ara)
+            continue
+
+        if cal_comprovar:
+            try:
+                retard = _retard_replica(conn)
+            except pymysql.Error:
+                retard = None
+            apta = retard is not None and retard <= DB_REPLICA_MAX_RETARD_SEGONS
+            with _estat_lock:
+                _estat_replicas[index] = (apta, ara)
+            if not apta:
+                conn.close()
+                continue
+
+        return conn
+
+    return None
@@ -0,0 +1,152 @@
+import asyncio
+import itertools
+from typing import Callable, Iterable, Optional, TypeVar
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.config import DB_SHARDS, DB_SHARDS_ID_INICIAL
+from app.db.database import get_db_connection, get_db_read_connection
+
+'''
+Repartiment de les dades dels passatgers entre diversos nodes de MariaDB (shards).
+
+Un passatger i tot el que en depèn (targetes, targetes virtuals i codis 2FA) viuen al mateix shard.
+Cada shard genera els IDs amb pas N_SHARDS i desplaçament shard + 1, per això el shard d'un passatger,
+d'una targeta o d'una targeta virtual es calcula directament a partir del seu ID, sense cap consulta.
+Les files creades abans d'activar els shards (ID fins a DB_SHARDS_ID_INICIAL) es queden a la primària.
+
+Per a les cerques que no porten ID hi ha un directori a la primària (shard 0):
+- directori_passatger: document -> id_passatger
+- directori_targeta: codi_targeta -> id_targeta (també garanteix que el codi sigui únic entre shards)
+El token dels QR porta el shard com a prefix (vegeu app/core/qr.py).
+
+Els llistats i les cerques sense clau de shard es fan a tots els shards en paral·lel i se n'ajunten els resultats.
+Amb un sol shard (sense MARIADB_SHARDS) no es consulta cap directori i tot va a la primària com abans.
+'''
+
+N_SHARDS = len(DB_SHARDS)
+
+T = TypeVar("T")
+
+_seguent_shard = itertools.count()
+
+
+def shard_de_id(id_fila: int) -> int:
+    if id_fila <= DB_SHARDS_ID_INICIAL:
+        return 0
+    return (id_fila - 1) % N_SHARDS
+
+# Shard on es crea un passatger nou (round-robin)
+def shard_nou() -> int:
+    return next(_seguent_shard) % N_SHARDS
+
+# Executa funcio(shard) a tots els shards (o als indicats) en paral·lel i en retorna els resultats en ordre de shard
+# Si només n'hi ha un s'executa directament, sense passar pel threadpool
+async def recollir(funcio: Callable[[int], T], shards: Optional[Iterable[int]] = None) -> list[T]:
+    shards = list(range(N_SHARDS)) if shards is None else list(shards)
+    if len(shards) <= 1:
+        return [funcio(shard) for shard in shards]
+    return list(await asyncio.gather(*(run_in_threadpool(funcio, shard) for shard in shards)))
+
+
+## Directori de documents
+
+# Shards on hi ha algun passatger amb aquest document
+def shards_document(document: str) -> list[int]:
+    if N_SHARDS == 1:
+        return [0]
+    with get_db_read_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT id_passatger FROM directori_passatger WHERE document = %s",
+                (document,)
+            )
+            return sorted({shard_de_id(row[0]) for row in cursor.fetchall()})
+        finally:
+            cursor.close()
+
+def registrar_document(document: str, id_passatger: int) -> None:
+    if N_SHARDS == 1:
+        return
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT IGNORE INTO directori_passatger (document, id_passatger) VALUES (%s, %s)",
+                (document, id_passatger)
+            )
+            conn.commit()
+        finally:
+            cursor.close()
+
+def esborrar_document(document: str, id_passatger: int) -> None:
+    if N_SHARDS == 1:
+        return
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "DELETE FROM directori_passatger WHERE document = %s AND id_passatger = %s",
+                (document, id_passatger)
+            )
+            conn.commit()
+        finally:
+            cursor.close()
+
+
+## Directori de codis de targeta
+
+# Reserva un codi de targeta a tots els shards. Retorna False si ja el té una altra targeta
+# Amb un sol shard la unicitat ja la garanteix la clau `uq_targeta_codi`
+def reservar_codi_targeta(codi_targeta: str) -> bool:
+    if N_SHARDS == 1:
+        return True
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT IGNORE INTO directori_targeta (codi_targeta) VALUES (%s)",
+                (codi_targeta,)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            cursor.close()
+
+def assignar_codi_targeta(codi_targeta: str, id_targeta: Optional[int]) -> None:
+    if N_SHARDS == 1:
+        return
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # Sense ID (la targeta no s'ha pogut crear) s'allibera la reserva
+            if id_targeta is None:
+                cursor.execute(
+                    "DELETE FROM directori_targeta WHERE codi_targeta = %s",
+                    (codi_targeta,)
+                )
+            else:
+                cursor.execute(
+                    "UPDATE directori_targeta SET id_targeta = %s WHERE codi_targeta = %s",
+                    (id_targeta, codi_targeta)
+                )
+            conn.commit()
+        finally:
+            cursor.close()
+
+# Shard de la targeta amb aquest codi (None si no existeix)
+def shard_codi_targeta(codi_targeta: str) -> Optional[int]:
+    if N_SHARDS == 1:
+        return 0
+    with get_db_read_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT id_targeta FROM directori_targeta WHERE codi_targeta = %s AND id_targeta IS NOT NULL",
+                (codi_targeta,)
+            )
+            row = cursor.fetchone()
+            return shard_de_id(row[0]) if row else None
+        finally:
+            cursor.close()
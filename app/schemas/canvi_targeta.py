@@ -0,0 +1,34 @@
+from pydantic import BaseModel
+from typing import List
+from datetime import datetime
+
+
+class CanviTargetaResponse(BaseModel):
+    versio: int
+    id_targeta: int
+    codi_targeta: str
+    estat: str
+    data_canvi: datetime
+
+
+class CanvisTargetaResponse(BaseModel):
+    canvis: List[CanviTargetaResponse]
+    seguent: str
+    mes: bool
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "canvis": [
+                    {
+                        "versio": 1842,
+                        "id_targeta": 42,
+                        "codi_targeta": "GE004217",
+                        "estat": "Robada",
+                        "data_canvi": "2026-02-19T08:14:03"
+                    }
+                ],
+                "seguent": "1842",
+                "mes": False
+            }
+        }
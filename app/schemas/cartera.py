@@ -0,0 +1,47 @@
+from pydantic import BaseModel
+from typing import List, Optional
+
+from app.schemas.passatger import PassatgerResponse
+from app.schemas.targeta import TargetaResponse
+from app.schemas.targeta_virtual import TargetaVirtualResponse
+
+
+class TargetaCarteraResponse(TargetaResponse):
+    targeta_virtual: Optional[TargetaVirtualResponse] = None
+
+
+class CarteraResponse(BaseModel):
+    passatger: PassatgerResponse
+    targetes: Optional[List[TargetaCarteraResponse]] = None
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "passatger": {
+                    "id": 7,
+                    "nom": "Joan",
+                    "llinatge_1": "Garcia",
+                    "llinatge_2": "Lopez",
+                    "document": "12345678A",
+                    "email": "joan.garcia@example.com",
+                    "sessio_iniciada": True
+                },
+                "targetes": [
+                    {
+                        "id": 42,
+                        "id_passatger": 7,
+                        "codi_targeta": "GE000384",
+                        "perfil": "General",
+                        "saldo": "12.50",
+                        "estat": "Activa",
+                        "targeta_virtual": {
+                            "id": 1,
+                            "id_targeta_mare": 42,
+                            "qr": "a3f1c2d4e5b6...",
+                            "data_creacio": "2024-01-15T10:00:00",
+                            "data_expiracio": "2024-01-15T10:01:00"
+                        }
+                    }
+                ]
+            }
+        }
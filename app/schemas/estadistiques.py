@@ -0,0 +1,31 @@
+from pydantic import BaseModel
+from typing import Dict, Optional
+from decimal import Decimal
+from datetime import datetime
+
+
+class EstadistiquesResponse(BaseModel):
+    targetes_total: int
+    targetes_per_perfil: Dict[str, int]
+    targetes_per_estat: Dict[str, int]
+    saldo_total: Decimal
+    saldo_mitja: Decimal
+    targetes_virtuals_actives: int
+    passatgers_amb_sessio: int
+    data_sincronitzacio: Optional[datetime]
+    max_antiguitat_segons: int
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "targetes_total": 1520,
+                "targetes_per_perfil": {"General": 900, "Jove": 320, "Infantil": 150, "Pensionista": 140, "Altres": 10},
+                "targetes_per_estat": {"Activa": 1400, "Perduda": 60, "Robada": 20, "Caducada": 40},
+                "saldo_total": "18234.50",
+                "saldo_mitja": "12.00",
+                "targetes_virtuals_actives": 37,
+                "passatgers_amb_sessio": 812,
+                "data_sincronitzacio": "2026-02-19T10:30:00",
+                "max_antiguitat_segons": 60
+            }
+        }
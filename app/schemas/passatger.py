@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 
 class PassatgerCreate(BaseModel):
@@ -39,4 +39,27 @@ class PassatgerResponse(BaseModel):
     llinatge_2: Optional[str]
     document: str
     email: str
-    sessio_iniciada: bool
\ No newline at end of file
+    sessio_iniciada: bool
+
+
+class PassatgerCercaResponse(BaseModel):
+    resultats: List[PassatgerResponse]
+    seguent: Optional[int]
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "resultats": [
+                    {
+                        "id": 12,
+                        "nom": "Maria",
+                        "llinatge_1": "Riera",
+                        "llinatge_2": "Rotger",
+                        "document": "19232030H",
+                        "email": "mariarierar@gmail.com",
+                        "sessio_iniciada": False
+                    }
+                ],
+                "seguent": 12
+            }
+        }
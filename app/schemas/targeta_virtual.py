@@ -22,6 +22,41 @@ class Config:
         }
 
 
+class TargetaVirtualAmbImatgeResponse(TargetaVirtualResponse):
+    imatge: str
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "id": 1,
+                "id_targeta_mare": 42,
+                "qr": "a3f1c2d4e5b6...",
+                "data_creacio": "2024-01-15T10:00:00",
+                "data_expiracio": "2024-01-15T10:01:00",
+                "imatge": "/9j/4AAQSkZJRgABAQAAAQABAAD..."
+            }
+        }
+
+
+class SecretQRResponse(BaseModel):
+    id_targeta_mare: int
+    secret: str
+    periode_segons: int
+    digits: int
+    format: str
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "id_targeta_mare": 42,
+                "secret": "GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ",
+                "periode_segons": 30,
+                "digits": 8,
+                "format": "T-42-{codi}"
+            }
+        }
+
+
 class VerifyQRRequest(BaseModel):
     qr: str
 
@@ -39,6 +74,7 @@ class VerifyQRResponse(BaseModel):
     codi_targeta: str
     perfil: str
     saldo: float
+    import_cobrat: float
     passatger_id: int
     nom: str
     llinatge_1: str
@@ -53,7 +89,8 @@ class Config:
                 "id_targeta_mare": 42,
                 "codi_targeta": "GE000384",
                 "perfil": "General",
-                "saldo": 12.50,
+                "saldo": 11.00,
+                "import_cobrat": 1.50,
                 "passatger_id": 7,
                 "nom": "Joan",
                 "llinatge_1": "Garcia",
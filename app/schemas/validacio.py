@@ -0,0 +1,54 @@
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+from datetime import date, datetime
+from decimal import Decimal
+
+
+class ValidacioResponse(BaseModel):
+    id: int
+    id_targeta: int
+    id_passatger: int
+    perfil: str
+    import_cobrat: Decimal
+    id_usuari: Optional[int]
+    data_validacio: datetime
+
+
+class HistoricTargetaResponse(BaseModel):
+    resultats: List[ValidacioResponse]
+    seguent: Optional[int]
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "resultats": [
+                    {
+                        "id": 10231,
+                        "id_targeta": 42,
+                        "id_passatger": 7,
+                        "perfil": "General",
+                        "import_cobrat": "1.50",
+                        "id_usuari": 3,
+                        "data_validacio": "2026-02-19T08:14:03"
+                    }
+                ],
+                "seguent": None
+            }
+        }
+
+
+class ValidacionsDiaResponse(BaseModel):
+    dia: date
+    validacions: int
+    targetes: int
+    per_perfil: Dict[str, int]
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "dia": "2026-02-19",
+                "validacions": 18342,
+                "targetes": 9120,
+                "per_perfil": {"General": 11020, "Jove": 4100, "Pensionista": 2210, "Infantil": 1012}
+            }
+        }
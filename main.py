@@ -1,17 +1,51 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-import uvicorn
+import json
 import os
 from dotenv import load_dotenv
 from app.api.v1 import router as v1_router
+from app.core.idempotencia import IdempotenciaMiddleware
+from app.core.traces import TracesMiddleware
+from app.core.validacions import buffer_validacions
+from app.core.bloquejades import llista_bloquejades
 
 load_dotenv()
 
+# Tasques de fons del worker: en aturar-se, l'històric de validacions escriu el que tenia pendent
+# i la llista de targetes bloquejades deixa d'actualitzar-se
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    buffer_validacions.iniciar()
+    llista_bloquejades.iniciar()
+    yield
+    await llista_bloquejades.aturar()
+    await buffer_validacions.aturar()
+
 app = FastAPI(
     title="tuAPI",
     description="API RESTful per a manejar dades de passatgers, targetes i codis QR de l'infraestructura del Transport de les Illes Balears",
     version="1.0.0",
+    lifespan=lifespan,
 )
 app.include_router(v1_router)
+app.add_middleware(IdempotenciaMiddleware)
+# S'afegeix la darrera perquè sigui la més externa i la traça inclogui també la resta de middlewares
+app.add_middleware(TracesMiddleware)
+
+# Ruta de l'esquema OpenAPI precalculat (es genera a la build de Docker amb scripts/generar_openapi.py)
+OPENAPI_PATH = os.getenv("OPENAPI_PATH", "openapi.json")
+
+# Si existeix l'esquema precalculat es carrega del disc. Si no, es genera un sol cop i queda a memòria
+def _openapi_precalculat() -> dict:
+    if app.openapi_schema is None:
+        if os.path.exists(OPENAPI_PATH):
+            with open(OPENAPI_PATH, encoding="utf-8") as f:
+                app.openapi_schema = json.load(f)
+        else:
+            FastAPI.openapi(app)
+    return app.openapi_schema
+
+app.openapi = _openapi_precalculat
 
 @app.get(
     "/",
@@ -33,5 +67,7 @@ async def root():
     }
 
 if __name__ == "__main__":
+    import uvicorn
+
     port = int(os.getenv("FASTAPI_PORT"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=port)
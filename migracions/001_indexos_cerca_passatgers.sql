@@ -0,0 +1,16 @@
+-- Índexos per a l'endpoint de cerca de passatgers (GET /api/v1/passatgers/cerca)
+-- Per a bases de dades creades amb una versió anterior de tu.sql: mysql targeta_unica < migracions/001_indexos_cerca_passatgers.sql
+
+ALTER TABLE `passatger`
+    ADD KEY `idx_passatger_document` (`document`),
+    ADD KEY `idx_passatger_email` (`email`),
+    ADD KEY `idx_passatger_llinatges` (`llinatge_1`, `llinatge_2`),
+    ADD KEY `idx_passatger_llinatge_2` (`llinatge_2`);
+
+-- InnoDB només permet crear un índex FULLTEXT per sentència ALTER TABLE
+ALTER TABLE `passatger`
+    ADD FULLTEXT KEY `ft_passatger_nom` (`nom`, `llinatge_1`, `llinatge_2`);
+
+-- Els codis de targeta ja es generen únics. L'índex únic ho garanteix i accelera la cerca per codi
+ALTER TABLE `targeta`
+    ADD UNIQUE KEY `uq_targeta_codi` (`codi_targeta`);
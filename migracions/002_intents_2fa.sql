@@ -0,0 +1,5 @@
+-- Comptador d'intents dels codis 2FA (només s'empra amb CODIS_2FA_BACKEND=sql)
+-- mysql targeta_unica < migracions/002_intents_2fa.sql
+
+ALTER TABLE `2fa`
+    ADD COLUMN `intents` TINYINT NOT NULL DEFAULT 0 AFTER `data_expiracio`;
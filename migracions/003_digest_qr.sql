@@ -0,0 +1,15 @@
+-- Els tokens QR es cerquen pel seu SHA-256 (BINARY(32)) en lloc de comparar el VARCHAR(255) amb col·lació
+-- Els tokens compactes ja no es desen: es deriven de `qr_sal` amb la SECRET_KEY de l'API
+-- mysql targeta_unica < migracions/003_digest_qr.sql
+
+ALTER TABLE `targeta_virtual`
+    MODIFY COLUMN `qr` VARCHAR(255) NULL,
+    ADD COLUMN `qr_digest` BINARY(32) NULL AFTER `qr`,
+    ADD COLUMN `qr_sal` BINARY(16) NULL AFTER `qr_digest`;
+
+-- Les targetes virtuals existents conserven el token a `qr` i s'hi afegeix el digest per a poder-les verificar
+UPDATE `targeta_virtual` SET `qr_digest` = UNHEX(SHA2(`qr`, 256));
+
+ALTER TABLE `targeta_virtual`
+    MODIFY COLUMN `qr_digest` BINARY(32) NOT NULL,
+    ADD UNIQUE KEY `uq_targeta_virtual_qr_digest` (`qr_digest`);
@@ -0,0 +1,28 @@
+-- Històric de validacions, particionat per mesos. Les validacions s'hi escriuen en lots des de l'API
+-- mysql targeta_unica < migracions/004_historic_validacions.sql
+
+CREATE TABLE IF NOT EXISTS `validacio` (
+    `id`              BIGINT                                                        NOT NULL AUTO_INCREMENT,
+    `id_targeta`      INT(8)                                                        NOT NULL,
+    `id_passatger`    INT(8)                                                        NOT NULL,
+    `perfil`          ENUM('Infantil', 'Jove', 'General', 'Pensionista', 'Altres')  NOT NULL,
+    `id_usuari`       INT(8)                                                            NULL,
+    `data_validacio`  DATETIME                                                      NOT NULL,
+    PRIMARY KEY (`id`, `data_validacio`),
+    KEY `idx_validacio_targeta_data` (`id_targeta`, `data_validacio`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+PARTITION BY RANGE COLUMNS (`data_validacio`) (
+    PARTITION `p202601` VALUES LESS THAN ('2026-02-01'),
+    PARTITION `p202602` VALUES LESS THAN ('2026-03-01'),
+    PARTITION `p202603` VALUES LESS THAN ('2026-04-01'),
+    PARTITION `p202604` VALUES LESS THAN ('2026-05-01'),
+    PARTITION `p202605` VALUES LESS THAN ('2026-06-01'),
+    PARTITION `p202606` VALUES LESS THAN ('2026-07-01'),
+    PARTITION `p202607` VALUES LESS THAN ('2026-08-01'),
+    PARTITION `p202608` VALUES LESS THAN ('2026-09-01'),
+    PARTITION `p202609` VALUES LESS THAN ('2026-10-01'),
+    PARTITION `p202610` VALUES LESS THAN ('2026-11-01'),
+    PARTITION `p202611` VALUES LESS THAN ('2026-12-01'),
+    PARTITION `p202612` VALUES LESS THAN ('2027-01-01'),
+    PARTITION `pmax` VALUES LESS THAN (MAXVALUE)
+);
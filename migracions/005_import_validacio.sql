@@ -0,0 +1,5 @@
+-- La verificació de QR cobra la tarifa del viatge i l'import queda a l'històric de validacions
+-- mysql targeta_unica < migracions/005_import_validacio.sql
+
+ALTER TABLE `validacio`
+    ADD COLUMN `import_cobrat` NUMERIC(8, 2) NOT NULL DEFAULT 0.00 AFTER `perfil`;
@@ -0,0 +1,28 @@
+-- Directoris de documents i codis de targeta per a repartir els passatgers entre diversos shards
+-- S'aplica a la primària (shard 0): mysql targeta_unica < migracions/006_directori_shards.sql
+--
+-- Les dades existents es queden a la primària. Abans d'afegir shards (MARIADB_SHARDS):
+-- 1. Definir MARIADB_SHARDS_ID_INICIAL >= l'ID més alt de `passatger`, `targeta` i `targeta_virtual`
+-- 2. Als nodes nous (creats amb tu.sql), començar els AUTO_INCREMENT per damunt d'aquest valor, per exemple:
+--    ALTER TABLE passatger AUTO_INCREMENT = 100001;
+--    ALTER TABLE targeta AUTO_INCREMENT = 100001;
+--    ALTER TABLE targeta_virtual AUTO_INCREMENT = 100001;
+
+CREATE TABLE IF NOT EXISTS `directori_passatger` (
+    `document`      VARCHAR(16)  NOT NULL,
+    `id_passatger`  INT(8)       NOT NULL,
+    PRIMARY KEY (`document`, `id_passatger`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `directori_targeta` (
+    `codi_targeta`  VARCHAR(16)  NOT NULL,
+    `id_targeta`    INT(8)           NULL,
+    PRIMARY KEY (`codi_targeta`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Els passatgers i les targetes existents s'afegeixen als directoris
+INSERT IGNORE INTO `directori_passatger` (`document`, `id_passatger`)
+    SELECT `document`, `id` FROM `passatger`;
+
+INSERT IGNORE INTO `directori_targeta` (`codi_targeta`, `id_targeta`)
+    SELECT `codi_targeta`, `id` FROM `targeta`;
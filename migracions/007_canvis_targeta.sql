@@ -0,0 +1,34 @@
+-- Registre de canvis d'estat de les targetes per a la sincronització per deltes de les validadores
+-- S'aplica a cada shard: mysql targeta_unica < migracions/007_canvis_targeta.sql
+
+CREATE TABLE IF NOT EXISTS `comptador_canvis` (
+    `id`      TINYINT  NOT NULL,
+    `versio`  BIGINT   NOT NULL DEFAULT 0,
+    PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `canvi_targeta` (
+    `versio`        BIGINT                                                                    NOT NULL,
+    `id_targeta`    INT(8)                                                                    NOT NULL,
+    `codi_targeta`  VARCHAR(16)                                                               NOT NULL,
+    `estat`         ENUM('Activa', 'Robada', 'Caducada', 'Perduda', 'Desactivada', 'Altres')  NOT NULL,
+    `data_canvi`    DATETIME                                                                  NOT NULL,
+    PRIMARY KEY (`versio`),
+    KEY `idx_canvi_targeta_targeta` (`id_targeta`, `versio`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `dispositiu_canvis` (
+    `id_dispositiu`        VARCHAR(64)  NOT NULL,
+    `versio`               BIGINT       NOT NULL,
+    `data_sincronitzacio`  DATETIME     NOT NULL,
+    PRIMARY KEY (`id_dispositiu`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- L'estat actual de les targetes existents és el punt de partida del registre:
+-- un dispositiu que es sincronitza des de 0 les rep totes
+INSERT INTO `canvi_targeta` (`versio`, `id_targeta`, `codi_targeta`, `estat`, `data_canvi`)
+    SELECT ROW_NUMBER() OVER (ORDER BY `id`), `id`, `codi_targeta`, `estat`, UTC_TIMESTAMP()
+    FROM `targeta`;
+
+INSERT INTO `comptador_canvis` (`id`, `versio`)
+    SELECT 1, COALESCE(MAX(`versio`), 0) FROM `canvi_targeta`;
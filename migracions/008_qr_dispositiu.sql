@@ -0,0 +1,15 @@
+-- Secret dels QR generats al dispositiu (TOTP), com a alternativa a crear una targeta virtual cada minut
+-- S'aplica a cada shard: mysql targeta_unica < migracions/008_qr_dispositiu.sql
+
+CREATE TABLE IF NOT EXISTS `qr_dispositiu` (
+    `id_targeta`     INT(8)      NOT NULL,
+    `sal`            BINARY(16)  NOT NULL,
+    `darrer_pas`     BIGINT      NOT NULL DEFAULT 0,
+    `data_provisio`  DATETIME    NOT NULL,
+    PRIMARY KEY (`id_targeta`),
+    CONSTRAINT `fk_qr_dispositiu_targeta`
+        FOREIGN KEY (`id_targeta`)
+        REFERENCES `targeta` (`id`)
+        ON UPDATE CASCADE
+        ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
@@ -0,0 +1,88 @@
+# Benchmark del temps d'arrencada de l'API: temps d'importació de main.py i temps fins a la primera resposta
+# Ús: python -m scripts.bench_arrencada [repeticions]
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+REPETICIONS = 5
+TIMEOUT_ARRENCADA_SEGONS = 30
+
+
+# Mesura el temps d'importar main.py dins un procés nou (sense mòduls ja carregats a memòria)
+def _temps_importacio() -> float:
+    codi = (
+        "import time\n"
+        "t = time.perf_counter()\n"
+        "import main\n"
+        "print(time.perf_counter() - t)\n"
+    )
+    sortida = subprocess.run(
+        [sys.executable, "-c", codi],
+        check=True, capture_output=True, text=True
+    )
+    return float(sortida.stdout.strip().splitlines()[-1])
+
+
+def _port_lliure() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _esperar_resposta(url: str, limit: float) -> None:
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resposta:
+                resposta.read()
+                return
+        except OSError:
+            if time.perf_counter() > limit:
+                raise TimeoutError(f"L'API no ha respost a {url}")
+            time.sleep(0.01)
+
+
+# Mesura el temps des de llançar uvicorn fins a rebre la primera resposta de '/' i de '/openapi.json'
+def _temps_primera_peticio() -> tuple[float, float]:
+    port = _port_lliure()
+    inici = time.perf_counter()
+    proces = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=os.environ.copy()
+    )
+    try:
+        _esperar_resposta(f"http://127.0.0.1:{port}/", inici + TIMEOUT_ARRENCADA_SEGONS)
+        primera = time.perf_counter() - inici
+
+        t = time.perf_counter()
+        _esperar_resposta(f"http://127.0.0.1:{port}/openapi.json", t + TIMEOUT_ARRENCADA_SEGONS)
+        openapi = time.perf_counter() - t
+        return primera, openapi
+    finally:
+        proces.terminate()
+        proces.wait()
+
+
+def _resum(nom: str, mostres: list[float]) -> None:
+    print(
+        f"{nom:<28} mediana {statistics.median(mostres) * 1000:8.1f} ms"
+        f"   min {min(mostres) * 1000:8.1f} ms   max {max(mostres) * 1000:8.1f} ms"
+    )
+
+
+def main() -> None:
+    repeticions = int(sys.argv[1]) if len(sys.argv) > 1 else REPETICIONS
+
+    importacio = [_temps_importacio() for _ in range(repeticions)]
+    peticions = [_temps_primera_peticio() for _ in range(repeticions)]
+
+    _resum("Importació de main.py", importacio)
+    _resum("Arrencada fins a 1a petició", [p[0] for p in peticions])
+    _resum("Primer /openapi.json", [p[1] for p in peticions])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Benchmark del renderitzat i la lectura de QR segons el format i la longitud del token
+# Ús: python -m scripts.bench_qr [repeticions]
+# La lectura (decodificació) només es mesura si hi ha instal·lat pyzbar (pip install pyzbar + libzbar0)
+import io
+import statistics
+import sys
+import time
+
+import qrcode
+from PIL import Image
+
+from app.core.qr import _generar_token_compacte, _generar_token_llegat, renderitzar_qr
+
+REPETICIONS = 200
+
+FORMATS = {
+    "compacte 160 bits": _generar_token_compacte,
+    "llegat 255 hex": _generar_token_llegat,
+}
+
+
+def _versio_qr(token: str) -> int:
+    qr = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_M)
+    qr.add_data(token)
+    qr.make(fit=True)
+    return qr.version
+
+
+def _mediana_ms(funcio, repeticions: int) -> float:
+    mostres = []
+    for _ in range(repeticions):
+        t = time.perf_counter()
+        funcio()
+        mostres.append(time.perf_counter() - t)
+    return statistics.median(mostres) * 1000
+
+
+def main() -> None:
+    repeticions = int(sys.argv[1]) if len(sys.argv) > 1 else REPETICIONS
+
+    try:
+        from pyzbar.pyzbar import decode
+    except ImportError:
+        decode = None
+
+    print(f"{'Format':<20} {'Longitud':>8} {'Versió':>7} {'Mòduls':>7} {'JPEG':>8} {'Render':>10} {'Lectura':>10}")
+    for nom, generar in FORMATS.items():
+        token = generar()[0]
+        versio = _versio_qr(token)
+        imatge = renderitzar_qr(token)
+        render = _mediana_ms(lambda: renderitzar_qr(generar()[0]), repeticions)
+
+        lectura = "n/d"
+        if decode is not None:
+            pil = Image.open(io.BytesIO(imatge))
+            pil.load()
+            assert decode(pil)[0].data.decode("ascii") == token
+            lectura = f"{_mediana_ms(lambda: decode(pil), repeticions):7.2f} ms"
+
+        print(
+            f"{nom:<20} {len(token):>8} {versio:>7} {17 + 4 * versio:>7} {len(imatge):>7}B"
+            f" {render:7.2f} ms {lectura:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
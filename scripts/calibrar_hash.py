@@ -0,0 +1,74 @@
+# Calibra el cost del hash de contrasenyes per a aquest maquinari: per a cada algorisme, augmenta el cost fins que
+# un hash supera la latència objectiu i proposa el darrer valor que hi cap (vegeu app/core/contrasenyes.py)
+# Ús: python -m scripts.calibrar_hash [latencia_ms] [bcrypt|scrypt]
+# S'ha d'executar a la mateixa màquina (i amb la mateixa càrrega) on s'executarà l'API
+import statistics
+import sys
+import time
+
+from app.core.contrasenyes import hash_bcrypt, hash_scrypt, verificar, CONTRASENYES_SCRYPT_R, CONTRASENYES_SCRYPT_P
+
+LATENCIA_MS = 250
+REPETICIONS = 3
+CONTRASENYA = "contrasenya-de-calibratge"
+
+BCRYPT_RONDES = range(8, 18)
+SCRYPT_LN = range(12, 22)
+
+
+def _mesurar(funcio) -> float:
+    temps = []
+    for _ in range(REPETICIONS):
+        t = time.perf_counter()
+        funcio()
+        temps.append((time.perf_counter() - t) * 1000)
+    return statistics.median(temps)
+
+
+# Prova costos creixents fins que se supera la latència. Retorna el darrer cost que no la supera (o el primer)
+def _calibrar(nom: str, costos: range, funcio, latencia_ms: float) -> int:
+    escollit = costos[0]
+    for cost in costos:
+        ms = _mesurar(lambda: funcio(cost))
+        print(f"  {nom}={cost}: {ms:.0f} ms")
+        if ms > latencia_ms:
+            break
+        escollit = cost
+    return escollit
+
+
+def main() -> None:
+    latencia_ms = float(sys.argv[1]) if len(sys.argv) > 1 else LATENCIA_MS
+    algorismes = [sys.argv[2]] if len(sys.argv) > 2 else ["bcrypt", "scrypt"]
+
+    # Comprovació ràpida de que els hashos generats es verifiquen
+    assert verificar(CONTRASENYA, hash_bcrypt(CONTRASENYA, 4))
+    assert verificar(CONTRASENYA, hash_scrypt(CONTRASENYA, 10, 8, 1))
+
+    print(f"Latència objectiu: {latencia_ms:.0f} ms per hash (mediana de {REPETICIONS})")
+    recomanacions = []
+
+    if "bcrypt" in algorismes:
+        print("bcrypt:")
+        rondes = _calibrar("rondes", BCRYPT_RONDES, lambda c: hash_bcrypt(CONTRASENYA, c), latencia_ms)
+        recomanacions.append(("bcrypt", [f"CONTRASENYES_BCRYPT_RONDES={rondes}"]))
+
+    if "scrypt" in algorismes:
+        r, p = CONTRASENYES_SCRYPT_R, CONTRASENYES_SCRYPT_P
+        print(f"scrypt (r={r}, p={p}):")
+        ln = _calibrar("ln", SCRYPT_LN, lambda c: hash_scrypt(CONTRASENYA, c, r, p), latencia_ms)
+        print(f"  memòria per hash amb ln={ln}: {128 * r * 2 ** ln / 2 ** 20:.0f} MiB")
+        recomanacions.append(("scrypt", [
+            f"CONTRASENYES_SCRYPT_LN={ln}", f"CONTRASENYES_SCRYPT_R={r}", f"CONTRASENYES_SCRYPT_P={p}"
+        ]))
+
+    print("\nValors recomanats (.env):")
+    for algorisme, variables in recomanacions:
+        print(f"# {algorisme}")
+        print(f"CONTRASENYES_ALGORISME={algorisme}")
+        for variable in variables:
+            print(variable)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+# Compacta el registre de canvis de targetes de tots els shards (vegeu app/core/canvis_targeta.py)
+# Ús: python -m scripts.compactar_canvis_targeta
+# Es pot executar periòdicament (per exemple, cada nit amb cron). Sempre es conserva la darrera entrada de cada targeta
+from app.core.canvis_targeta import compactar
+from app.db.sharding import N_SHARDS
+
+
+def main() -> None:
+    for shard in range(N_SHARDS):
+        print(f"Shard {shard}: {compactar(shard)} entrades esborrades")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+# Genera l'esquema OpenAPI de l'API i el desa a disc, per a no haver-lo de construir al primer accés a /docs
+# Ús: python -m scripts.generar_openapi [ruta_sortida]
+import json
+import sys
+
+from fastapi import FastAPI
+
+from main import app, OPENAPI_PATH
+
+
+def main() -> None:
+    ruta = sys.argv[1] if len(sys.argv) > 1 else OPENAPI_PATH
+    # Es crida directament a FastAPI.openapi per a generar sempre l'esquema a partir de les rutes actuals
+    esquema = FastAPI.openapi(app)
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump(esquema, f, ensure_ascii=False)
+    print(f"Esquema OpenAPI desat a {ruta}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Crea les particions mensuals de la taula `validacio` per als mesos següents, dividint la partició `pmax`
+# Ús: python -m scripts.particions_validacio [mesos_endavant]
+# S'ha d'executar periòdicament (per exemple, un cop al mes amb cron) abans que les validacions arribin a `pmax`
+import sys
+from datetime import date
+
+from app.db.database import get_db_connection
+
+MESOS_ENDAVANT = 3
+
+
+def _mes_seguent(dia: date) -> date:
+    return date(dia.year + dia.month // 12, dia.month % 12 + 1, 1)
+
+
+def main() -> None:
+    mesos = int(sys.argv[1]) if len(sys.argv) > 1 else MESOS_ENDAVANT
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'validacio'"
+            )
+            existents = {row[0] for row in cursor.fetchall()}
+
+            # Els mesos que falten, des del mes actual fins a 'mesos' endavant
+            noves = []
+            inici = date.today().replace(day=1)
+            for _ in range(mesos + 1):
+                nom = f"p{inici:%Y%m}"
+                fi = _mes_seguent(inici)
+                if nom not in existents:
+                    noves.append(f"PARTITION `{nom}` VALUES LESS THAN ('{fi:%Y-%m-%d}')")
+                inici = fi
+
+            if not noves:
+                print("Les particions ja existeixen")
+                return
+
+            # REORGANIZE de `pmax`: només es mouen les files de `pmax`, que hauria d'estar buida
+            cursor.execute(
+                "ALTER TABLE validacio REORGANIZE PARTITION pmax INTO ("
+                + ", ".join(noves)
+                + ", PARTITION `pmax` VALUES LESS THAN (MAXVALUE))"
+            )
+            print(f"Particions creades: {len(noves)}")
+        finally:
+            cursor.close()
+
+
+if __name__ == "__main__":
+    main()
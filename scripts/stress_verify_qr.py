@@ -0,0 +1,63 @@
+# Prova d'estrès de la verificació de QR: moltes validadores escanegen el mateix QR exactament alhora
+# i només una l'ha d'acceptar. Si en algun round se n'accepta més d'una, el script acaba amb codi 1
+# Ús: python -m scripts.stress_verify_qr <id_targeta_activa> [rounds] [validadores]
+# S'ha d'executar contra una base de dades de proves: cada round genera i consumeix una targeta virtual
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+from app.api.v1.targeta_virtual import _generar_targeta_virtual, _verificar_qr
+
+ROUNDS = 50
+VALIDADORES = 32
+
+
+def _round(id_targeta: int, validadores: int, executor: ThreadPoolExecutor) -> Counter:
+    qr = _generar_targeta_virtual(id_targeta).qr
+    # Totes les validadores esperen a la barrera per a llançar la verificació en el mateix instant
+    barrera = threading.Barrier(validadores)
+
+    def validadora() -> int:
+        barrera.wait()
+        try:
+            _verificar_qr(qr)
+            return 200
+        except HTTPException as e:
+            return e.status_code
+
+    return Counter(executor.map(lambda _: validadora(), range(validadores)))
+
+
+def main() -> None:
+    if len(sys.argv) < 2:
+        print("Ús: python -m scripts.stress_verify_qr <id_targeta_activa> [rounds] [validadores]")
+        sys.exit(2)
+    id_targeta = int(sys.argv[1])
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else ROUNDS
+    validadores = int(sys.argv[3]) if len(sys.argv) > 3 else VALIDADORES
+
+    total = Counter()
+    dobles = 0
+    t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=validadores) as executor:
+        for i in range(rounds):
+            resultat = _round(id_targeta, validadores, executor)
+            total.update(resultat)
+            if resultat[200] != 1:
+                dobles += 1
+                print(f"Round {i}: {resultat[200]} acceptacions ({dict(resultat)})")
+
+    print(f"{rounds} rounds x {validadores} validadores en {time.perf_counter() - t:.1f} s")
+    print(f"Respostes: {dict(sorted(total.items()))}")
+    if dobles:
+        print(f"ERROR: {dobles} rounds sense exactament una acceptació")
+        sys.exit(1)
+    print("Cap QR s'ha acceptat més d'un cop")
+
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,12 @@ CREATE TABLE IF NOT EXISTS `passatger` (
     `document`         VARCHAR(16)     NOT NULL,
     `email`            VARCHAR(128)    NOT NULL,
     `sessio_iniciada`  BOOLEAN         NOT NULL DEFAULT FALSE,
-    PRIMARY KEY (`id`)
+    PRIMARY KEY (`id`),
+    KEY `idx_passatger_document` (`document`),
+    KEY `idx_passatger_email` (`email`),
+    KEY `idx_passatger_llinatges` (`llinatge_1`, `llinatge_2`),
+    KEY `idx_passatger_llinatge_2` (`llinatge_2`),
+    FULLTEXT KEY `ft_passatger_nom` (`nom`, `llinatge_1`, `llinatge_2`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 CREATE TABLE IF NOT EXISTS `2fa` (
@@ -31,6 +36,7 @@ CREATE TABLE IF NOT EXISTS `2fa` (
     `codi`            NUMERIC(8, 0)   NOT NULL,
     `data_creacio`    DATETIME        NOT NULL,
     `data_expiracio`  DATETIME        NOT NULL,
+    `intents`         TINYINT         NOT NULL DEFAULT 0,
     PRIMARY KEY (`id`),
     CONSTRAINT `fk_2fa_passatger`
         FOREIGN KEY (`id_passatger`)
@@ -47,6 +53,7 @@ CREATE TABLE IF NOT EXISTS `targeta` (
     `saldo`        NUMERIC(8, 2)                                                       NOT NULL DEFAULT 0.00,
     `estat`        ENUM('Activa', 'Robada', 'Caducada', 'Perduda', 'Desactivada', 'Altres') NOT NULL DEFAULT 'Activa',
     PRIMARY KEY (`id`),
+    UNIQUE KEY `uq_targeta_codi` (`codi_targeta`),
     CONSTRAINT `fk_targeta_passatger`
         FOREIGN KEY (`id_passatger`)
         REFERENCES `passatger` (`id`)
@@ -57,10 +64,13 @@ CREATE TABLE IF NOT EXISTS `targeta` (
 CREATE TABLE IF NOT EXISTS `targeta_virtual` (
     `id`               INT(16)         NOT NULL AUTO_INCREMENT,
     `id_targeta_mare`  INT(8)          NOT NULL,
-    `qr`               VARCHAR(255)    NOT NULL,
+    `qr`               VARCHAR(255)        NULL,
+    `qr_digest`        BINARY(32)      NOT NULL,
+    `qr_sal`           BINARY(16)          NULL,
     `data_creacio`     DATETIME        NOT NULL,
     `data_expiracio`   DATETIME        NOT NULL,
     PRIMARY KEY (`id`),
+    UNIQUE KEY `uq_targeta_virtual_qr_digest` (`qr_digest`),
     CONSTRAINT `fk_targeta_virtual_targeta`
         FOREIGN KEY (`id_targeta_mare`)
         REFERENCES `targeta` (`id`)
@@ -68,6 +78,21 @@ CREATE TABLE IF NOT EXISTS `targeta_virtual` (
         ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- Secret dels QR generats al dispositiu (TOTP). Només es desa la sal: el secret es deriva amb la SECRET_KEY.
+-- `darrer_pas` és el darrer pas acceptat, per a no acceptar cap codi dues vegades
+CREATE TABLE IF NOT EXISTS `qr_dispositiu` (
+    `id_targeta`     INT(8)      NOT NULL,
+    `sal`            BINARY(16)  NOT NULL,
+    `darrer_pas`     BIGINT      NOT NULL DEFAULT 0,
+    `data_provisio`  DATETIME    NOT NULL,
+    PRIMARY KEY (`id_targeta`),
+    CONSTRAINT `fk_qr_dispositiu_targeta`
+        FOREIGN KEY (`id_targeta`)
+        REFERENCES `targeta` (`id`)
+        ON UPDATE CASCADE
+        ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 CREATE TABLE IF NOT EXISTS `user` (
     `id`          INT(8)       NOT NULL AUTO_INCREMENT,
     `nom`         VARCHAR(32)  NOT NULL,
@@ -78,4 +103,77 @@ CREATE TABLE IF NOT EXISTS `user` (
     PRIMARY KEY (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- Directoris per a trobar el shard d'un passatger pel document i d'una targeta pel codi. Només s'empren a la primària
+-- (shard 0) quan hi ha diversos shards (MARIADB_SHARDS). `directori_targeta` també fa que el codi sigui únic entre shards
+CREATE TABLE IF NOT EXISTS `directori_passatger` (
+    `document`      VARCHAR(16)  NOT NULL,
+    `id_passatger`  INT(8)       NOT NULL,
+    PRIMARY KEY (`document`, `id_passatger`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `directori_targeta` (
+    `codi_targeta`  VARCHAR(16)  NOT NULL,
+    `id_targeta`    INT(8)           NULL,
+    PRIMARY KEY (`codi_targeta`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Històric de validacions (append-only). Es particiona per mesos sobre `data_validacio`: les consultes per rang de dates
+-- només llegeixen els mesos afectats i els mesos antics es poden arxivar o eliminar amb DROP PARTITION.
+-- Les taules particionades no admeten claus foranes, per això `id_targeta` i `id_passatger` no en tenen.
+-- Les particions dels mesos següents es creen amb scripts/particions_validacio.py
+CREATE TABLE IF NOT EXISTS `validacio` (
+    `id`              BIGINT                                                        NOT NULL AUTO_INCREMENT,
+    `id_targeta`      INT(8)                                                        NOT NULL,
+    `id_passatger`    INT(8)                                                        NOT NULL,
+    `perfil`          ENUM('Infantil', 'Jove', 'General', 'Pensionista', 'Altres')  NOT NULL,
+    `import_cobrat`   NUMERIC(8, 2)                                                 NOT NULL DEFAULT 0.00,
+    `id_usuari`       INT(8)                                                            NULL,
+    `data_validacio`  DATETIME                                                      NOT NULL,
+    PRIMARY KEY (`id`, `data_validacio`),
+    KEY `idx_validacio_targeta_data` (`id_targeta`, `data_validacio`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+PARTITION BY RANGE COLUMNS (`data_validacio`) (
+    PARTITION `p202601` VALUES LESS THAN ('2026-02-01'),
+    PARTITION `p202602` VALUES LESS THAN ('2026-03-01'),
+    PARTITION `p202603` VALUES LESS THAN ('2026-04-01'),
+    PARTITION `p202604` VALUES LESS THAN ('2026-05-01'),
+    PARTITION `p202605` VALUES LESS THAN ('2026-06-01'),
+    PARTITION `p202606` VALUES LESS THAN ('2026-07-01'),
+    PARTITION `p202607` VALUES LESS THAN ('2026-08-01'),
+    PARTITION `p202608` VALUES LESS THAN ('2026-09-01'),
+    PARTITION `p202609` VALUES LESS THAN ('2026-10-01'),
+    PARTITION `p202610` VALUES LESS THAN ('2026-11-01'),
+    PARTITION `p202611` VALUES LESS THAN ('2026-12-01'),
+    PARTITION `p202612` VALUES LESS THAN ('2027-01-01'),
+    PARTITION `pmax` VALUES LESS THAN (MAXVALUE)
+);
+
+-- Registre de canvis d'estat de les targetes per a la sincronització de les validadores (vegeu app/core/canvis_targeta.py).
+-- La versió surt de `comptador_canvis`, que té una sola fila. Cada shard té el seu registre
+CREATE TABLE IF NOT EXISTS `comptador_canvis` (
+    `id`      TINYINT  NOT NULL,
+    `versio`  BIGINT   NOT NULL DEFAULT 0,
+    PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+INSERT IGNORE INTO `comptador_canvis` (`id`, `versio`) VALUES (1, 0);
+
+CREATE TABLE IF NOT EXISTS `canvi_targeta` (
+    `versio`        BIGINT                                                                    NOT NULL,
+    `id_targeta`    INT(8)                                                                    NOT NULL,
+    `codi_targeta`  VARCHAR(16)                                                               NOT NULL,
+    `estat`         ENUM('Activa', 'Robada', 'Caducada', 'Perduda', 'Desactivada', 'Altres')  NOT NULL,
+    `data_canvi`    DATETIME                                                                  NOT NULL,
+    PRIMARY KEY (`versio`),
+    KEY `idx_canvi_targeta_targeta` (`id_targeta`, `versio`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Fins on s'ha sincronitzat cada dispositiu. La compactació no esborra les entrades que encara no han llegit
+CREATE TABLE IF NOT EXISTS `dispositiu_canvis` (
+    `id_dispositiu`        VARCHAR(64)  NOT NULL,
+    `versio`               BIGINT       NOT NULL,
+    `data_sincronitzacio`  DATETIME     NOT NULL,
+    PRIMARY KEY (`id_dispositiu`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 SET FOREIGN_KEY_CHECKS = 1;